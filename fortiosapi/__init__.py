@@ -1,3 +1,17 @@
 name = "fortiosapi"
 from .fortiosapi import FortiOSAPI
-from .exceptions import (InvalidLicense, NotLogged)
+from .cache import (ResponseCache, SchemaCache, SessionCache)
+from .cliconfig import (CLIConfig, ConfigDiff, diff_configs)
+from .fleet import (FortiOSFleet, FleetResult)
+from .metrics import (RequestContext, RequestMetrics)
+from .mirror import CMDBMirror
+from .multipart import MultipartStream
+from .policy import RequestPolicy
+from .policylookup import PolicyLookup
+from .references import ReferenceIndex
+from .routing import RoutingTable
+from .subscriptions import (MonitorDelta, MonitorPoller)
+import sys
+if sys.version_info >= (3, 5):
+    from .asyncfortiosapi import AsyncFortiOSAPI
+from .exceptions import (APIError, InvalidLicense, NotLogged)
@@ -0,0 +1,1026 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# asyncfortiosapi.py is the asyncio version of fortiosapi.py
+# all the calls doing a request on the Fortigate are coroutines
+# running on aiohttp (python3 only, pip install fortiosapi[async])
+#
+###################################################################
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+from collections import deque
+
+import six.moves.urllib as urllib
+
+from . import overlay
+from .exceptions import (APIError, NotLogged)
+from .fortiosapi import FortiOSAPI, _DownloadWriter, _VERSION_UNSET
+from .metrics import RequestContext
+from .multipart import MultipartStream
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOG = logging.getLogger('fortiosapi')
+
+
+class _AsyncRequest(object):
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class AsyncResponse(object):
+    """
+    Already read aiohttp response exposing the same attributes as a requests
+    response so FortiOSAPI.formatresponse and logging work unchanged.
+    A streamed response (content None) is read with iter_chunked or read
+    and must be closed.
+    """
+
+    def __init__(self, response, content=None):
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.content = content
+        self.request = _AsyncRequest(response.method, str(response.url))
+        self._response = response
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    async def read(self):
+        if self.content is None:
+            self.content = await self._response.read()
+        return self.content
+
+    def iter_chunked(self, chunk_size):
+        return self._response.content.iter_chunked(chunk_size)
+
+    def close(self):
+        self._response.release()
+
+
+async def _multipart_body(stream):
+    # body of a MultipartStream for aiohttp, the files are read chunk by chunk while sending
+    while True:
+        chunk = stream.read(stream.chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _replayable(data):
+    # a form or a streamed body can not be sent again
+    return data is None or isinstance(data, (str, bytes))
+
+
+class _AsyncPages(object):
+    # async iterator on the records of the pages fetched with start/count,
+    # same paging as FortiOSAPI._iter_pages with the next page as a task
+
+    def __init__(self, fetch, parameters, page_size, prefetch):
+        self._fetch = fetch
+        self._parameters = parameters
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._start = 0
+        self._first = None
+        self._records = deque()
+        self._next = None
+        self._done = False
+
+    def _page(self, start):
+        params = dict(self._parameters or {})
+        params['start'] = start
+        params['count'] = self._page_size
+        return self._fetch(params)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._records:
+            if self._done:
+                raise StopAsyncIteration
+            if self._next is not None:
+                resp = await self._next
+                self._next = None
+            else:
+                resp = await self._page(self._start)
+            self._load(resp)
+        return self._records.popleft()
+
+    def _load(self, resp):
+        if not isinstance(resp, dict) or resp.get('status') != 'success':
+            self._done = True
+            raise APIError(resp)
+        results = resp.get('results') or []
+        if not isinstance(results, list):
+            results = [results]
+        if not results or (self._start > 0 and results[0] == self._first):
+            # an endpoint ignoring start would send the same page again
+            self._done = True
+            return
+        self._first = results[0]
+        self._records.extend(results)
+        # short page: the last one, longer page: count ignored, everything was sent
+        if len(results) != self._page_size:
+            self._done = True
+            return
+        self._start += self._page_size
+        if self._prefetch:
+            self._next = asyncio.ensure_future(self._page(self._start))
+
+    async def aclose(self):
+        # stop before the end, drop the page being fetched
+        self._done = True
+        self._records.clear()
+        if self._next is not None:
+            self._next.cancel()
+            try:
+                await self._next
+            except BaseException:
+                pass
+            self._next = None
+
+
+class AsyncFortiOSAPI(FortiOSAPI):
+    """
+    asyncio version of FortiOSAPI, the calls doing requests are coroutines
+    to be awaited. URL building and responses formatting are the ones of FortiOSAPI.
+    Many requests (on one or many AsyncFortiOSAPI objects) can run concurrently
+    on a single event loop. The bulk calls run their requests as tasks and
+    iter_table/iter_monitor are async iterators (async for).
+
+    :param schema_cache: a SchemaCache to share between FortiOSAPI objects
+    :param connection_limit: max number of simultaneous connections to the Fortigate
+    :param policy: RequestPolicy (retries, backoff, rate limit), see FortiOSAPI
+    :param response_cache: ResponseCache of the get/monitor responses, see FortiOSAPI
+    """
+
+    def __init__(self, schema_cache=None, connection_limit=100, policy=None, response_cache=None):
+        if aiohttp is None:
+            raise ImportError("AsyncFortiOSAPI requires aiohttp: pip install fortiosapi[async]")
+        FortiOSAPI.__init__(self, schema_cache=schema_cache, policy=policy, response_cache=response_cache)
+        # the requests session is not used, aiohttp one is created in the event loop at login
+        self._session.close()
+        self._session = None
+        self._headers = {}
+        self._ssl = None
+        self.connection_limit = connection_limit
+        # created in the event loop at login
+        self._relogin_lock = None
+        # requests in flight by response cache key, awaited by the identical ones
+        self._flights = {}
+        # (host, port, scheme): [connections opened, requests sent] for connection_stats
+        self._connection_counts = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _new_session(self, verify, cert):
+        # verify and cert have the same meaning as for a requests session
+        if verify is True:
+            context = None if cert is None else ssl.create_default_context()
+        elif verify is False:
+            context = False
+            if cert is not None:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        elif os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+        if cert is not None:
+            if isinstance(cert, (tuple, list)):
+                context.load_cert_chain(cert[0], cert[1])
+            else:
+                context.load_cert_chain(cert)
+        self._ssl = context
+        if self._session is None or self._session.closed:
+            # unsafe to accept cookies from hosts given as ip address
+            self._session = aiohttp.ClientSession(
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                connector=aiohttp.TCPConnector(limit=self.connection_limit),
+                trace_configs=[self._trace_config()])
+
+    def _trace_config(self):
+        # count the connections opened and the requests sent per host
+        trace = aiohttp.TraceConfig()
+
+        async def request_start(session, context, params):
+            context.counts = self._connection_counts.setdefault(
+                (params.url.host, params.url.port, params.url.scheme), [0, 0])
+            context.counts[1] += 1
+
+        async def connection_created(session, context, params):
+            context.counts[0] += 1
+
+        trace.on_request_start.append(request_start)
+        trace.on_connection_create_end.append(connection_created)
+        return trace
+
+    def connection_stats(self, all_hosts=False):
+        """
+        Keep alive statistics of the aiohttp connections, see FortiOSAPI.connection_stats
+
+        :param all_hosts: True for all the hosts this object sent requests to, default only this host
+        :return: list of dict host, port, scheme, connections (opened), requests, reuse
+        """
+        stats = []
+        for (host, port, scheme), (connections, requests) in list(self._connection_counts.items()):
+            if not all_hosts and self.host not in ("%s:%s" % (host, port), host):
+                continue
+            stats.append({'host': host, 'port': port, 'scheme': scheme, 'connections': connections,
+                          'requests': requests,
+                          'reuse': 1.0 - float(connections) / requests if requests else 0.0})
+        return stats
+
+    def _set_url_prefix(self, host):
+        self.host = host
+        LOG.debug("self._https is %s", self._https)
+        if not self._https:
+            self.url_prefix = 'http://' + self.host
+        else:
+            self.url_prefix = 'https://' + self.host
+
+    async def _send(self, method, url, params=None, data=None, headers=None, stream=False):
+        reqheaders = dict(self._headers)
+        if headers:
+            reqheaders.update(headers)
+        request = self._session.request(method, url, params=params, data=data, headers=reqheaders,
+                                        ssl=self._ssl, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        if stream:
+            # the body is read by the caller, total is the time to read it all
+            return AsyncResponse(await request)
+        async with request as response:
+            content = await response.read()
+            return AsyncResponse(response, content)
+
+    async def _send_retry(self, method, url, context, params=None, data=None, headers=None, stream=False):
+        # same retry policy as FortiOSAPI._send_retry, waiting without blocking the loop
+        policy = self.policy
+        replayable = _replayable(data)
+        attempt = 0
+        while True:
+            delay = policy.reserve(self.host)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                res = await self._send(method, url, params=params, data=data, headers=headers, stream=stream)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                sent = not isinstance(e, aiohttp.ClientConnectorError)
+                delay = policy.retry(self.host, method, attempt, error=e, sent=sent) if replayable else None
+                if delay is None:
+                    raise
+                LOG.debug("%s %s failed (%s), retry in %.2fs", method, url, e, delay)
+            else:
+                delay = policy.retry(self.host, method, attempt, response=res) if replayable else None
+                if delay is None:
+                    return res
+                LOG.debug("%s %s answered %s, retry in %.2fs", method, url, res.status_code, delay)
+                res.close()
+            attempt += 1
+            if context is not None:
+                context.retries = attempt
+            await asyncio.sleep(delay)
+
+    async def _request(self, method, url, endpoint=None, payload=None, params=None, data=None, headers=None,
+                       stream=False):
+        # same as FortiOSAPI._request: login again once when the session expired
+        generation = self._login_generation
+        res = await self._request_once(method, url, endpoint, payload, params=params, data=data,
+                                       headers=headers, stream=stream)
+        if (res.status_code in (401, 403) and self._credentials is not None and
+                (endpoint is None or endpoint[0] not in ('login', 'logout')) and _replayable(data)):
+            if await self._relogin(generation):
+                res.close()
+                res = await self._request_once(method, url, endpoint, payload, params=params, data=data,
+                                               headers=headers, stream=stream)
+        return res
+
+    async def _request_once(self, method, url, endpoint=None, payload=None, params=None, data=None,
+                            headers=None, stream=False):
+        # same hooks as FortiOSAPI._request_once
+        if not self._has_hooks():
+            return await self._send_retry(method, url, None, params=params, data=data, headers=headers,
+                                          stream=stream)
+        kind, path, name, mkey, vdom = endpoint or (None, None, None, None, None)
+        context = RequestContext(method, url, kind=kind, path=path, name=name, mkey=mkey, vdom=vdom,
+                                 data=payload,
+                                 bytes_out=len(data) if isinstance(data, (str, bytes)) else 0,
+                                 stream=stream)
+        self._run_hooks('before_request', context)
+        try:
+            res = await self._send_retry(method, url, context, params=params, data=data, headers=headers,
+                                         stream=stream)
+        except Exception as e:
+            context.elapsed = time.time() - context.start
+            self._run_hooks('on_error', context, e)
+            raise
+        context.elapsed = time.time() - context.start
+        self._run_hooks('after_response', context, res)
+        return res
+
+    def update_cookie(self):
+        # Retrieve server csrf and update session's headers
+        for cookie in self._session.cookie_jar:
+            if cookie.key == 'ccsrftoken':
+                csrftoken = cookie.value
+                if csrftoken.startswith('"'):
+                    csrftoken = csrftoken[1:-1]  # token stored as a list
+                self._headers['X-CSRFTOKEN'] = csrftoken
+                LOG.debug("csrftoken after update  : %s ", csrftoken)
+
+    async def login(self, host, username, password, verify=True, cert=None, timeout=12, vdom="global"):
+        """
+        Initialize the connection to the API with the related credentials.
+        Further calls on the object will reuse the session initiated here.
+
+        :param host: ip or name (fqdn) can include a port like 10.40.40.40:8443
+        :param username: name of API user
+        :param password: password of API user
+        :param verify: True verify validity of the Fortigate API ssl certificate, False ignore
+        :param cert: client certificate to authenticate
+        :param timeout: global timeout on the url session
+        :param vdom: default is root, can use global or name of the vdom to use
+        :return:
+        """
+        self._set_url_prefix(host)
+        self._new_session(verify, cert)
+        self.timeout = timeout
+        if self._relogin_lock is None:
+            self._relogin_lock = asyncio.Lock()
+        self._credentials = None
+        self._identity = username
+        await self._logincheck(username, password, vdom)
+        self._credentials = (username, password, vdom)
+        return True
+
+    async def _check_license(self, vdom):
+        # see FortiOSAPI._check_license
+        param = "{ vdom = " + vdom + " }"
+        resp_lic = await self._monitor('license', 'status', parameters=param)
+        LOG.debug("response system/status : %s", resp_lic)
+        if not isinstance(resp_lic, dict):
+            return False
+        try:
+            self._fortiversion = resp_lic['version']
+            return True
+        except KeyError:
+            return resp_lic.get('status') == 'success'
+
+    async def _logincheck(self, username, password, vdom):
+        url = self.url_prefix + '/logincheck'
+        res = await self._request(
+            'POST', url, endpoint=('login', None, None, None, None),
+            data='username=' + urllib.parse.quote(username) + '&secretkey=' + urllib.parse.quote(password) + "&ajax=1")
+        self.logging(res)
+        LOG.debug("logincheck res : %s", res.content)
+        if res.content.decode('ascii')[:1] == '1':
+            self.update_cookie()
+            self._logged = True
+            self._login_generation += 1
+            if await self._check_license(vdom):
+                return True
+        self._logged = False
+        raise NotLogged
+
+    async def _relogin(self, generation):
+        # login again after a 401/403, once for all the tasks which got it
+        async with self._relogin_lock:
+            if self._login_generation != generation:
+                # another task already did
+                return True
+            credentials = self._credentials
+            if credentials is None:
+                # token login
+                return False
+            LOG.info("session on %s expired, login again", self.host)
+            self._credentials = None
+            self._session.cookie_jar.clear()
+            self._headers.pop('X-CSRFTOKEN', None)
+            try:
+                await self._logincheck(*credentials)
+            except NotLogged:
+                LOG.warning("login again on %s failed", self.host)
+                return False
+            self._credentials = credentials
+            return True
+
+    async def tokenlogin(self, host, apitoken, verify=True, cert=None, timeout=12, vdom="global"):
+        """
+        Initialize the connection to the API with the related apitoken.
+        Further calls on the object will reuse the session initiated here.
+
+        :param host: ip or name (fqdn) can include a port like 10.40.40.40:8443
+        :param apitoken: Token obtained on the Fortigate or forced see official doc
+        :param verify: True verify validity of the Fortigate API ssl certificate, False ignore
+        :param cert: client certificate to authenticate
+        :param timeout: global timeout on the url session
+        :param vdom: default is root, can use global or name of the vdom to use
+        :return:
+        """
+        self._set_url_prefix(host)
+        self._new_session(verify, cert)
+        self._credentials = None
+        self._identity = self._token_identity(apitoken)
+        self._headers['Authorization'] = 'Bearer ' + apitoken
+        self._logged = True
+        self.timeout = timeout
+        resp_lic = await self._get('system', 'status', vdom=vdom)
+        LOG.debug("response system/status : %s", resp_lic)
+        try:
+            self._fortiversion = resp_lic['version']
+        except (TypeError, KeyError):
+            raise NotLogged
+        return True
+
+    async def logout(self):
+        """
+        Logout and close the aiohttp session.
+        """
+        url = self.url_prefix + '/logout'
+        res = await self._request('POST', url, endpoint=('logout', None, None, None, None))
+        self.logging(res)
+        self._credentials = None
+        await self.close()
+        # set license to Valid by default to ensure rechecked at login
+        self._license = "Valid"
+
+    async def close(self):
+        """
+        Close the aiohttp session without login out.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._headers = {}
+        self._logged = False
+
+    async def get_mkeyname(self, path, name, vdom=None):
+        schema = await self.schema(path, name, vdom=vdom)
+        try:
+            keyname = schema['mkey']
+        except KeyError:
+            LOG.warning("there is no mkey for %s/%s", path, name)
+            return False
+        return keyname
+
+    async def get_mkey(self, path, name, data, vdom=None):
+        keyname = await self.get_mkeyname(path, name, vdom)
+        if not keyname:
+            LOG.warning("there is no mkey for %s/%s", path, name)
+            return None
+        try:
+            return data[keyname]
+        except KeyError:
+            LOG.warning("mkey not set in the data")
+            return None
+
+    async def download(self, path, name, vdom=None, mkey=None, parameters=None):
+        """
+        Use the download call on the monitoring part of the API.
+
+        :return:
+            An AsyncResponse, file is in the content
+        """
+        url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
+        return await self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters)
+
+    async def download_stream(self, path, name, sink, vdom=None, mkey=None, parameters=None, chunk_size=65536,
+                              compression=None, checksum='sha256', progress=None, resume=False, cancel=None):
+        """
+        Coroutine version of FortiOSAPI.download_stream, the chunks are read
+        without blocking the event loop and written to sink as they come.
+
+        :param cancel: threading.Event or asyncio.Event stopping the download when set
+        :return:
+            dict bytes, written, checksum, complete and http_status, raise APIError if the call failed
+        """
+        writer = _DownloadWriter(path, name, sink, chunk_size, compression, checksum, progress, resume, cancel)
+        url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
+        res = await self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters,
+                                  headers=writer.headers, stream=True)
+        try:
+            if res.status_code not in (200, 206):
+                await res.read()
+                raise APIError(self.formatresponse(res, vdom=vdom))
+            writer.open(res.status_code, res.headers.get('Content-Length'))
+            async for chunk in res.iter_chunked(chunk_size):
+                if not writer.write(chunk):
+                    return writer.finish(False)
+            return writer.finish(True)
+        finally:
+            res.close()
+            writer.close()
+
+    async def upload(self, path, name, vdom=None, mkey=None,
+                     parameters=None, data=None, files=None):
+        """
+        Upload a file (refer to the monitoring part), used for license, config, certificates etc.. uploads.
+        files is the same dict as for requests: {field: fileobj or (filename, fileobj[, content_type])}
+        and data a dict of form fields, or a MultipartStream (without files) streamed for big files.
+
+        :return:
+            An AsyncResponse
+        """
+        if isinstance(data, MultipartStream) and files:
+            raise TypeError("upload takes files or a MultipartStream as data, not both")
+        if data is not None and not isinstance(data, (dict, MultipartStream)):
+            raise TypeError("upload data must be a dict of form fields or a MultipartStream")
+        url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
+        if isinstance(data, MultipartStream):
+            return await self._request('POST', url, endpoint=('monitor', path, name, mkey, vdom),
+                                       params=parameters, data=_multipart_body(data),
+                                       headers={'Content-Type': data.content_type,
+                                                'Content-Length': str(len(data))})
+        form = aiohttp.FormData()
+        for key, value in (data or {}).items():
+            form.add_field(key, str(value))
+        for field, value in (files or {}).items():
+            if isinstance(value, (tuple, list)):
+                form.add_field(field, value[1], filename=value[0],
+                               content_type=value[2] if len(value) > 2 else None)
+            else:
+                form.add_field(field, value)
+        return await self._request('POST', url, endpoint=('monitor', path, name, mkey, vdom),
+                                   params=parameters, data=form)
+
+    async def get(self, path, name, vdom=None, mkey=None, parameters=None):
+        """
+        Execute a GET on the cmdb (i.e. configuration part) of the Fortios API
+
+        :return:
+            A formatted json with the last response from the API, values are in return['results']
+        """
+        if self.response_cache is None:
+            return await self._get(path, name, vdom, mkey, parameters)
+        return await self._cached(self._cache_key('cmdb', path, name, vdom, mkey, parameters),
+                                  lambda: self._get(path, name, vdom, mkey, parameters))
+
+    async def _get(self, path, name, vdom=None, mkey=None, parameters=None):
+        url = self.cmdb_url(path, name, vdom, mkey=mkey)
+        res = await self._request('GET', url, endpoint=('cmdb', path, name, mkey, vdom), params=parameters)
+        return self.formatresponse(res, vdom=vdom)
+
+    async def monitor(self, path, name, vdom=None, mkey=None, parameters=None):
+        """
+        Execute a GET on the montioring part of the Fortios API
+
+        :return:
+            A formatted json with the last response from the API, values are in return['results']
+        """
+        if self.response_cache is None:
+            return await self._monitor(path, name, vdom, mkey, parameters)
+        return await self._cached(
+            self._cache_key('monitor', path, name, vdom, mkey, parameters),
+            lambda: self._monitor(path, name, vdom, mkey, parameters))
+
+    async def _monitor(self, path, name, vdom=None, mkey=None, parameters=None):
+        url = self.mon_url(path, name, vdom, mkey)
+        res = await self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters)
+        return self.formatresponse(res, vdom=vdom)
+
+    async def _cached(self, key, loader):
+        # ResponseCache.fetch for the event loop: the identical requests in
+        # flight on this object wait for the first one instead of a thread
+        flight = self._flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        result, generation = self.response_cache.lookup(key)
+        if generation is None:
+            return result
+        flight = self._flights[key] = asyncio.ensure_future(loader())
+        try:
+            result = await asyncio.shield(flight)
+        finally:
+            del self._flights[key]
+        self.response_cache.store(key, result, generation)
+        return result
+
+    def iter_table(self, path, name, vdom=None, parameters=None, page_size=1000, prefetch=True):
+        """
+        Async iterator (async for) on the entries of a cmdb table, see FortiOSAPI.iter_table
+
+        :return:
+            an async iterator of the table entries, raise APIError if a page fails
+        """
+        return _AsyncPages(lambda params: self._get(path, name, vdom=vdom, parameters=params),
+                           parameters, page_size, prefetch)
+
+    def iter_monitor(self, path, name, vdom=None, mkey=None, parameters=None, page_size=1000, prefetch=True):
+        """
+        Async iterator (async for) on the results of a monitor call, see FortiOSAPI.iter_monitor
+
+        :return:
+            an async iterator of the monitor results, raise APIError if a page fails
+        """
+        return _AsyncPages(lambda params: self._monitor(path, name, vdom=vdom, mkey=mkey, parameters=params),
+                           parameters, page_size, prefetch)
+
+    async def schema(self, path, name, vdom=None):
+        cacheable = self.schema_cache is not None and self._fortiversion != _VERSION_UNSET
+        if cacheable:
+            schema = self.schema_cache.get(self._fortiversion, path, name, vdom=vdom)
+            if schema is not None:
+                return schema
+        if vdom is None:
+            url = self.cmdb_url(path, name) + "?action=schema"
+        else:
+            url = self.cmdb_url(path, name, vdom=vdom) + "&action=schema"
+        res = await self._request('GET', url, endpoint=('schema', path, name, None, vdom))
+        if res.status_code == 200:
+            if vdom == "global":
+                schema = res.json()[0]['results']
+            else:
+                schema = res.json()['results']
+            if cacheable:
+                self.schema_cache.put(self._fortiversion, path, name, schema, vdom=vdom)
+            return schema
+        else:
+            return res.json()
+
+    async def cmdb_schemas(self, vdom=None):
+        """
+        Schemas of all the cmdb tables and settings in one call, see FortiOSAPI.cmdb_schemas
+        """
+        url_postfix = '/api/v2/cmdb/'
+        if vdom is not None:
+            url_postfix += '?vdom=' + vdom + "&action=schema"
+        else:
+            url_postfix += "?action=schema"
+        res = await self._request('GET', self.url_prefix + url_postfix,
+                                  endpoint=('schema', None, None, None, vdom))
+        self.logging(res)
+        return [keys for keys in res.json()['results'] if "__tree__" not in keys['path']]
+
+    async def get_name_path_dict(self, vdom=None):
+        return [keys['path'] + " " + keys['name'] for keys in await self.cmdb_schemas(vdom)]
+
+    async def post(self, path, name, data, vdom=None,
+                   mkey=None, parameters=None):
+        """
+        Execute a REST POST on the API. It will fail if the targeted object already exist.
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        if mkey:
+            mkeyname = await self.get_mkeyname(path, name, vdom)
+            data[mkeyname] = mkey
+        url = self.cmdb_url(path, name, vdom, mkey=None)
+        res = await self._request('POST', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                                  params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
+        r = self.formatresponse(res, vdom=vdom)
+        if not self._index_posted(path, name, vdom, mkey, r):
+            self._index_posted(path, name, vdom, await self.get_mkey(path, name, data, vdom=vdom), r)
+        return r
+
+    async def execute(self, path, name, data, vdom=None,
+                      mkey=None, parameters=None):
+        """
+        Execute is an action done on a running fortigate (post on the monitor part of the API)
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        url = self.mon_url(path, name, vdom, mkey=mkey)
+        res = await self._request('POST', url, endpoint=('monitor', path, name, mkey, vdom), payload=data,
+                                  params=parameters, data=json.dumps(data))
+        return self.formatresponse(res, vdom=vdom)
+
+    async def put(self, path, name, vdom=None,
+                  mkey=None, parameters=None, data=None):
+        """
+        Execute a REST PUT on the specified object
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        if not mkey:
+            mkey = await self.get_mkey(path, name, data, vdom=vdom)
+        url = self.cmdb_url(path, name, vdom, mkey)
+        res = await self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                                  params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
+        return self.formatresponse(res, vdom=vdom)
+
+    async def move(self, path, name, vdom=None, mkey=None,
+                   where=None, reference_key=None, parameters=None):
+        """
+        Move an object in a cmdb table (firewall/policies for example).
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        url = self.cmdb_url(path, name, vdom, mkey)
+        parameters = dict(parameters or {})
+        parameters['action'] = 'move'
+        parameters[where] = str(reference_key)
+        res = await self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), params=parameters)
+        self._invalidate_reads(path, name)
+        return self.formatresponse(res, vdom=vdom)
+
+    async def delete(self, path, name, vdom=None,
+                     mkey=None, parameters=None, data=None):
+        """
+        Delete a pointed object in the cmdb.
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        if not mkey:
+            mkey = await self.get_mkey(path, name, data, vdom=vdom)
+        url = self.cmdb_url(path, name, vdom, mkey)
+        res = await self._request('DELETE', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                                  params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
+        r = self.formatresponse(res, vdom=vdom)
+        self._index_deleted(path, name, vdom, mkey, r)
+        return r
+
+    async def set(self, path, name, data, mkey=None, vdom=None, parameters=None):
+        """
+        Try a PUT and if the object does not exist do a POST.
+
+        :return:
+            A formatted json with the last response from the API
+        """
+        if not mkey:
+            mkey = await self.get_mkey(path, name, data, vdom=vdom)
+        if self._use_index and mkey is not None and self._not_indexed(path, name, vdom, mkey,
+                                                                      await self._table_mkeys(path, name, vdom)):
+            r = await self.post(path, name, data, vdom, mkey, parameters=parameters)
+            if not self._stale_index(path, name, vdom, mkey, r):
+                return r
+        url = self.cmdb_url(path, name, vdom, mkey)
+        res = await self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                                  params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
+        r = self.formatresponse(res, vdom=vdom)
+        if self._missing(r):
+            LOG.warning("Try to put on %s failed doing a post", url)
+            return await self.post(path, name, data, vdom, mkey)
+        return r
+
+    async def _table_mkeys(self, path, name, vdom):
+        # see FortiOSAPI._table_mkeys
+        key = (path, name, vdom)
+        if key in self._mkey_index:
+            return self._mkey_index[key]
+        mkeyname = await self.get_mkeyname(path, name, vdom)
+        if not mkeyname:
+            return None
+        resp = await self.get(path, name, vdom=vdom, parameters={'format': mkeyname})
+        return self._index_table(key, mkeyname, resp)
+
+    async def _run_many(self, func, items, keyof, concurrency):
+        # run the coroutine func on each item with at most concurrency calls
+        # in flight and at most 2 * concurrency items read from the iterable
+        summary = {'success': 0, 'error': 0, 'results': []}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def safe(item):
+            async with semaphore:
+                try:
+                    return await func(item)
+                except Exception as e:
+                    LOG.warning("bulk call failed for %s: %s", keyof(item), e)
+                    return self._failure(e)
+
+        pending = deque()
+        try:
+            for item in items:
+                pending.append((item, asyncio.ensure_future(safe(item))))
+                if len(pending) >= 2 * concurrency:
+                    item, task = pending.popleft()
+                    self._collect(summary, keyof(item), await task)
+            while pending:
+                item, task = pending.popleft()
+                self._collect(summary, keyof(item), await task)
+        finally:
+            for item, task in pending:
+                task.cancel()
+        return summary
+
+    async def set_many(self, path, name, objects, vdom=None, parameters=None, concurrency=8):
+        """
+        Coroutine version of FortiOSAPI.set_many, concurrency requests in flight as tasks
+
+        :return:
+            a summary {'success': n, 'error': n, 'results': [{'mkey', 'status', 'http_status'(, 'error', 'response')}]}
+            results are in the objects order
+        """
+        mkeyname = self._bulk_mkeyname(path, name, await self.get_mkeyname(path, name, vdom), 'set_many')
+
+        if self._use_index:
+            # read once before the tasks start
+            await self._table_mkeys(path, name, vdom)
+
+        async def setone(data):
+            return await self.set(path, name, data, mkey=data.get(mkeyname), vdom=vdom, parameters=parameters)
+
+        return await self._run_many(setone, objects, lambda data: data.get(mkeyname), concurrency)
+
+    async def delete_many(self, path, name, objects, vdom=None, parameters=None, concurrency=8,
+                          reference_index=None):
+        """
+        Coroutine version of FortiOSAPI.delete_many, concurrency requests in flight as tasks
+
+        :return:
+            a summary as returned by set_many
+        """
+        mkeyname = self._bulk_mkeyname(path, name, await self.get_mkeyname(path, name, vdom), 'delete_many')
+
+        def keyof(item):
+            return self._delete_key(mkeyname, item)
+
+        blocked = {}
+
+        async def deleteone(item):
+            return self._blocked(blocked, keyof(item)) or \
+                await self.delete(path, name, vdom=vdom, mkey=keyof(item), parameters=parameters)
+
+        if reference_index is None:
+            return await self._run_many(deleteone, objects, keyof, concurrency)
+
+        objects = list(objects)
+        summary = {'success': 0, 'error': 0, 'results': [None] * len(objects)}
+        for indexes in self._delete_levels(path, name, vdom, objects, keyof, reference_index, blocked):
+            self._merge(summary, indexes, await self._run_many(deleteone, [objects[i] for i in indexes], keyof,
+                                                               concurrency))
+        return summary
+
+    async def _post_chunk(self, path, name, mkeyname, chunk, vdom, parameters):
+        # see FortiOSAPI._post_chunk
+        if len(chunk) == 1:
+            try:
+                return [await self.post(path, name, chunk[0], vdom=vdom, parameters=parameters)]
+            except Exception as e:
+                LOG.warning("bulk call failed for %s: %s", chunk[0].get(mkeyname), e)
+                return [self._failure(e)]
+        url = self.cmdb_url(path, name, vdom)
+        try:
+            res = await self._request('POST', url, endpoint=('cmdb', path, name, None, vdom), payload=chunk,
+                                      params=parameters, data=json.dumps(chunk))
+            r = self.formatresponse(res, vdom=vdom)
+        except Exception as e:
+            LOG.warning("POST of %d objects failed: %s", len(chunk), e)
+            r = self._failure(e)
+        finally:
+            self._invalidate_reads(path, name)
+        responses, halves = self._chunk_outcome(path, name, mkeyname, chunk, vdom, r)
+        if halves is None:
+            return responses
+        return (await self._post_chunk(path, name, mkeyname, halves[0], vdom, parameters) +
+                await self._post_chunk(path, name, mkeyname, halves[1], vdom, parameters))
+
+    async def post_batch(self, path, name, objects, vdom=None, parameters=None, chunk_size=100, concurrency=8):
+        """
+        Coroutine version of FortiOSAPI.post_batch
+
+        :return:
+            a summary as returned by set_many, results are in the objects order
+        """
+        mkeyname = self._bulk_mkeyname(path, name, await self.get_mkeyname(path, name, vdom), 'post_batch')
+
+        if chunk_size <= 1 or not self._array_post_supported():
+            LOG.debug("no json array POST on %s, one post per object", self._fortiversion)
+
+            async def postone(data):
+                return await self.post(path, name, data, vdom=vdom, parameters=parameters)
+
+            return await self._run_many(postone, objects, lambda data: data.get(mkeyname), concurrency)
+
+        summary = {'success': 0, 'error': 0, 'results': []}
+        for chunk in self._chunks(objects, chunk_size):
+            responses = await self._post_chunk(path, name, mkeyname, chunk, vdom, parameters)
+            for data, res in zip(chunk, responses):
+                self._collect(summary, data.get(mkeyname), res)
+        return summary
+
+    async def license(self, vdom="root"):
+        """
+        license check, see FortiOSAPI.license
+        """
+        resp = await self.monitor('license', 'status', vdom=vdom)
+        if resp['status'] == 'success':
+            return resp
+        postresp = await self.execute('system', 'fortiguard/update', None, vdom=vdom)
+        if postresp['status'] == 'success':
+            await asyncio.sleep(17)
+            return await self.monitor('license', 'status', vdom=vdom)
+
+    async def planoverlayconfig(self, yamltree, vdom=None):
+        """
+        Coroutine version of FortiOSAPI.planoverlayconfig, the touched tables are read concurrently
+
+        :return:
+            an OverlayPlan listing the objects to create, update or skip
+        """
+        settings, tables = self.splitoverlay(copy.deepcopy(yamltree))
+        reads = overlay.overlay_reads(settings, tables)
+
+        async def read(name, path, is_table):
+            mkeyname = await self.get_mkeyname(name, path, vdom) if is_table else None
+            return mkeyname, await self.get(name, path, vdom=vdom)
+
+        done = await asyncio.gather(*[read(*r) for r in reads])
+        answers = dict(((name, path), answer) for (name, path, _), (_, answer) in zip(reads, done))
+        mkeynames = dict(((name, path), mkeyname) for (name, path, is_table), (mkeyname, _) in zip(reads, done)
+                         if is_table)
+        return overlay.build_plan(settings, tables, answers, mkeynames)
+
+    async def _apply_overlay_plan(self, plan, vdom, concurrency):
+        # overlay.apply_overlay_plan with tasks, at most concurrency pushes in flight
+        lock = threading.Lock()
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def chain(actions):
+            for action in actions:
+                async with semaphore:
+                    res = await overlay.push(self, action, vdom)
+                if not overlay.record(plan, action, res, lock):
+                    return False
+            return True
+
+        settings, entries, bytable = overlay.plan_parts(plan)
+        if not await chain(settings):
+            return plan
+        if concurrency <= 1:
+            await chain(entries)
+            return plan
+
+        tables = list(bytable)
+        schemas = await asyncio.gather(*[self.schema(name, path, vdom=vdom) for name, path in tables])
+        dependencies = overlay.schema_dependencies(tables, dict(zip(tables, schemas)))
+        levels = overlay.dependency_levels(dependencies, tables)
+        LOG.debug("overlay levels %s", levels)
+        for level in levels:
+            chains = overlay.level_chains(level, bytable, dependencies)
+            if not all(await asyncio.gather(*[chain(actions) for actions in chains])):
+                # next levels may reference what failed
+                break
+        return plan
+
+    async def setoverlayconfig(self, yamltree, vdom=None, diff=False, concurrency=1):
+        """
+        Coroutine version of FortiOSAPI.setoverlayconfig, with concurrency the
+        entries of independent tables are pushed as tasks.
+
+        :param yamltree: a yaml formatted string of the differents part of CMDB to be changed
+        :param vdom: (optionnal) default is root, can use vdom=global to swtich to global settings.
+        :param diff: if True only the objects differing from the running configuration are pushed
+        :param concurrency: max number of sets in flight, tables pushed in the order of their references
+        :return:
+            True if all the sets succeeded, with diff the OverlayPlan applied
+        """
+        if diff:
+            plan = await self.planoverlayconfig(yamltree, vdom=vdom)
+            return await self._apply_overlay_plan(plan, vdom, concurrency)
+        if concurrency > 1:
+            plan = overlay.set_plan(self, yamltree)
+            await self._apply_overlay_plan(plan, vdom, concurrency)
+            return plan.failed == 0
+
+        restree = False
+        for group in self._overlay_groups(yamltree):
+            for name, path, mkey, data in group:
+                res = await self.set(name, path, mkey=mkey, data=data, vdom=vdom)
+                restree = res['status'] == "success"
+                if not restree:
+                    break
+        return restree
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# cache.py holds the caches used by FortiOSAPI to avoid repeating
+# identical calls to the Fortigate.
+#
+###################################################################
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import urllib.parse as urlencoding
+except ImportError:
+    import urllib as urlencoding
+
+LOG = logging.getLogger('fortiosapi')
+
+
+class LRUCache(object):
+    """
+    Thread safe in memory LRU mapping with hit/miss counters.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while self.maxsize and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SchemaCache(object):
+    """
+    Cache of the cmdb schemas (and so of the mkey names) keyed by
+    (fortios version, path, name, vdom).
+
+    A schema only changes with the firmware so a single SchemaCache can be
+    shared by all the FortiOSAPI objects talking to devices running the same
+    build. With a directory the schemas are also stored on disk and reused
+    by other processes.
+
+    :param maxsize: max number of schemas kept in memory (0 for no limit)
+    :param directory: optionnal directory where schemas are persisted
+    """
+
+    def __init__(self, maxsize=1024, directory=None):
+        self._memory = LRUCache(maxsize)
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def _quote(value):
+        return urlencoding.quote(str(value), safe='')
+
+    def _filename(self, key):
+        version, path, name, vdom = key
+        return os.path.join(self.directory, self._quote(version),
+                            "%s+%s+%s.json" % (self._quote(path), self._quote(name), self._quote(vdom)))
+
+    def _load(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _store(self, key, schema):
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # write in a temp file then rename so concurrent readers never see partial content
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(schema, fh)
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            LOG.warning("unable to store schema in %s", filename)
+
+    def get(self, version, path, name, vdom=None):
+        """
+        :return: the cached schema or None if unknown
+        """
+        key = (version, path, name, vdom)
+        schema = self._memory.get(key)
+        if schema is None and self.directory is not None:
+            schema = self._load(key)
+            if schema is not None:
+                self._memory.put(key, schema)
+                with self._lock:
+                    self.disk_hits += 1
+        with self._lock:
+            if schema is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return schema
+
+    def put(self, version, path, name, schema, vdom=None):
+        key = (version, path, name, vdom)
+        self._memory.put(key, schema)
+        if self.directory is not None:
+            self._store(key, schema)
+
+    def invalidate(self, version=None, path=None, name=None, vdom=None):
+        """
+        Remove the cached schemas matching all the given criterias,
+        from memory and disk. Without argument the whole cache is cleared.
+
+        :return: the number of schemas removed from memory
+        """
+        removed = 0
+        for key in self._memory.keys():
+            if ((version is None or key[0] == version) and
+                    (path is None or key[1] == path) and
+                    (name is None or key[2] == name) and
+                    (vdom is None or key[3] == vdom)):
+                self._memory.pop(key)
+                removed += 1
+        if self.directory is not None:
+            if version is None:
+                versions = os.listdir(self.directory)
+            else:
+                versions = [self._quote(version)]
+            for quotedversion in versions:
+                versiondir = os.path.join(self.directory, quotedversion)
+                if not os.path.isdir(versiondir):
+                    continue
+                for filename in os.listdir(versiondir):
+                    if not filename.endswith('.json'):
+                        continue
+                    fpath, fname, fvdom = [urlencoding.unquote(p) for p in filename[:-5].split('+')]
+                    if ((path is None or fpath == path) and
+                            (name is None or fname == name) and
+                            (vdom is None or fvdom == str(vdom))):
+                        os.remove(os.path.join(versiondir, filename))
+        return removed
+
+    def stats(self):
+        """
+        :return: a dict with the hits, misses, disk_hits and size of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'disk_hits': self.disk_hits, 'size': len(self._memory)}
+
+
+class _Flight(object):
+    # a request in progress, the other callers of the same key wait for it
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache(object):
+    """
+    Short lived cache of get/monitor responses shared by the callers of one
+    or many FortiOSAPI. Identical requests in flight are sent once and all
+    the callers get the response (single flight). Writes done by a FortiOSAPI
+    (post, put, set, delete, move) drop the cached responses of the table.
+
+    Only successful responses are kept and they are shared by the callers,
+    do not modify them.
+
+    :param ttl: default seconds a response is kept, 0 to only coalesce in flight requests
+    :param ttls: dict of endpoint: ttl overriding the default, an endpoint is kind
+                 or kind/path or kind/path/name like monitor/system/resource/usage,
+                 the longest matching one is used
+    :param maxsize: max number of responses kept (least recently used are dropped)
+    """
+
+    def __init__(self, ttl=1.0, ttls=None, maxsize=1024):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self._prefixes = sorted(self.ttls, key=len, reverse=True)
+        self._memory = LRUCache(maxsize)
+        self._flights = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def ttl_for(self, kind, path, name):
+        endpoint = "%s/%s/%s" % (kind, path, name)
+        for prefix in self._prefixes:
+            if endpoint == prefix or endpoint.startswith(prefix + '/'):
+                return self.ttls[prefix]
+        return self.ttl
+
+    @staticmethod
+    def key(host, kind, path, name, vdom=None, mkey=None, parameters=None, identity=None):
+        """
+        :param identity: user or token the request is done with, the Fortigate
+                         answers according to its profile so it is part of the key
+        """
+        if isinstance(parameters, dict):
+            parameters = json.dumps(parameters, sort_keys=True)
+        return (host, kind, path, name, vdom, None if mkey is None else str(mkey), parameters, identity)
+
+    def fetch(self, key, loader):
+        """
+        Return the cached response of key or the one of loader(),
+        called once for all the threads asking for key at the same time.
+
+        :param key: from ResponseCache.key()
+        :param loader: function doing the request and returning the formatted response
+        """
+        cached = self._memory.get(key)
+        if cached is not None and cached[0] > time.time():
+            with self._lock:
+                self.hits += 1
+            return cached[1]
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            result = flight.result = loader()
+            self.store(key, result, generation)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return result
+
+    def lookup(self, key):
+        """
+        For the callers which can not wait on a thread (asyncio): the cached
+        response of key and None, or None and the generation to give to
+        store() with the response of the request they do themselves.
+
+        :param key: from ResponseCache.key()
+        """
+        cached = self._memory.get(key)
+        with self._lock:
+            if cached is not None and cached[0] > time.time():
+                self.hits += 1
+                return cached[1], None
+            self.misses += 1
+            return None, self._generation
+
+    def store(self, key, result, generation):
+        """
+        Keep result for the ttl of its endpoint if it is a success and no write
+        happened since generation was read.
+        """
+        ttl = self.ttl_for(key[1], key[2], key[3])
+        if ttl > 0 and isinstance(result, dict) and result.get('status') == 'success':
+            with self._lock:
+                # a write during the request may have changed what it read
+                if generation == self._generation:
+                    self._memory.put(key, (time.time() + ttl, result))
+
+    def invalidate(self, kind=None, path=None, name=None, vdom=None, host=None):
+        """
+        Drop the cached responses matching all the given criterias, everything without argument.
+
+        :return: the number of responses removed
+        """
+        removed = 0
+        with self._lock:
+            self._generation += 1
+        for key in self._memory.keys():
+            if ((host is None or key[0] == host) and (kind is None or key[1] == kind) and
+                    (path is None or key[2] == path) and (name is None or key[3] == name) and
+                    (vdom is None or key[4] == vdom)):
+                if self._memory.pop(key) is not None:
+                    removed += 1
+        return removed
+
+    def stats(self):
+        """
+        :return: a dict with the hits, misses, coalesced (requests not sent
+                 as an identical one was in flight) and size of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'size': len(self._memory)}
+
+
+class SessionCache(object):
+    """
+    Login sessions (cookies, csrf token and firmware version) stored on
+    disk per host and user so that a new process reuses them instead of
+    logging in again. Files are only readable by their owner (0600),
+    passwords are never written.
+
+    :param directory: where sessions are stored, default ~/.cache/fortiosapi/sessions
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'fortiosapi', 'sessions')
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+    def _filename(self, host, username):
+        return os.path.join(self.directory, "%s+%s.json" % (urlencoding.quote(str(host), safe=''),
+                                                            urlencoding.quote(str(username), safe='')))
+
+    def load(self, host, username):
+        """
+        :return: the stored session dict (cookies, headers, version) or None
+        """
+        try:
+            with open(self._filename(host, username), 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, host, username, session):
+        filename = self._filename(host, username)
+        try:
+            # mkstemp creates the file with 0600
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(session, fh)
+            os.rename(tmpname, filename)
+        except (IOError, OSError):
+            LOG.warning("unable to store session in %s", filename)
+
+    def delete(self, host, username):
+        try:
+            os.remove(self._filename(host, username))
+        except OSError:
+            pass
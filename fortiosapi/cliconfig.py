@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# cliconfig.py reads FortiOS CLI config backups (config/edit/set/
+# next/end) as a tree indexed by vdom, path, name and mkey.
+#
+###################################################################
+
+import hashlib
+import io
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+import six
+
+LOG = logging.getLogger('fortiosapi')
+
+_ESCAPED = re.compile(br'\\.')
+
+
+def _open_quote(line):
+    # True when line (bytes) has a double quote not closed on the line
+    if b'\\' in line:
+        line = _ESCAPED.sub(b'', line)
+    return line.count(b'"') % 2 == 1
+
+
+def _tokens(text):
+    """
+    Split a CLI line in words, unquoting the quoted ones.
+    """
+    words = []
+    word = []
+    quote = None
+    quoted = False
+    i = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if quote is not None:
+            if c == '\\' and i + 1 < length:
+                i += 1
+                word.append(text[i])
+            elif c == quote:
+                quote = None
+            else:
+                word.append(c)
+        elif c in '"\'':
+            quote = c
+            quoted = True
+        elif c.isspace():
+            if word or quoted:
+                words.append(''.join(word))
+                word = []
+                quoted = False
+        else:
+            word.append(c)
+        i += 1
+    if word or quoted:
+        words.append(''.join(word))
+    return words
+
+
+def _edit_key(line):
+    # mkey of an edit line (bytes), most are a plain word or a simple quoted one
+    key = line[5:].strip()
+    if b'\\' not in key and b"'" not in key:
+        if key.startswith(b'"') and key.endswith(b'"') and key.count(b'"') == 2:
+            return key[1:-1].decode('utf-8', 'replace')
+        if b'"' not in key and b' ' not in key:
+            return key.decode('utf-8', 'replace')
+    words = _tokens(key.decode('utf-8', 'replace'))
+    return words[0] if words else ''
+
+
+def _logical_lines(data):
+    # lines of a block with the multi lines quoted values (certificates,
+    # comments) joined back, comments and blank lines dropped
+    pending = None
+    for line in data.splitlines():
+        if pending is not None:
+            pending += b'\n' + line
+            if not _open_quote(pending):
+                yield pending.decode('utf-8', 'replace')
+                pending = None
+            continue
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        if _open_quote(line):
+            pending = line
+            continue
+        yield line.decode('utf-8', 'replace')
+    if pending is not None:
+        yield pending.decode('utf-8', 'replace')
+
+
+def _parse_block(lines, closing):
+    """
+    Parse the lines up to closing ('end' or 'next') in a dict of the set
+    values (a string or a list of strings) and sub config blocks.
+    A block of edit entries gives an OrderedDict mkey: entry instead.
+    """
+    values = OrderedDict()
+    table = None
+    for line in lines:
+        words = _tokens(line)
+        if not words:
+            continue
+        command = words[0]
+        if command == closing:
+            break
+        if command == 'set' and len(words) > 1:
+            values[words[1]] = words[2] if len(words) == 3 else words[2:]
+        elif command == 'config' and len(words) > 1:
+            values[' '.join(words[1:])] = _parse_block(lines, 'end')
+        elif command == 'edit' and len(words) > 1:
+            if table is None:
+                table = OrderedDict()
+            table[words[1]] = _parse_block(lines, 'next')
+        elif command in ('end', 'next'):
+            # unbalanced block, stop there
+            break
+    return table if table is not None else values
+
+
+def _diff_values(old, new):
+    # field: (old, new) of two materialized entries or settings
+    fields = OrderedDict()
+    for key, value in new.items():
+        before = old.get(key)
+        if before != value:
+            fields[key] = (before, value)
+    for key, value in old.items():
+        if key not in new:
+            fields[key] = (value, None)
+    return fields
+
+
+class ConfigBlock(object):
+    """
+    A top level config block of a backup: a table (edit entries) or
+    settings. Only the position of the entries in the backup and their
+    digest are kept, an entry is parsed when accessed.
+    """
+
+    def __init__(self, config, vdom, path, name):
+        self.config = config
+        self.vdom = vdom
+        self.path = path
+        self.name = name
+        # (start, end) of the block in the backup, more than one if repeated
+        self.spans = []
+        # mkey: (start, end, digest) of the edit entries
+        self.entries = OrderedDict()
+        self.digest = None
+        self._hash = hashlib.sha1()
+
+    @property
+    def key(self):
+        return self.vdom, self.path, self.name
+
+    @property
+    def is_table(self):
+        return bool(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, mkey):
+        return six.text_type(mkey) in self.entries
+
+    def __getitem__(self, mkey):
+        start, end, digest = self.entries[six.text_type(mkey)]
+        lines = _logical_lines(self.config.read(start, end))
+        next(lines)  # the edit line
+        return _parse_block(lines, 'next')
+
+    def get(self, mkey, default=None):
+        if mkey not in self:
+            return default
+        return self[mkey]
+
+    def items(self):
+        """
+        Iterate on (mkey, entry) parsing the entries one at a time
+        """
+        for mkey in self.entries:
+            yield mkey, self[mkey]
+
+    def values(self):
+        """
+        :return: the dict of the settings (and sub blocks) of a settings block
+        """
+        values = OrderedDict()
+        for start, end in self.spans:
+            lines = _logical_lines(self.config.read(start, end))
+            next(lines)  # the config line
+            block = _parse_block(lines, 'end')
+            if isinstance(block, dict):
+                values.update(block)
+        return values
+
+    def __repr__(self):
+        return "ConfigBlock(%s %s/%s, %d entries)" % (self.vdom, self.path, self.name, len(self.entries))
+
+
+class ConfigDiff(object):
+    """
+    Differences between two backups. The keys are (vdom, path, name, mkey),
+    mkey is None for the settings blocks.
+
+    added and removed are lists of keys, changed is key: {field: (old, new)}
+    and reordered the (vdom, path, name) of the tables whose entries present
+    in both backups are not in the same order (firewall policies).
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = OrderedDict()
+        self.reordered = []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed or self.reordered)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "ConfigDiff(+%d -%d ~%d reordered %d)" % (len(self.added), len(self.removed),
+                                                          len(self.changed), len(self.reordered))
+
+
+class CLIConfig(object):
+    """
+    FortiOS CLI config backup read as a tree:
+    config[vdom, path, name] is the ConfigBlock of "config <path> <name>"
+    (vdom is None in a backup without vdoms, 'global' for config global)
+    and config[vdom, path, name][mkey] the entry parsed as a dict.
+
+    The backup is read once, line by line, keeping only the offsets and the
+    digest of the blocks and entries in memory: the entries are read again
+    and parsed when accessed, so big backups are indexed quickly with a
+    bounded memory and two backups are compared on their digests.
+
+    config = CLIConfig(fgt.download('system', 'config/backup', vdom='global',
+                                    parameters={'scope': 'global'}).content)
+    config['root', 'firewall', 'address']['all']['subnet']
+
+    :param source: the backup as bytes, a file name or a seekable binary file object
+    """
+
+    def __init__(self, source):
+        self._lock = threading.Lock()
+        self._filename = None
+        if isinstance(source, six.binary_type):
+            self._file = io.BytesIO(source)
+        elif isinstance(source, six.string_types):
+            self._filename = source
+            self._file = None
+        else:
+            self._file = source
+        self.header = {}
+        self.blocks = OrderedDict()
+        if self._filename is not None:
+            with open(self._filename, 'rb') as f:
+                self._index(f)
+        else:
+            self._file.seek(0)
+            self._index(self._file)
+
+    def read(self, start, end):
+        """
+        :return: the bytes of the backup between start and end
+        """
+        if self._filename is not None:
+            with open(self._filename, 'rb') as f:
+                f.seek(start)
+                return f.read(end - start)
+        with self._lock:
+            self._file.seek(start)
+            return self._file.read(end - start)
+
+    def _parse_header(self, line):
+        # #config-version=FGVM64-6.04-FW-build1575-190418:opmode=0:vdom=1:user=admin
+        for part in line.lstrip(b'#').decode('utf-8', 'replace').strip().split(':'):
+            key, _, value = part.partition('=')
+            self.header[key] = value
+        version = self.header.get('config-version', '').split('-')
+        if len(version) > 2:
+            self.header['model'] = version[0]
+            self.header['version'] = version[1]
+        for part in version:
+            if part.startswith('build'):
+                self.header['build'] = part[5:]
+
+    def _block(self, vdom, words):
+        path = words[0].decode('utf-8', 'replace')
+        name = '/'.join(w.decode('utf-8', 'replace') for w in words[1:])
+        key = (vdom, path, name)
+        block = self.blocks.get(key)
+        if block is None:
+            block = self.blocks[key] = ConfigBlock(self, vdom, path, name)
+        return block
+
+    def _index(self, f):
+        # states: where are we in the config vdom / config global wrappers
+        wrapper = []
+        vdom = None
+        block = None
+        start = 0
+        level = 0
+        entry = None
+        offset = 0
+        quoted = False
+        for raw in f:
+            position = offset
+            offset += len(raw)
+            line = raw.strip()
+            if quoted:
+                # inside a multi lines value
+                quoted = _open_quote(b'"' + line)
+                (entry[3] if entry is not None else block._hash).update(line + b'\n')
+                continue
+            if not line:
+                continue
+            if line.startswith(b'#'):
+                if position == 0:
+                    self._parse_header(line)
+                continue
+            words = line.split(None, 2)
+            command = words[0]
+            if block is None:
+                if command == b'config' and len(words) > 1:
+                    if not wrapper and words[1:] == [b'vdom']:
+                        wrapper.append('vdom')
+                    elif not wrapper and words[1:] == [b'global']:
+                        wrapper.append('global')
+                        vdom = 'global'
+                    else:
+                        block = self._block(vdom, line.split()[1:])
+                        start = position
+                        level = 0
+                elif command == b'edit' and wrapper == ['vdom']:
+                    wrapper.append('edit')
+                    vdom = _edit_key(line)
+                elif command in (b'end', b'next') and wrapper:
+                    wrapper.pop()
+                    vdom = 'global' if wrapper == ['global'] else None
+                continue
+            if command == b'end' and level == 0:
+                block.spans.append((start, offset))
+                block = None
+                continue
+            if command == b'edit' and level == 0:
+                entry = [_edit_key(line), position, None, hashlib.sha1()]
+                level += 1
+                continue
+            if command == b'next' and level == 1 and entry is not None:
+                digest = entry[3].digest()
+                block.entries[entry[0]] = (entry[1], offset, digest)
+                block._hash.update(entry[0].encode('utf-8') + b'\0' + digest)
+                entry = None
+                level = 0
+                continue
+            if command in (b'config', b'edit'):
+                level += 1
+            elif command in (b'end', b'next'):
+                level -= 1
+            if command == b'set' and _open_quote(line):
+                quoted = True
+            (entry[3] if entry is not None else block._hash).update(line + b'\n')
+        for block in self.blocks.values():
+            block.digest = block._hash.digest()
+            block._hash = None
+        LOG.debug("indexed %d config blocks in %d bytes", len(self.blocks), offset)
+
+    @property
+    def vdoms(self):
+        """
+        :return: the vdoms having config blocks (None for a backup without vdoms)
+        """
+        return sorted(set(key[0] for key in self.blocks), key=lambda v: (v is not None, v))
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def __getitem__(self, key):
+        return self.blocks[key]
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, path, name, mkey=None, vdom=None):
+        """
+        Like FortiOSAPI.get on the backup.
+
+        :return: the entry mkey, the list of the entries of a table, the
+                 settings dict or None when not in the backup
+        """
+        block = self.blocks.get((vdom, path, name))
+        if block is None:
+            return None
+        if mkey is not None:
+            return block.get(mkey)
+        if block.is_table:
+            return [entry for mkey, entry in block.items()]
+        return block.values()
+
+    def diff(self, other):
+        """
+        Compare with a newer backup, see diff_configs.
+        """
+        return diff_configs(self, other)
+
+
+def diff_configs(old, new):
+    """
+    Compare two CLIConfig. Blocks and entries with the same digest are
+    skipped without being parsed, only the changed entries are parsed to
+    give the changed fields.
+
+    :return: a ConfigDiff
+    """
+    result = ConfigDiff()
+    for key, block in old.blocks.items():
+        if key not in new.blocks:
+            if block.is_table:
+                result.removed.extend(key + (mkey,) for mkey in block.entries)
+            else:
+                result.removed.append(key + (None,))
+    for key, block in new.blocks.items():
+        before = old.blocks.get(key)
+        if before is None:
+            if block.is_table:
+                result.added.extend(key + (mkey,) for mkey in block.entries)
+            else:
+                result.added.append(key + (None,))
+            continue
+        if before.digest == block.digest:
+            continue
+        if not block.is_table and not before.is_table:
+            fields = _diff_values(before.values(), block.values())
+            if fields:
+                result.changed[key + (None,)] = fields
+            continue
+        for mkey in before.entries:
+            if mkey not in block.entries:
+                result.removed.append(key + (mkey,))
+        common = []
+        for mkey, (start, end, digest) in block.entries.items():
+            previous = before.entries.get(mkey)
+            if previous is None:
+                result.added.append(key + (mkey,))
+                continue
+            common.append(mkey)
+            if previous[2] != digest:
+                fields = _diff_values(before[mkey], block[mkey])
+                if fields:
+                    result.changed[key + (mkey,)] = fields
+        if common != [mkey for mkey in before.entries if mkey in block.entries]:
+            result.reordered.append(key)
+    return result
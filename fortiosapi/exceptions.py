@@ -17,4 +17,13 @@ class NotLogged(Exception):
     Not logged on a session, please login.
     '''
     def __init__(self):
-        Exception.__init__(self,"Not logged on a session, please login.")
\ No newline at end of file
+        Exception.__init__(self,"Not logged on a session, please login.")
+
+
+class APIError(Exception):
+    '''
+    Error returned by the API where a result was expected.
+    '''
+    def __init__(self, response):
+        self.response = response
+        Exception.__init__(self, "API error: %s" % (response,))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# fleet.py runs the same FortiOSAPI call on many Fortigates
+# concurrently and streams the results as they come.
+#
+###################################################################
+
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .cache import SchemaCache
+from .fortiosapi import FortiOSAPI
+
+LOG = logging.getLogger('fortiosapi')
+
+
+def latency_summary(latencies):
+    """
+    :param latencies: list of durations in seconds
+    :return: a dict with count, min, max, avg, p50, p90 and p99 of the latencies
+    """
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def percentile(p):
+        return ordered[min(count - 1, int(round(p / 100.0 * (count - 1))))]
+
+    return {'count': count,
+            'min': ordered[0],
+            'max': ordered[-1],
+            'avg': sum(ordered) / count,
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99)}
+
+
+class FleetResult(object):
+    """
+    Result of a call on one Fortigate of the fleet.
+    result is the value returned by the call, error the exception raised if any
+    and elapsed the duration of the call in seconds.
+    """
+
+    def __init__(self, host, result=None, error=None, elapsed=0.0):
+        self.host = host
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "FleetResult(%s, ok, %.3fs)" % (self.host, self.elapsed)
+        return "FleetResult(%s, error=%r, %.3fs)" % (self.host, self.error, self.elapsed)
+
+
+class FortiOSFleet(object):
+    """
+    Pool of FortiOSAPI objects, one per Fortigate, to run a call on all or a
+    subset of the devices with a bounded number of calls in flight.
+    The devices share a SchemaCache as it is keyed by firmware version.
+
+    :param concurrency: max number of calls running at the same time
+    :param schema_cache: SchemaCache shared by all the clients
+    :param pool: FortiOSAPI.connection_pool() shared by all the clients, by default
+                 each client has its own
+    :param policy: RequestPolicy shared by all the clients (rate limit is per host)
+    """
+
+    def __init__(self, concurrency=32, schema_cache=None, pool=None, policy=None):
+        self.concurrency = concurrency
+        self.pool = pool
+        self.policy = policy
+        if schema_cache is None:
+            schema_cache = SchemaCache()
+        self.schema_cache = schema_cache
+        self.clients = OrderedDict()
+        self._credentials = {}
+        self.last_run = {'count': 0}
+
+    def add(self, host, username=None, password=None, apitoken=None,
+            https=True, verify=True, cert=None, timeout=12, vdom="global"):
+        """
+        Register a Fortigate, login is done by login().
+        Either username/password or apitoken must be given.
+
+        :param host: ip or name (fqdn) can include a port like 10.40.40.40:8443
+        :return: the FortiOSAPI object of this host
+        """
+        if apitoken is None and username is None:
+            raise ValueError("username/password or apitoken needed for %s" % host)
+        client = FortiOSAPI(schema_cache=self.schema_cache, pool=self.pool, policy=self.policy)
+        client.https('on' if https else 'off')
+        self.clients[host] = client
+        self._credentials[host] = dict(username=username, password=password, apitoken=apitoken,
+                                       verify=verify, cert=cert, timeout=timeout, vdom=vdom)
+        return client
+
+    def remove(self, host):
+        self.clients.pop(host, None)
+        self._credentials.pop(host, None)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __getitem__(self, host):
+        return self.clients[host]
+
+    def _login(self, host, client):
+        cred = self._credentials[host]
+        if cred['apitoken'] is not None:
+            return client.tokenlogin(host, cred['apitoken'], verify=cred['verify'], cert=cred['cert'],
+                                     timeout=cred['timeout'], vdom=cred['vdom'])
+        return client.login(host, cred['username'], cred['password'], verify=cred['verify'],
+                            cert=cred['cert'], timeout=cred['timeout'], vdom=cred['vdom'])
+
+    def login(self, hosts=None):
+        """
+        Login concurrently on the Fortigates.
+
+        :param hosts: optionnal list of hosts, all by default
+        :return: the list of FleetResult, failed logins have the error set
+        """
+        return list(self._call(self._login, hosts))
+
+    def logout(self, hosts=None):
+        """
+        Logout concurrently from the logged Fortigates.
+
+        :return: the list of FleetResult
+        """
+        return list(self.call(lambda client: client.logout(),
+                              hosts=[h for h in self._select(hosts) if self.clients[h]._logged]))
+
+    def _select(self, hosts):
+        if hosts is None:
+            return list(self.clients)
+        return [host for host in hosts if host in self.clients]
+
+    def call(self, func, hosts=None):
+        """
+        Run func(client) on each selected Fortigate with at most concurrency calls in flight.
+        Exceptions are not raised but returned in the FleetResult error.
+
+        :param func: callable receiving the FortiOSAPI object of the host
+        :param hosts: optionnal list of hosts, all by default
+        :return: a generator of FleetResult in completion order
+        """
+        return self._call(lambda host, client: func(client), hosts)
+
+    def _call(self, func, hosts):
+        selected = self._select(hosts)
+
+        def timed(host):
+            start = time.time()
+            try:
+                return FleetResult(host, result=func(host, self.clients[host]),
+                                   elapsed=time.time() - start)
+            except Exception as e:
+                LOG.warning("fleet call failed on %s: %s", host, e)
+                return FleetResult(host, error=e, elapsed=time.time() - start)
+
+        latencies = []
+        errors = 0
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(selected) or 1)))
+        futures = [executor.submit(timed, host) for host in selected]
+        try:
+            for future in as_completed(futures):
+                fleetresult = future.result()
+                latencies.append(fleetresult.elapsed)
+                if not fleetresult.ok:
+                    errors += 1
+                yield fleetresult
+        finally:
+            # if the caller stops iterating the calls not started are dropped
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.last_run = latency_summary(latencies)
+            self.last_run['errors'] = errors
+            self.last_run['wall'] = time.time() - start
+
+    def run(self, method, *args, **kwargs):
+        """
+        Run a FortiOSAPI method on the Fortigates, for example:
+        fleet.run('monitor', 'system', 'status')
+
+        :param method: name of the FortiOSAPI method to call
+        :param hosts: (keyword only) optionnal list of hosts, all by default
+        :return: a generator of FleetResult in completion order
+        """
+        hosts = kwargs.pop('hosts', None)
+        return self.call(lambda client: getattr(client, method)(*args, **kwargs), hosts=hosts)
+
+    def run_all(self, method, *args, **kwargs):
+        """
+        Same as run but wait for all the calls.
+
+        :return: a dict host: FleetResult
+        """
+        return dict((r.host, r) for r in self.run(method, *args, **kwargs))
+
+    def stats(self):
+        """
+        :return: the latency summary (count, errors, wall, min, max, avg, p50, p90, p99) of the last run
+        """
+        return dict(self.last_run)
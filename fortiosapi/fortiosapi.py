@@ -26,18 +26,36 @@
 ###################################################################
 
 import copy
+import hashlib
+import itertools
 import json
 # Set default logging handler to avoid "No handler found" warnings.
 import logging
+import os
+import re
 import subprocess
+import threading
 import time
-from collections import OrderedDict
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import paramiko
 import requests
+import six
 import six.moves.urllib as urllib
 
-from .exceptions import (InvalidLicense, NotLogged)
+from . import overlay
+from .cache import SchemaCache
+from .exceptions import (APIError, InvalidLicense, NotLogged)
+from .metrics import (HOOK_EVENTS, RequestContext)
+from .multipart import MultipartStream
+from .policy import RequestPolicy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 try:
     import urllib.parse as urlencoding
@@ -60,18 +78,139 @@ logging.getLogger(__name__).addHandler(NullHandler())
 # create logger
 LOG = logging.getLogger('fortiosapi')
 
+_VERSION_UNSET = "Version is set when logged"
+
+
+def _compressor(compression):
+    # object with compress(bytes) and flush() like zlib ones
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard: pip install fortiosapi[zstd]")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("unknown compression %s, use gzip or zstd" % compression)
+
+
+class _DownloadWriter(object):
+    # writes the chunks of a download_stream to its sink (compression, checksum,
+    # progress, resume), the clients only read the chunks from the Fortigate
+
+    def __init__(self, path, name, sink, chunk_size, compression, checksum, progress, resume, cancel):
+        if resume and (compression or not isinstance(sink, six.string_types)):
+            raise ValueError("resume needs a file name sink without compression")
+        self.label = "%s/%s" % (path, name)
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.compressor = _compressor(compression)
+        self.digest = hashlib.new(checksum) if checksum else None
+        self.progress = progress
+        self.cancel = cancel
+        self.offset = 0
+        self.headers = {}
+        if resume and os.path.exists(sink):
+            self.offset = os.path.getsize(sink)
+            self.headers['Range'] = 'bytes=%d-' % self.offset
+        self.total = None
+        self.result = None
+        self._fh = None
+
+    def open(self, status_code, content_length):
+        if status_code == 200:
+            # whole file sent
+            self.offset = 0
+        if content_length is not None:
+            self.total = int(content_length) + self.offset
+        if isinstance(self.sink, six.string_types):
+            self._fh = self.sink = open(self.sink, 'ab' if self.offset else 'wb')
+        self.result = {'bytes': self.offset, 'written': self.offset, 'checksum': None, 'complete': False,
+                       'http_status': status_code}
+        if self.offset and self.digest is not None:
+            # hash the part already downloaded
+            with open(self._fh.name, 'rb') as previous:
+                for chunk in iter(lambda: previous.read(self.chunk_size), b''):
+                    self.digest.update(chunk)
+
+    def write(self, chunk):
+        # False when the download is cancelled
+        if self.cancel is not None and self.cancel.is_set():
+            LOG.info("download of %s cancelled after %d bytes", self.label, self.result['bytes'])
+            return False
+        if not chunk:
+            return True
+        self.result['bytes'] += len(chunk)
+        if self.digest is not None:
+            self.digest.update(chunk)
+        if self.compressor is not None:
+            chunk = self.compressor.compress(chunk)
+        if chunk:
+            self.sink.write(chunk)
+            self.result['written'] += len(chunk)
+        if self.progress is not None:
+            self.progress(self.result['bytes'], self.total)
+        return True
+
+    def finish(self, complete):
+        self.result['complete'] = complete
+        if self.compressor is not None:
+            chunk = self.compressor.flush()
+            self.sink.write(chunk)
+            self.result['written'] += len(chunk)
+        self.close()
+        if self.digest is not None:
+            self.result['checksum'] = self.digest.hexdigest()
+        LOG.debug("download of %s: %s", self.label, self.result)
+        return self.result
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
 
 class FortiOSAPI:
     """
     Global class / example for FortiOSAPI
     """
-    def __init__(self):
+    def __init__(self, schema_cache=None, pool_connections=10, pool_maxsize=10, pool_block=False, pool=None,
+                 policy=None, session_cache=None, response_cache=None):
+        """
+        A logged FortiOSAPI can be used by many threads at the same time:
+        the csrf/auth headers are swapped under a lock and requests sends
+        over a thread safe urllib3 connection pool.
+
+        :param schema_cache: a SchemaCache to share between FortiOSAPI objects,
+                             an in memory one is created if not provided
+        :param pool_connections: number of hosts whose connections are kept alive
+        :param pool_maxsize: max number of kept alive connections per host
+        :param pool_block: True to wait for a free connection instead of opening
+                           more than pool_maxsize connections to a host
+        :param pool: an adapter from connection_pool() shared by many FortiOSAPI
+                     (to different hosts), pool_* parameters are then ignored
+        :param policy: RequestPolicy (retries, backoff, rate limit) which can be shared
+                       by many FortiOSAPI, by default each request is sent once (no
+                       retry, no rate limit)
+        :param session_cache: SessionCache where login sessions are kept to be reused
+                              by the next login of the same user on the same host
+        :param response_cache: ResponseCache of the get/monitor responses (can be shared),
+                               by default nothing is cached
+        """
         self.host = None
         self._https = True
         self._logged = False
-        self._fortiversion = "Version is set when logged"
+        self._fortiversion = _VERSION_UNSET
+        self._auth_lock = threading.RLock()
+        self._shared_pool = pool is not None
+        # sizes of the pool created here, the ones of a shared pool are set by its owner
+        self._pool_sizes = None
+        if pool is None:
+            self._pool_sizes = (pool_connections, pool_maxsize, pool_block)
+            pool = self.connection_pool(pool_connections, pool_maxsize, pool_block)
+        self._pool = pool
         # reference the fortinet version of the targeted product.
-        self._session = requests.session()  # use single session
+        self._session = self._pooled_session()  # use single session
         # persistant and same for all
         self._session.verify = True
         # (can be changed to) self._session.verify = '/etc/ssl/certs/' or False
@@ -80,9 +219,81 @@ class FortiOSAPI:
         self._apitoken = None
         self._license = None
         self.url_prefix = None
+        if schema_cache is None:
+            schema_cache = SchemaCache()
+        self.schema_cache = schema_cache
+        if policy is None:
+            # retries are opt in, a failing request does not block in backoff sleeps
+            policy = RequestPolicy(retries=0)
+        self.policy = policy
+        self.session_cache = session_cache
+        self.response_cache = response_cache
+        # (username, password, vdom) to login again when the session expires
+        self._credentials = None
+        # user or token digest the responses are cached for
+        self._identity = None
+        self._login_generation = 0
+        self._hooks = dict((event, []) for event in HOOK_EVENTS)
+        self._use_index = False
+        self._mkey_index = {}
+        self._index_lock = threading.RLock()
+
+    @staticmethod
+    def connection_pool(pool_connections=10, pool_maxsize=10, pool_block=False):
+        """
+        Create a connection pool (requests HTTPAdapter) to give as pool= to many
+        FortiOSAPI so that they share the kept alive connections, each one keeps
+        its own cookies and tokens.
+
+        :param pool_connections: number of hosts whose connections are kept alive
+        :param pool_maxsize: max number of kept alive connections per host
+        :param pool_block: True to wait for a free connection instead of opening more
+        :return: the adapter
+        """
+        return requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                             pool_block=pool_block)
+
+    def _pooled_session(self):
+        session = requests.session()
+        session.mount('https://', self._pool)
+        session.mount('http://', self._pool)
+        return session
+
+    def connection_stats(self, all_hosts=False):
+        """
+        Keep alive statistics of the connection pool: a reuse close to 1 means
+        the connections are kept alive, close to 0 that one is opened per request.
+
+        :param all_hosts: True for all the hosts of a shared pool, default only this host
+        :return: list of dict host, port, scheme, connections (opened), requests, reuse
+        """
+        stats = []
+        pools = self._pool.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = pool.host if not pool.port else "%s:%s" % (pool.host, pool.port)
+            if not all_hosts and self.host not in (host, pool.host):
+                continue
+            stats.append({'host': pool.host, 'port': pool.port, 'scheme': pool.scheme,
+                          'connections': pool.num_connections, 'requests': pool.num_requests,
+                          'reuse': 1.0 - float(pool.num_connections) / pool.num_requests
+                          if pool.num_requests else 0.0})
+        return stats
+
+    def _set_headers(self, **headers):
+        # requests copies the session headers while sending, replace the
+        # dict instead of changing it under the other threads
+        with self._auth_lock:
+            new = self._session.headers.copy()
+            new.update(headers)
+            self._session.headers = new
 
     @staticmethod
     def logging(response):
+        if not LOG.isEnabledFor(logging.DEBUG):
+            return
         try:
             LOG.debug("response content type : %s",
                       response.headers['content-type'])
@@ -108,6 +319,103 @@ class FortiOSAPI:
         if status == 'on':
             LOG.setLevel(logging.DEBUG)
 
+    def add_hook(self, event, func):
+        """
+        Register a function called around every request done by this object:
+         - before_request: func(context) just before sending
+         - after_response: func(context, response) when the response is received
+         - on_error: func(context, exception) when the request raised
+        context is a RequestContext (method, url, kind, path, name, mkey, vdom, data, elapsed...)
+        Nothing is computed for the hooks when none is registered.
+
+        :param event: before_request, after_response or on_error
+        :param func: the function to call
+        """
+        if event not in self._hooks:
+            raise ValueError("unknown hook event %s, use one of %s" % (event, HOOK_EVENTS))
+        self._hooks[event].append(func)
+
+    def remove_hook(self, event, func):
+        self._hooks[event].remove(func)
+
+    def _has_hooks(self):
+        hooks = self._hooks
+        return hooks['before_request'] or hooks['after_response'] or hooks['on_error']
+
+    def _run_hooks(self, event, *args):
+        for func in self._hooks[event]:
+            try:
+                func(*args)
+            except Exception as e:
+                LOG.warning("%s hook %s failed: %s", event, func, e)
+
+    def _request(self, method, url, endpoint=None, payload=None, **kwargs):
+        """
+        Send a request with the session, every call to the Fortigate goes through here.
+        When the session expired (401/403) after a login with a password, login
+        again and send the request once more.
+
+        :param endpoint: (kind, path, name, mkey, vdom) describing the call for the hooks
+        :param payload: python object serialized in data, given to the hooks
+        :param kwargs: passed to requests (params, data, files, stream)
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        generation = self._login_generation
+        res = self._request_once(method, url, endpoint, payload, **kwargs)
+        if (res.status_code in (401, 403) and self._credentials is not None and
+                (endpoint is None or endpoint[0] not in ('login', 'logout')) and
+                not kwargs.get('files') and not hasattr(kwargs.get('data'), 'read')):
+            if self._relogin(generation):
+                res.close()
+                res = self._request_once(method, url, endpoint, payload, **kwargs)
+        return res
+
+    def _request_once(self, method, url, endpoint=None, payload=None, **kwargs):
+        if not self._has_hooks():
+            return self._send_retry(method, url, None, **kwargs)
+        kind, path, name, mkey, vdom = endpoint or (None, None, None, None, None)
+        data = kwargs.get('data')
+        context = RequestContext(method, url, kind=kind, path=path, name=name, mkey=mkey, vdom=vdom,
+                                 data=payload,
+                                 bytes_out=len(data) if isinstance(data, (str, bytes)) else 0,
+                                 stream=kwargs.get('stream', False))
+        self._run_hooks('before_request', context)
+        try:
+            res = self._send_retry(method, url, context, **kwargs)
+        except Exception as e:
+            context.elapsed = time.time() - context.start
+            self._run_hooks('on_error', context, e)
+            raise
+        context.elapsed = time.time() - context.start
+        self._run_hooks('after_response', context, res)
+        return res
+
+    def _send_retry(self, method, url, context, **kwargs):
+        # send following the retry policy, context (if any) counts the retries
+        policy = self.policy
+        # uploaded files can not be read twice (upload always passes files, maybe None)
+        replayable = not kwargs.get('files') and not hasattr(kwargs.get('data'), 'read')
+        attempt = 0
+        while True:
+            policy.acquire(self.host)
+            try:
+                res = self._session.request(method, url, **kwargs)
+            except Exception as e:
+                delay = policy.retry(self.host, method, attempt, error=e) if replayable else None
+                if delay is None:
+                    raise
+                LOG.debug("%s %s failed (%s), retry in %.2fs", method, url, e, delay)
+            else:
+                delay = policy.retry(self.host, method, attempt, response=res) if replayable else None
+                if delay is None:
+                    return res
+                LOG.debug("%s %s answered %s, retry in %.2fs", method, url, res.status_code, delay)
+                res.close()
+            attempt += 1
+            if context is not None:
+                context.retries = attempt
+            time.sleep(delay)
+
     def formatresponse(self, res, vdom=None):
         LOG.debug("formating response")
         self.logging(res)
@@ -159,6 +467,94 @@ class FortiOSAPI:
             self._https = False
         LOG.debug("https mode is %s", self._https)
 
+    def existence_index(self, status):
+        """
+        With the index on, set() knows if an object exists and does directly a POST
+        or a PUT instead of a PUT then a POST when the object is missing.
+        The mkeys of a table are read once (GET limited to the mkey field) at the first
+        set on it and the index is updated by the post/delete done with this object.
+        An object created by something else is found when its POST fails, set() then does the PUT.
+
+        :param status: 'on' to use the index, 'off' to stop using it and drop it
+        :return:
+        """
+        if status == 'on':
+            self._use_index = True
+        if status == 'off':
+            self._use_index = False
+            self.invalidate_existence()
+        LOG.debug("existence index is %s", self._use_index)
+
+    def invalidate_existence(self, path=None, name=None, vdom=None):
+        """
+        Drop the existence index of a table (or of all tables), it will be read again
+        on the next set. Useful if objects are deleted by something else than this object.
+        """
+        with self._index_lock:
+            for key in list(self._mkey_index):
+                if ((path is None or key[0] == path) and (name is None or key[1] == name) and
+                        (vdom is None or key[2] == vdom)):
+                    del self._mkey_index[key]
+
+    def _table_mkeys(self, path, name, vdom):
+        # set of the mkeys (as strings) of a table, read once, None if unavailable,
+        # the threads reading the same table at the same time keep the first read
+        key = (path, name, vdom)
+        with self._index_lock:
+            if key in self._mkey_index:
+                return self._mkey_index[key]
+        mkeyname = self.get_mkeyname(path, name, vdom)
+        if not mkeyname:
+            return None
+        resp = self.get(path, name, vdom=vdom, parameters={'format': mkeyname})
+        return self._index_table(key, mkeyname, resp)
+
+    def _index_table(self, key, mkeyname, resp):
+        # index the mkeys of the GET of the table key, None if it failed
+        path, name, vdom = key
+        if not isinstance(resp, dict) or resp.get('status') != 'success':
+            LOG.warning("unable to read the mkeys of %s/%s for the existence index", path, name)
+            return None
+        results = resp.get('results') or []
+        if isinstance(results, dict):
+            results = [results]
+        mkeys = set(str(entry.get(mkeyname)) for entry in results)
+        with self._index_lock:
+            return self._mkey_index.setdefault(key, mkeys)
+
+    def _index_posted(self, path, name, vdom, mkey, r):
+        # index the object created by a POST answered r, False if its mkey
+        # must be read from the posted data
+        if not self._mkey_index or not isinstance(r, dict) or r.get('status') != 'success':
+            return True
+        # the API gives the mkey, it may be allocated by the Fortigate (policyid 0)
+        if r.get('mkey') is not None:
+            mkey = r['mkey']
+        if not mkey:
+            return False
+        self._index_update(path, name, vdom, mkey, True)
+        return True
+
+    def _index_deleted(self, path, name, vdom, mkey, r):
+        if self._mkey_index and isinstance(r, dict) and r.get('status') == 'success':
+            self._index_update(path, name, vdom, mkey, False)
+
+    def _index_update(self, path, name, vdom, mkey, exists):
+        with self._index_lock:
+            mkeys = self._mkey_index.get((path, name, vdom))
+            if mkeys is None or mkey is None:
+                return
+            if exists:
+                mkeys.add(str(mkey))
+            else:
+                mkeys.discard(str(mkey))
+
+    def _invalidate_reads(self, path, name):
+        # a write makes the cached reads of the table stale, in all the vdoms
+        # as vdom=None reads the default one
+        if self.response_cache is not None:
+            self.response_cache.invalidate(kind='cmdb', path=path, name=name, host=self.host)
+
     def update_cookie(self):
         # Retrieve server csrf and update session's headers
         LOG.debug("cookies are  : %s ", self._session.cookies)
@@ -166,7 +562,7 @@ class FortiOSAPI:
             if cookie.name == 'ccsrftoken':
                 csrftoken = cookie.value[1:-1]  # token stored as a list
                 LOG.debug("csrftoken before update  : %s ", csrftoken)
-                self._session.headers.update({'X-CSRFTOKEN': csrftoken})
+                self._set_headers(**{'X-CSRFTOKEN': csrftoken})
                 LOG.debug("csrftoken after update  : %s ", csrftoken)
         LOG.debug("New session header is: %s", self._session.headers)
 
@@ -174,6 +570,8 @@ class FortiOSAPI:
         """
         Initialize the connection to the API with the related credentials.
         Further calls on the object will reuse the session initiated here.
+        With a session_cache a stored session still valid is reused instead of
+        logging in. If the session expires later the next call logs in again.
 
         :param host: ip or name (fqdn) can include a port like 10.40.40.40:8443
         :param username: name of API user
@@ -191,9 +589,8 @@ class FortiOSAPI:
         else:
             self.url_prefix = 'https://' + self.host
 
-        url = self.url_prefix + '/logincheck'
         if not self._session:
-            self._session = requests.session()
+            self._session = self._pooled_session()
             # may happen if logout is called
         self._session.verify = verify
 
@@ -202,33 +599,105 @@ class FortiOSAPI:
         # set the default at 12 see request doc for details http://docs.python-requests.org/en/master/user/advanced/
         self.timeout = timeout
 
-        res = self._session.post(
-            url,
-            data='username=' + urllib.parse.quote(username) + '&secretkey=' + urllib.parse.quote(password) + "&ajax=1", timeout=self.timeout)
+        self._credentials = None
+        self._identity = username
+        if self.session_cache is not None and self._resume_session(username, vdom):
+            self._credentials = (username, password, vdom)
+            return True
+        self._logincheck(username, password, vdom)
+        self._credentials = (username, password, vdom)
+        self._save_session(username)
+        return True
+
+    def _check_license(self, vdom):
+        # check the session with license/status, sets the version, never
+        # answered from the response cache as it probes the session
+        param = "{ vdom = " + vdom + " }"
+        resp_lic = self._monitor('license', 'status', parameters = param)
+        LOG.debug("response system/status : %s", resp_lic)
+        if not isinstance(resp_lic, dict):
+            return False
+        try:
+            self._fortiversion = resp_lic['version']
+            return True
+        except KeyError:
+            return resp_lic.get('status') == 'success'
+
+    def _logincheck(self, username, password, vdom):
+        url = self.url_prefix + '/logincheck'
+        res = self._request(
+            'POST', url, endpoint=('login', None, None, None, None),
+            data='username=' + urllib.parse.quote(username) + '&secretkey=' + urllib.parse.quote(password) + "&ajax=1")
         self.logging(res)
         # Ajax=1 documented in 5.6 API ref but available on 5.4
         LOG.debug("logincheck res : %s", res.content)
-        if res.content.decode('ascii')[0] == '1':
+        if res.content.decode('ascii')[:1] == '1':
             # Update session's csrftoken
             self.update_cookie()
             self._logged = True
-            LOG.debug("host is %s", host)
-            param = "{ vdom = " + vdom + " }"
-            resp_lic = self.monitor('license', 'status', parameters = param)
-            LOG.debug("response system/status : %s", resp_lic)
-            try:
-                self._fortiversion = resp_lic['version']
+            self._login_generation += 1
+            LOG.debug("host is %s", self.host)
+            if self._check_license(vdom):
                 return True
-            except KeyError:
-                if resp_lic['status'] == 'success':
-                    self._logged = True
-                    return True
-                else:
-                    self._logged = False
-                    raise NotLogged
-        else:
-            self._logged = False
-            raise NotLogged
+        self._logged = False
+        raise NotLogged
+
+    def _resume_session(self, username, vdom):
+        # reuse the session stored by a previous login if the Fortigate still accepts it
+        state = self.session_cache.load(self.host, username)
+        if not state:
+            return False
+        for cookie in state.get('cookies', []):
+            self._session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'],
+                                      path=cookie['path'])
+        self._set_headers(**state.get('headers', {}))
+        self._logged = True
+        self._fortiversion = state.get('version', _VERSION_UNSET)
+        if self._check_license(vdom):
+            LOG.debug("reusing the stored session of %s on %s", username, self.host)
+            self._login_generation += 1
+            return True
+        LOG.debug("stored session of %s on %s expired", username, self.host)
+        self._logged = False
+        self._session.cookies.clear()
+        self.session_cache.delete(self.host, username)
+        return False
+
+    def _save_session(self, username):
+        if self.session_cache is None:
+            return
+        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+                   for c in self._session.cookies]
+        headers = {}
+        if 'X-CSRFTOKEN' in self._session.headers:
+            headers['X-CSRFTOKEN'] = self._session.headers['X-CSRFTOKEN']
+        self.session_cache.save(self.host, username, {'cookies': cookies, 'headers': headers,
+                                                      'version': self._fortiversion,
+                                                      'saved': time.time()})
+
+    def _relogin(self, generation):
+        # login again after a 401/403, once for all the threads which got it
+        with self._auth_lock:
+            if self._login_generation != generation:
+                # another thread already did
+                return True
+            credentials = self._credentials
+            if credentials is None:
+                # token login or already login again in this thread
+                return False
+            LOG.info("session on %s expired, login again", self.host)
+            self._credentials = None
+            self._session.cookies.clear()
+            try:
+                self._logincheck(*credentials)
+            except NotLogged:
+                LOG.warning("login again on %s failed", self.host)
+                if self.session_cache is not None:
+                    self.session_cache.delete(self.host, credentials[0])
+                return False
+            self._credentials = credentials
+            self._save_session(credentials[0])
+            return True
 
     def tokenlogin(self, host, apitoken, verify=True, cert=None, timeout=12, vdom="global"):
         """
@@ -245,10 +714,12 @@ class FortiOSAPI:
         :return:
         """
         self.host = host
+        self._credentials = None
+        self._identity = self._token_identity(apitoken)
         if not self._session:
-            self._session = requests.session()
+            self._session = self._pooled_session()
             # may happen at start or if logout is called
-        self._session.headers.update({'Authorization': 'Bearer ' + apitoken})
+        self._set_headers(Authorization='Bearer ' + apitoken)
         self._logged = True
         LOG.debug("self._https is %s", self._https)
         if not self._https:
@@ -264,7 +735,7 @@ class FortiOSAPI:
         self.timeout = timeout
 
         LOG.debug("host is %s", host)
-        resp_lic = self.get('system', 'status', vdom=vdom)
+        resp_lic = self._get('system', 'status', vdom=vdom)
         LOG.debug("response system/status : %s", resp_lic)
         try:
             self._fortiversion = resp_lic['version']
@@ -272,6 +743,15 @@ class FortiOSAPI:
             raise NotLogged
         return True
 
+    @staticmethod
+    def _token_identity(apitoken):
+        # the token is not kept in the response cache keys
+        return 'token:' + hashlib.sha256(apitoken.encode('utf-8')).hexdigest()[:16]
+
+    def _cache_key(self, kind, path, name, vdom, mkey, parameters):
+        return self.response_cache.key(self.host, kind, path, name, vdom, mkey, parameters,
+                                       identity=self._identity)
+
     def get_version(self):
         """
 
@@ -326,8 +806,13 @@ class FortiOSAPI:
         :return:
         """
         url = self.url_prefix + '/logout'
-        res = self._session.post(url, timeout=self.timeout)
-        self._session.close()
+        res = self._request('POST', url, endpoint=('logout', None, None, None, None))
+        if self._credentials is not None and self.session_cache is not None:
+            self.session_cache.delete(self.host, self._credentials[0])
+        self._credentials = None
+        if not self._shared_pool:
+            # closing would drop the connections of the other users of the pool
+            self._session.close()
         self._session.cookies.clear()
         self._logged = False
         # set license to Valid by default to ensure rechecked at login
@@ -384,11 +869,49 @@ class FortiOSAPI:
             The file is part of the returned json
         """
         url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
-        res = self._session.get(url, params=parameters, timeout=self.timeout)
+        res = self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters)
         LOG.debug("in DOWNLOAD function")
-        LOG.debug(" result download : %s", res.content)
+        LOG.debug(" result download : %s bytes", len(res.content))
         return res
 
+    def download_stream(self, path, name, sink, vdom=None, mkey=None, parameters=None, chunk_size=65536,
+                        compression=None, checksum='sha256', progress=None, resume=False, cancel=None):
+        """
+        Download a file (config backup, logs..) with the monitor API, writing it chunk by chunk
+        to sink so the memory used is bounded by chunk_size whatever the file size.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/monitor/<path>/<name>
+        :param sink: file name or binary file like object with a write method
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :param parameters: Add parameters understood by the API call in json. Must set \"destination\": \"file\" and scope
+        :param chunk_size: bytes read at a time
+        :param compression: None, 'gzip' or 'zstd' (needs zstandard) to compress while writing
+        :param checksum: name of a hashlib algorithm computed on the downloaded bytes or None
+        :param progress: function(bytes downloaded, total bytes or None) called after each chunk
+        :param resume: with a file name sink (no compression), continue a partial file with
+                       a Range request, the Fortigate may send the whole file again
+        :param cancel: threading.Event stopping the download when set, the partial file is kept
+        :return:
+            dict bytes (downloaded), written (to sink, compressed size), checksum (hex digest),
+            complete (False if cancelled) and http_status, raise APIError if the call failed
+        """
+        writer = _DownloadWriter(path, name, sink, chunk_size, compression, checksum, progress, resume, cancel)
+        url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
+        res = self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters,
+                            headers=writer.headers, stream=True)
+        try:
+            if res.status_code not in (200, 206):
+                raise APIError(self.formatresponse(res, vdom=vdom))
+            writer.open(res.status_code, res.headers.get('Content-Length'))
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                if not writer.write(chunk):
+                    return writer.finish(False)
+            return writer.finish(True)
+        finally:
+            res.close()
+            writer.close()
+
     def upload(self, path, name, vdom=None, mkey=None,
                parameters=None, data=None, files=None):
         """
@@ -402,14 +925,18 @@ class FortiOSAPI:
         :param vdom: the vdom on which you want to apply config or global for global settings
         :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
         :param files: the file to be uploaded
+                      (built in memory by requests, give a MultipartStream as data for big files)
         :return:
             A formatted json with the last response from the API
         """
         # TODO should be file not files
-        # TODO add a test
         url = self.mon_url(path, name, vdom=vdom, mkey=mkey)
-        res = self._session.post(url, params=parameters,
-                                 data=data, files=files, timeout=self.timeout)
+        headers = None
+        if isinstance(data, MultipartStream):
+            # streamed from the files while sending
+            headers = {'Content-Type': data.content_type}
+        res = self._request('POST', url, endpoint=('monitor', path, name, mkey, vdom),
+                            params=parameters, data=data, files=files, headers=headers)
         LOG.debug("in UPLOAD function")
         return res
 
@@ -425,11 +952,19 @@ class FortiOSAPI:
         :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
         :return:
             A formatted json with the last response from the API, values are in return['results']
+            (shared with the other callers when a response_cache is used, do not modify it)
 
         """
+        if self.response_cache is None:
+            return self._get(path, name, vdom, mkey, parameters)
+        return self.response_cache.fetch(
+            self._cache_key('cmdb', path, name, vdom, mkey, parameters),
+            lambda: self._get(path, name, vdom, mkey, parameters))
+
+    def _get(self, path, name, vdom=None, mkey=None, parameters=None):
         url = self.cmdb_url(path, name, vdom, mkey=mkey)
         LOG.debug("Calling GET ( %s, %s)", url, parameters)
-        res = self._session.get(url, params=parameters, timeout=self.timeout)
+        res = self._request('GET', url, endpoint=('cmdb', path, name, mkey, vdom), params=parameters)
         LOG.debug("in GET function")
         return self.formatresponse(res, vdom=vdom)
 
@@ -444,32 +979,150 @@ class FortiOSAPI:
         :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
         :return:
             A formatted json with the last response from the API, values are in return['results']
+            (shared with the other callers when a response_cache is used, do not modify it)
 
         """
+        if self.response_cache is None:
+            return self._monitor(path, name, vdom, mkey, parameters)
+        return self.response_cache.fetch(
+            self._cache_key('monitor', path, name, vdom, mkey, parameters),
+            lambda: self._monitor(path, name, vdom, mkey, parameters))
+
+    def _monitor(self, path, name, vdom=None, mkey=None, parameters=None):
         url = self.mon_url(path, name, vdom, mkey)
         LOG.debug("in monitor url is %s", url)
-        res = self._session.get(url, params=parameters, timeout=self.timeout)
+        res = self._request('GET', url, endpoint=('monitor', path, name, mkey, vdom), params=parameters)
         LOG.debug("in MONITOR function")
         return self.formatresponse(res, vdom=vdom)
 
+    @staticmethod
+    def _iter_pages(fetch, parameters, page_size, prefetch):
+        # fetch(parameters) returns a formatted response, pages are asked with start/count
+        # and only one page (two with prefetch) is in memory at a time
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        def page(start):
+            params = dict(parameters or {})
+            params['start'] = start
+            params['count'] = page_size
+            return fetch(params)
+
+        try:
+            start = 0
+            future = None
+            resp = page(start)
+            first = None
+            while True:
+                if not isinstance(resp, dict) or resp.get('status') != 'success':
+                    raise APIError(resp)
+                results = resp.get('results') or []
+                if not isinstance(results, list):
+                    results = [results]
+                if not results or (start > 0 and results[0] == first):
+                    # an endpoint ignoring start would send the same page again
+                    return
+                first = results[0]
+                # a short page is the last one, a longer page comes from an endpoint
+                # ignoring count which sent everything at once
+                last_page = len(results) != page_size
+                if not last_page and executor is not None:
+                    future = executor.submit(page, start + page_size)
+                del resp
+                for record in results:
+                    yield record
+                if last_page:
+                    return
+                start += page_size
+                if future is not None:
+                    resp = future.result()
+                    future = None
+                else:
+                    resp = page(start)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def iter_table(self, path, name, vdom=None, parameters=None, page_size=1000, prefetch=True):
+        """
+        Iterate on the entries of a cmdb table with a GET per page of page_size entries,
+        the memory used is bounded by the page size whatever the table size.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/cmdb/<path>/<name>
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :param parameters: dict of add on parameters understood by the API call like {"format": "name|subnet"}
+        :param page_size: number of entries asked per request
+        :param prefetch: get the next page while the current one is consumed
+        :return:
+            a generator of the table entries, raise APIError if a page fails
+        """
+        return self._iter_pages(lambda params: self._get(path, name, vdom=vdom, parameters=params),
+                                parameters, page_size, prefetch)
+
+    def iter_monitor(self, path, name, vdom=None, mkey=None, parameters=None, page_size=1000, prefetch=True):
+        """
+        Iterate on the results of a monitor call paging with start/count
+        (firewall/session for example), see iter_table.
+
+        :return:
+            a generator of the monitor results, raise APIError if a page fails
+        """
+        return self._iter_pages(lambda params: self._monitor(path, name, vdom=vdom, mkey=mkey, parameters=params),
+                                parameters, page_size, prefetch)
+
     def schema(self, path, name, vdom=None):
+        """
+        Get the schema of a cmdb table. Successful answers are kept in the
+        schema_cache, keyed by the firmware version, so are fetched only once.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/cmdb/<path>/<name>
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :return:
+            The schema results or the error returned by the API
+        """
+        cacheable = self.schema_cache is not None and self._fortiversion != _VERSION_UNSET
+        if cacheable:
+            schema = self.schema_cache.get(self._fortiversion, path, name, vdom=vdom)
+            if schema is not None:
+                return schema
         # vdom or global is managed in cmdb_url
         if vdom is None:
             url = self.cmdb_url(path, name) + "?action=schema"
         else:
             url = self.cmdb_url(path, name, vdom=vdom) + "&action=schema"
 
-        res = self._session.get(url, timeout=self.timeout)
-        if res.status_code is 200:
+        res = self._request('GET', url, endpoint=('schema', path, name, None, vdom))
+        if res.status_code == 200:
             if vdom == "global":
-                return json.loads(res.content.decode('utf-8'))[0]['results']
+                schema = json.loads(res.content.decode('utf-8'))[0]['results']
             else:
-                return json.loads(res.content.decode('utf-8'))['results']
+                schema = json.loads(res.content.decode('utf-8'))['results']
+            if cacheable:
+                self.schema_cache.put(self._fortiversion, path, name, schema, vdom=vdom)
+            return schema
         else:
             return json.loads(res.content.decode('utf-8'))
 
-    def get_name_path_dict(self, vdom=None):
-        # return builded URL
+    def invalidate_schema(self, path=None, name=None, vdom=None):
+        """
+        Drop the cached schemas of the current firmware version, all of them
+        if no path/name/vdom is given. Use it if a schema changed without
+        version change (special builds).
+
+        :return: the number of schemas removed from memory
+        """
+        return self.schema_cache.invalidate(version=self._fortiversion, path=path,
+                                            name=name, vdom=vdom)
+
+    def cmdb_schemas(self, vdom=None):
+        """
+        Schemas of all the cmdb tables and settings in one call.
+
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :return:
+            list of the schemas (dict with path, name, category, mkey, children..)
+        """
         url_postfix = '/api/v2/cmdb/'
         if vdom is not None:
             url_postfix += '?vdom=' + vdom + "&action=schema"
@@ -477,13 +1130,16 @@ class FortiOSAPI:
             url_postfix += "?action=schema"
 
         url = self.url_prefix + url_postfix
-        cmdbschema = self._session.get(url, timeout=self.timeout)
+        cmdbschema = self._request('GET', url, endpoint=('schema', None, None, None, vdom))
         self.logging(cmdbschema)
-        j = json.loads(cmdbschema.content.decode('utf-8'))['results']
+        return [keys for keys in json.loads(cmdbschema.content.decode('utf-8'))['results']
+                if "__tree__" not in keys['path']]
+
+    def get_name_path_dict(self, vdom=None):
+        # return builded URL
         dict = []
-        for keys in j:
-            if "__tree__" not in keys['path']:
-                dict.append(keys['path'] + " " + keys['name'])
+        for keys in self.cmdb_schemas(vdom):
+            dict.append(keys['path'] + " " + keys['name'])
         return dict
 
     def post(self, path, name, data, vdom=None,
@@ -514,11 +1170,16 @@ class FortiOSAPI:
         # post with mkey will return a 404 as the next level is not there yet
         # we pushed mkey in data if needed.
         url = self.cmdb_url(path, name, vdom, mkey=None)
-        LOG.debug("POST sent data : %s", json.dumps(data))
-        res = self._session.post(
-            url, params=parameters, data=json.dumps(data), timeout=self.timeout)
+        body = json.dumps(data)
+        LOG.debug("POST sent data : %s", body)
+        res = self._request('POST', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                            params=parameters, data=body)
+        self._invalidate_reads(path, name)
         LOG.debug("POST raw results: %s", res)
-        return self.formatresponse(res, vdom=vdom)
+        r = self.formatresponse(res, vdom=vdom)
+        if not self._index_posted(path, name, vdom, mkey, r):
+            self._index_posted(path, name, vdom, self.get_mkey(path, name, data, vdom=vdom), r)
+        return r
 
     def execute(self, path, name, data, vdom=None,
                 mkey=None, parameters=None):
@@ -541,9 +1202,10 @@ class FortiOSAPI:
         LOG.debug("in EXEC function")
 
         url = self.mon_url(path, name, vdom, mkey=mkey)
-        LOG.debug("EXEC sent data : %s", json.dumps(data))
-        res = self._session.post(
-            url, params=parameters, data=json.dumps(data), timeout=self.timeout)
+        body = json.dumps(data)
+        LOG.debug("EXEC sent data : %s", body)
+        res = self._request('POST', url, endpoint=('monitor', path, name, mkey, vdom), payload=data,
+                            params=parameters, data=body)
         LOG.debug("EXEC raw results: %s", res)
         return self.formatresponse(res, vdom=vdom)
 
@@ -566,13 +1228,14 @@ class FortiOSAPI:
         if not mkey:
             mkey = self.get_mkey(path, name, data, vdom=vdom)
         url = self.cmdb_url(path, name, vdom, mkey)
-        res = self._session.put(url, params=parameters,
-                                data=json.dumps(data), timeout=self.timeout)
+        res = self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                            params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
         LOG.debug("in PUT function")
         return self.formatresponse(res, vdom=vdom)
 
     def move(self, path, name, vdom=None, mkey=None,
-             where=None, reference_key=None, parameters={}):
+             where=None, reference_key=None, parameters=None):
         # TODO add a test in the tOx suit
         """
         Move an object in a cmdb table (firewall/policies for example).
@@ -589,9 +1252,12 @@ class FortiOSAPI:
             A formatted json with the last response from the API
         """
         url = self.cmdb_url(path, name, vdom, mkey)
+        # copy, the caller dict (or a shared default) must not keep the move parameters
+        parameters = dict(parameters or {})
         parameters['action'] = 'move'
         parameters[where] = str(reference_key)
-        res = self._session.put(url, params=parameters, timeout=self.timeout)
+        res = self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), params=parameters)
+        self._invalidate_reads(path, name)
         LOG.debug("in MOVE function")
         return self.formatresponse(res, vdom=vdom)
 
@@ -615,11 +1281,14 @@ class FortiOSAPI:
         if not mkey:
             mkey = self.get_mkey(path, name, data, vdom=vdom)
         url = self.cmdb_url(path, name, vdom, mkey)
-        res = self._session.delete(
-            url, params=parameters, data=json.dumps(data), timeout=self.timeout)
+        res = self._request('DELETE', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                            params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
 
         LOG.debug("in DELETE function")
-        return self.formatresponse(res, vdom=vdom)
+        r = self.formatresponse(res, vdom=vdom)
+        self._index_deleted(path, name, vdom, mkey, r)
+        return r
 
     # Set will try to put if err code is 424 will try post (424 is ressource exists)
     # may add a force option to delete and redo if troubles.
@@ -642,23 +1311,395 @@ class FortiOSAPI:
         # post with mkey will return a 404 as the next level is not there yet
         if not mkey:
             mkey = self.get_mkey(path, name, data, vdom=vdom)
+        if self._use_index and mkey is not None and self._not_indexed(path, name, vdom, mkey,
+                                                                      self._table_mkeys(path, name, vdom)):
+            r = self.post(path, name, data, vdom, mkey, parameters=parameters)
+            if not self._stale_index(path, name, vdom, mkey, r):
+                return r
         url = self.cmdb_url(path, name, vdom, mkey)
-        res = self._session.put(
-            url, params=parameters, data=json.dumps(data), timeout=self.timeout)
+        res = self._request('PUT', url, endpoint=('cmdb', path, name, mkey, vdom), payload=data,
+                            params=parameters, data=json.dumps(data))
+        self._invalidate_reads(path, name)
         LOG.debug("in SET function after PUT")
         r = self.formatresponse(res, vdom=vdom)
 
-        if r['http_status'] == 404 or r['http_status'] == 405 or r['http_status'] == 500:
+        if self._missing(r):
             LOG.warning(
                 "Try to put on %s  failed doing a put to force parameters\
                 change consider delete if still fails ",
-                res.request.url)
+                url)
             res = self.post(path, name, data, vdom, mkey)
             LOG.debug("in SET function after POST result %s", res)
-            return self.formatresponse(res, vdom=vdom)
+            # post already returns a formatted response
+            return res
         else:
             return r
 
+    @staticmethod
+    def _not_indexed(path, name, vdom, mkey, mkeys):
+        # set() does a POST directly when the existence index of the table misses mkey
+        if mkeys is None or str(mkey) in mkeys:
+            return False
+        LOG.debug("in SET %s not in the existence index of %s/%s doing a POST", mkey, path, name)
+        return True
+
+    def _stale_index(self, path, name, vdom, mkey, r):
+        # True if the POST of set() answered r because the object was created
+        # after the table was indexed, it is then indexed and set() does the PUT
+        if not isinstance(r, dict) or r.get('http_status') != 500 or r.get('error') != -5:
+            return False
+        LOG.debug("%s created in %s/%s after the existence index was read doing a PUT", mkey, path, name)
+        self._index_update(path, name, vdom, mkey, True)
+        return True
+
+    @staticmethod
+    def _missing(r):
+        # answer of a PUT on an object which does not exist, 500 is also answered
+        # for transient errors, -3 is the "entry not found" error code
+        if not isinstance(r, dict):
+            return False
+        return r.get('http_status') in (404, 405) or (r.get('http_status') == 500 and r.get('error') == -3)
+
+    def _ensure_pool_size(self, size):
+        # requests keeps 10 connections per host by default, more threads would
+        # open and drop connections instead of reusing them
+        if self._shared_pool:
+            LOG.debug("shared pool used by %d threads, give connection_pool() a pool_maxsize of at least %d",
+                      size, size)
+            return
+        with self._auth_lock:
+            pool_connections, pool_maxsize, pool_block = self._pool_sizes
+            if pool_maxsize >= size:
+                return
+            LOG.debug("connection pool grown from %d to %d connections per host", pool_maxsize, size)
+            self._pool_sizes = (pool_connections, size, pool_block)
+            self._pool = self.connection_pool(pool_connections, size, pool_block)
+            self._session.mount('https://', self._pool)
+            self._session.mount('http://', self._pool)
+
+    @staticmethod
+    def _failure(error):
+        # response of a call which raised
+        return {'status': 'error', 'http_status': None, 'error': str(error)}
+
+    @staticmethod
+    def _bulk_mkeyname(path, name, mkeyname, call):
+        if not mkeyname:
+            raise ValueError("%s/%s is not a table, %s needs a mkey" % (path, name, call))
+        return mkeyname
+
+    @staticmethod
+    def _collect(summary, mkey, res):
+        # add the response of the call on mkey to a bulk summary
+        if not isinstance(res, dict):
+            # formatresponse returns the raw response if not json
+            res = {'status': 'error', 'http_status': getattr(res, 'status_code', None)}
+        entry = {'mkey': mkey, 'status': res.get('status'), 'http_status': res.get('http_status')}
+        if res.get('status') == 'success':
+            summary['success'] += 1
+        else:
+            summary['error'] += 1
+            entry['error'] = res.get('error')
+            entry['response'] = res
+        summary['results'].append(entry)
+
+    def _run_many(self, func, items, keyof, concurrency):
+        # run func on each item with at most concurrency calls in flight
+        # and at most 2 * concurrency items read from the iterable
+        self._ensure_pool_size(concurrency)
+        summary = {'success': 0, 'error': 0, 'results': []}
+
+        def safe(item):
+            try:
+                return func(item)
+            except Exception as e:
+                LOG.warning("bulk call failed for %s: %s", keyof(item), e)
+                return self._failure(e)
+
+        def collect(item, res):
+            self._collect(summary, keyof(item), res)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for item in items:
+                pending.append((item, executor.submit(safe, item)))
+                if len(pending) >= 2 * concurrency:
+                    item, future = pending.popleft()
+                    collect(item, future.result())
+            while pending:
+                item, future = pending.popleft()
+                collect(item, future.result())
+        return summary
+
+    def set_many(self, path, name, objects, vdom=None, parameters=None, concurrency=8):
+        """
+        set a list (or any iterable) of objects in a cmdb table with concurrency
+        requests in flight over the kept alive connections of the session.
+        The mkey name is retrieved once for all the objects.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/cmdb/<path>/<name>
+        :param objects: iterable of json (dict) objects, each one must contain its mkey
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
+        :param concurrency: max number of requests running at the same time
+        :return:
+            a summary {'success': n, 'error': n, 'results': [{'mkey', 'status', 'http_status'(, 'error', 'response')}]}
+            results are in the objects order
+        """
+        mkeyname = self._bulk_mkeyname(path, name, self.get_mkeyname(path, name, vdom), 'set_many')
+
+        if self._use_index:
+            # read once before the threads start
+            self._table_mkeys(path, name, vdom)
+
+        def setone(data):
+            return self.set(path, name, data, mkey=data.get(mkeyname), vdom=vdom, parameters=parameters)
+
+        return self._run_many(setone, objects, lambda data: data.get(mkeyname), concurrency)
+
+    def delete_many(self, path, name, objects, vdom=None, parameters=None, concurrency=8,
+                    reference_index=None):
+        """
+        delete a list (or any iterable) of objects from a cmdb table with concurrency
+        requests in flight.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/cmdb/<path>/<name>
+        :param objects: iterable of mkeys or json (dict) objects containing their mkey
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
+        :param concurrency: max number of requests running at the same time
+        :param reference_index: a ReferenceIndex, the objects still referenced (by
+                                objects not deleted here) are not sent and fail with
+                                the error "referenced" and the referrers in the response.
+                                The objects referenced by others of the batch (nested
+                                groups) are deleted after them.
+        :return:
+            a summary as returned by set_many
+        """
+        mkeyname = self._bulk_mkeyname(path, name, self.get_mkeyname(path, name, vdom), 'delete_many')
+
+        def keyof(item):
+            return self._delete_key(mkeyname, item)
+
+        blocked = {}
+
+        def deleteone(item):
+            return self._blocked(blocked, keyof(item)) or \
+                self.delete(path, name, vdom=vdom, mkey=keyof(item), parameters=parameters)
+
+        if reference_index is None:
+            return self._run_many(deleteone, objects, keyof, concurrency)
+
+        objects = list(objects)
+        summary = {'success': 0, 'error': 0, 'results': [None] * len(objects)}
+        for indexes in self._delete_levels(path, name, vdom, objects, keyof, reference_index, blocked):
+            self._merge(summary, indexes, self._run_many(deleteone, [objects[i] for i in indexes], keyof,
+                                                         concurrency))
+        return summary
+
+    @staticmethod
+    def _delete_key(mkeyname, item):
+        # delete_many objects are mkeys or dicts containing their mkey
+        if isinstance(item, dict):
+            return item.get(mkeyname)
+        return item
+
+    @staticmethod
+    def _blocked(blocked, mkey):
+        # response of the deletion of an object referenced outside of the batch, None if not
+        referrers = blocked.get(six.text_type(mkey))
+        if referrers:
+            return {'status': 'error', 'http_status': None, 'error': 'referenced',
+                    'referrers': referrers}
+        return None
+
+    @staticmethod
+    def _delete_levels(path, name, vdom, objects, keyof, reference_index, blocked):
+        """
+        Order the deletion of objects with the references of reference_index:
+        FortiOS refuses to delete a referenced object, the referrers deleted in
+        the batch go on a level before the objects they reference. The objects
+        referenced from outside of the batch are added to blocked (mkey: referrers).
+
+        :return: list of levels, each one the list of the indexes of its objects
+        """
+        keys = [six.text_type(keyof(item)) for item in objects]
+        deleted = set((path, name, key) for key in keys)
+        dependencies = {}
+        for item, key in zip(objects, keys):
+            referrers = reference_index.referrers(path, name, keyof(item), vdom=vdom)
+            outside = [r for r in referrers if (r['path'], r['name'], r['mkey']) not in deleted]
+            if outside:
+                blocked[key] = outside
+            dependencies[key] = set(r['mkey'] for r in referrers
+                                    if (r['path'], r['name'], r['mkey']) in deleted and r['mkey'] != key)
+        levels = []
+        for level in overlay.dependency_levels(dependencies, keys):
+            level = set(level)
+            levels.append([i for i, key in enumerate(keys) if key in level])
+        return levels
+
+    @staticmethod
+    def _merge(summary, indexes, part):
+        # put the summary of the objects at indexes in the summary of all of them
+        summary['success'] += part['success']
+        summary['error'] += part['error']
+        for i, entry in zip(indexes, part['results']):
+            summary['results'][i] = entry
+
+    def _array_post_supported(self):
+        # FortiOS accepts a json array of objects as POST body of a table since 6.4
+        match = re.match(r'v?(\d+)\.(\d+)', self._fortiversion or '')
+        return match is not None and (int(match.group(1)), int(match.group(2))) >= (6, 4)
+
+    @staticmethod
+    def _rejected(r):
+        # the Fortigate refused the objects (invalid or existing one), as opposed
+        # to a failure of the request itself (session, overload, transport)
+        if not isinstance(r, dict):
+            return False
+        status = r.get('http_status')
+        if status in (401, 403, 429):
+            return False
+        if status is not None and 400 <= status < 500:
+            return True
+        # FortiOS answers 500 with its error code for an existing or invalid entry
+        return status == 500 and r.get('error') is not None
+
+    def _chunk_results(self, path, name, mkeyname, chunk, vdom, r):
+        """
+        Responses of the objects of an array POST from its answer.
+
+        :return: list of responses in the chunk order, None if the answer is a
+                 failure without the result of each object
+        """
+        if not isinstance(r, dict):
+            return None
+        results = r.get('results')
+        if not isinstance(results, list) or len(results) != len(chunk):
+            results = None
+        elif r.get('status') != 'success' and not all(isinstance(x, dict) and 'status' in x for x in results):
+            results = None
+        if results is None:
+            if r.get('status') != 'success':
+                return None
+            results = [{} for _ in chunk]
+        base = dict((k, v) for k, v in r.items() if k not in ('results', 'status', 'http_status', 'error'))
+        responses = []
+        for data, result in zip(chunk, results):
+            if not isinstance(result, dict):
+                result = {}
+            resp = dict(base)
+            resp['status'] = result.get('status', r.get('status'))
+            resp['http_status'] = result.get('http_status', r.get('http_status'))
+            # the mkeys allocated by the Fortigate (policyid 0) are in the results if given
+            resp['mkey'] = result.get('mkey', data.get(mkeyname))
+            if resp['status'] == 'success':
+                if self._mkey_index:
+                    self._index_update(path, name, vdom, resp['mkey'], True)
+            else:
+                resp['error'] = result.get('error', r.get('error'))
+            responses.append(resp)
+        return responses
+
+    def _post_chunk(self, path, name, mkeyname, chunk, vdom, parameters):
+        """
+        POST chunk as one json array. When the Fortigate rejects the array
+        without telling which objects are wrong, it is split in halves until
+        they are posted alone (a rejected array creates nothing on FortiOS).
+        A failure of the request itself (session, 429, 503, transport) is the
+        response of all the objects, they are not sent again.
+
+        :return: the responses of the objects of chunk, in order
+        """
+        if len(chunk) == 1:
+            try:
+                return [self.post(path, name, chunk[0], vdom=vdom, parameters=parameters)]
+            except Exception as e:
+                LOG.warning("bulk call failed for %s: %s", chunk[0].get(mkeyname), e)
+                return [self._failure(e)]
+        url = self.cmdb_url(path, name, vdom)
+        try:
+            res = self._request('POST', url, endpoint=('cmdb', path, name, None, vdom), payload=chunk,
+                                params=parameters, data=json.dumps(chunk))
+            r = self.formatresponse(res, vdom=vdom)
+        except Exception as e:
+            LOG.warning("POST of %d objects failed: %s", len(chunk), e)
+            r = self._failure(e)
+        finally:
+            self._invalidate_reads(path, name)
+        responses, halves = self._chunk_outcome(path, name, mkeyname, chunk, vdom, r)
+        if halves is None:
+            return responses
+        return (self._post_chunk(path, name, mkeyname, halves[0], vdom, parameters) +
+                self._post_chunk(path, name, mkeyname, halves[1], vdom, parameters))
+
+    def _chunk_outcome(self, path, name, mkeyname, chunk, vdom, r):
+        """
+        What to do after the POST of chunk answered r.
+
+        :return: (responses of the objects, None) or (None, the halves to post)
+        """
+        responses = self._chunk_results(path, name, mkeyname, chunk, vdom, r)
+        if responses is not None:
+            return responses, None
+        if self._rejected(r):
+            LOG.debug("POST of %d objects rejected, split in halves", len(chunk))
+            half = len(chunk) // 2
+            return None, (chunk[:half], chunk[half:])
+        LOG.warning("POST of %d objects failed: %s", len(chunk), r)
+        return [r] * len(chunk), None
+
+    def post_batch(self, path, name, objects, vdom=None, parameters=None, chunk_size=100, concurrency=8):
+        """
+        create a list (or any iterable) of objects in a cmdb table with one POST
+        of a json array per chunk_size objects when the firmware accepts it
+        (6.4 and later), with one post per object (concurrency in flight)
+        otherwise. The errors of the objects given in the answer are mapped
+        back to them, a chunk rejected as a whole is split in halves until the
+        objects in error are isolated and get the response of their own post.
+        A chunk failing for another reason (session, 429, 503, transport error)
+        is not split, all its objects get that response.
+
+        :param path: first part of the Fortios API URL like
+        :param name: https://myfgt:8040/api/v2/cmdb/<path>/<name>
+        :param objects: iterable of json (dict) objects to create
+        :param vdom: the vdom on which you want to apply config or global for global settings
+        :param parameters: Add on parameters understood by the API call can be \"&select=\" for example
+        :param chunk_size: max number of objects per POST
+        :param concurrency: max number of requests running at the same time without
+                            json arrays, use 1 for the tables where the order matters (policies)
+        :return:
+            a summary as returned by set_many, results are in the objects order
+        """
+        mkeyname = self._bulk_mkeyname(path, name, self.get_mkeyname(path, name, vdom), 'post_batch')
+
+        if chunk_size <= 1 or not self._array_post_supported():
+            LOG.debug("no json array POST on %s, one post per object", self._fortiversion)
+
+            def postone(data):
+                return self.post(path, name, data, vdom=vdom, parameters=parameters)
+
+            return self._run_many(postone, objects, lambda data: data.get(mkeyname), concurrency)
+
+        summary = {'success': 0, 'error': 0, 'results': []}
+        for chunk in self._chunks(objects, chunk_size):
+            for data, res in zip(chunk, self._post_chunk(path, name, mkeyname, chunk, vdom, parameters)):
+                self._collect(summary, data.get(mkeyname), res)
+        return summary
+
+    @staticmethod
+    def _chunks(objects, chunk_size):
+        # lists of chunk_size objects read from the iterable
+        objects = iter(objects)
+        while True:
+            chunk = list(itertools.islice(objects, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
     @staticmethod
     def ssh(cmds, host, user, password=None, port=22):
         """
@@ -731,23 +1772,18 @@ class FortiOSAPI:
                     "after update response monitor license status: %s", resp2)
                 return resp2
 
-    def setoverlayconfig(self, yamltree, vdom=None):
+    @staticmethod
+    def splitoverlay(yamltree):
         """
-        take a yaml tree with
-        name:
-            path:
-                mkey:
-        structure and recursively set the values.
-        create a copy to only keep the leaf as node (table firewall rules etc
-        Split the tree in 2 yaml objects and iterates)
-        Update the higher level, up to tables as those config parameters may influence which param are allowed
-        in the level 3 table
+        Split an overlay yaml tree in 2 trees: the first one keeps only the
+        parameters set at the name/path level, the second one only the
+        table entries (nodes which are structures).
+        The tree passed as parameter is modified and returned as the first tree.
+
         :param yamltree: a yaml formatted string of the differents part of CMDB to be changed
-        :param vdom: (optionnal) default is root, can use vdom=global to swtich to global settings.
         :return:
-
+            (yamltree, yamltreel3)
         """
-
         yamltreel3 = copy.deepcopy(yamltree)
         LOG.debug("initial yamltreel3 is %s ", yamltreel3)
         for name in yamltree.copy():
@@ -765,35 +1801,72 @@ class FortiOSAPI:
         # yamltree and yamltreel3 are now different
         LOG.debug("after yamltree is %s ", yamltree)
         LOG.debug("after yamltreel3 is %s ", yamltreel3)
-        restree = False
-        # Set the standard value on top of nodes first (example if setting firewall mode
-        # it must be done before pushing a rule l3)
-        # Set the standard value on top of nodes first (example if setting firewall mode it must be done before pushing a rule l3)
-        for name in yamltree:
-            for path in yamltree[name]:
-                LOG.debug("iterate set in yamltree @ name: %s path %s value %s",
-                          name, path, yamltree[name][path])
-                if yamltree[name][path]:
-                    res = self.set(
-                        name, path, data=yamltree[name][path], vdom=vdom)
-                    if res['status'] == "success":
-                        restree = True
-                    else:
-                        restree = False
-                        break
+        return yamltree, yamltreel3
 
+    @classmethod
+    def _overlay_groups(cls, yamltree):
+        # the sets of setoverlayconfig without diff nor concurrency as lists of
+        # (name, path, mkey, data), a failed set skips the rest of its list
+        yamltree, yamltreel3 = cls.splitoverlay(yamltree)
+        for name in yamltree:
+            LOG.debug("iterate set in yamltree @ name: %s value %s", name, yamltree[name])
+            yield [(name, path, None, yamltree[name][path]) for path in yamltree[name] if yamltree[name][path]]
         for name in yamltreel3:
             for path in yamltreel3[name]:
-                for k in yamltreel3[name][path].copy():
-                    node = yamltreel3[name][path][k]
-                    LOG.debug(
-                        "iterate set in yamltreel3 @ node: %s value %s ", k, yamltreel3[name][path][k])
-                    res = self.set(name, path, mkey=k, data=node, vdom=vdom)
-                    if res['status'] == "success":
-                        restree = True
-                    else:
-                        restree = False
-                        break
+                LOG.debug("iterate set in yamltreel3 @ name: %s path %s", name, path)
+                yield [(name, path, k, node) for k, node in yamltreel3[name][path].items()]
+
+    def planoverlayconfig(self, yamltree, vdom=None):
+        """
+        Compare an overlay (see setoverlayconfig) with the running configuration,
+        each touched table is read once.
+
+        :param yamltree: a yaml formatted string of the differents part of CMDB to be changed
+        :param vdom: (optionnal) default is root, can use vdom=global to swtich to global settings.
+        :return:
+            an OverlayPlan listing the objects to create, update or skip
+        """
+        return overlay.plan_overlay(self, yamltree, vdom=vdom)
+
+    def setoverlayconfig(self, yamltree, vdom=None, diff=False, concurrency=1):
+        """
+        take a yaml tree with
+        name:
+            path:
+                mkey:
+        structure and recursively set the values.
+        create a copy to only keep the leaf as node (table firewall rules etc
+        Split the tree in 2 yaml objects and iterates)
+        Update the higher level, up to tables as those config parameters may influence which param are allowed
+        in the level 3 table
+        :param yamltree: a yaml formatted string of the differents part of CMDB to be changed
+        :param vdom: (optionnal) default is root, can use vdom=global to swtich to global settings.
+        :param diff: if True only the objects differing from the running configuration are pushed
+        :param concurrency: if more than 1, tables are pushed in the order of their references
+                            (schema datasources) and the entries of independent tables concurrently
+        :return:
+            True if all the sets succeeded,
+            with diff the OverlayPlan applied (plan.summary() gives the created/updated/skipped/failed counts)
+        """
+        if diff:
+            self._ensure_pool_size(concurrency)
+            plan = self.planoverlayconfig(yamltree, vdom=vdom)
+            return overlay.apply_overlay_plan(self, plan, vdom=vdom, concurrency=concurrency)
+        if concurrency > 1:
+            self._ensure_pool_size(concurrency)
+            plan = overlay.set_plan(self, yamltree)
+            overlay.apply_overlay_plan(self, plan, vdom=vdom, concurrency=concurrency)
+            return plan.failed == 0
+
+        restree = False
+        # Set the standard value on top of nodes first (example if setting firewall mode
+        # it must be done before pushing a rule l3)
+        for group in self._overlay_groups(yamltree):
+            for name, path, mkey, data in group:
+                res = self.set(name, path, mkey=mkey, data=data, vdom=vdom)
+                restree = res['status'] == "success"
+                if not restree:
+                    break
 
         # TODO   Must defined a coherent returned value out
         return restree
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# metrics.py holds the request context passed to the FortiOSAPI
+# hooks and a collector of per endpoint latency/size statistics.
+#
+###################################################################
+
+import bisect
+import threading
+import time
+
+HOOK_EVENTS = ('before_request', 'after_response', 'on_error')
+
+# upper bounds in seconds of the latency histogram buckets, last one is +inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RequestContext(object):
+    """
+    Describe a request done by FortiOSAPI, given to the hooks.
+
+    kind is cmdb, monitor, schema, login or logout. data is the python
+    object sent (not serialized). retries is the number of times the request
+    was sent again. elapsed is set once the response is received. stream is
+    True when the response body is read by the caller after the hooks.
+    """
+
+    def __init__(self, method, url, kind=None, path=None, name=None, mkey=None,
+                 vdom=None, data=None, bytes_out=0, stream=False):
+        self.method = method
+        self.url = url
+        self.kind = kind
+        self.path = path
+        self.name = name
+        self.mkey = mkey
+        self.vdom = vdom
+        self.data = data
+        self.bytes_out = bytes_out
+        self.stream = stream
+        self.retries = 0
+        self.start = time.time()
+        self.elapsed = None
+
+    @property
+    def endpoint(self):
+        """
+        endpoint without the mkey like cmdb/firewall/address
+        """
+        if self.path is None:
+            return self.kind
+        return "%s/%s/%s" % (self.kind, self.path, self.name)
+
+    def __repr__(self):
+        return "RequestContext(%s %s)" % (self.method, self.url)
+
+
+class _EndpointStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.status = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def as_dict(self):
+        buckets = ["<=%s" % b for b in LATENCY_BUCKETS] + [">%s" % LATENCY_BUCKETS[-1]]
+        return {'count': self.count,
+                'errors': self.errors,
+                'retries': self.retries,
+                'total_time': self.total_time,
+                'avg_time': self.total_time / self.count if self.count else 0.0,
+                'max_time': self.max_time,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'status': dict(self.status),
+                'histogram': dict(zip(buckets, self.histogram))}
+
+
+class RequestMetrics(object):
+    """
+    Collect per (method, endpoint) latency histogram, bytes in/out,
+    status codes, errors and retries using the FortiOSAPI hooks.
+
+    metrics = RequestMetrics()
+    metrics.attach(fgt)
+    ...
+    metrics.report()
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def attach(self, client):
+        """
+        Register the collector hooks on a FortiOSAPI (can be called on many clients)
+        """
+        client.add_hook('after_response', self.after_response)
+        client.add_hook('on_error', self.on_error)
+        return self
+
+    def detach(self, client):
+        client.remove_hook('after_response', self.after_response)
+        client.remove_hook('on_error', self.on_error)
+
+    def _get(self, context):
+        key = (context.method, context.endpoint)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats.setdefault(key, _EndpointStats())
+        return stats
+
+    def _record(self, stats, context):
+        elapsed = context.elapsed or 0.0
+        stats.count += 1
+        stats.retries += context.retries
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        stats.bytes_out += context.bytes_out
+        stats.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def after_response(self, context, response):
+        status = getattr(response, 'status_code', None)
+        size = response.headers.get('Content-Length') if getattr(response, 'headers', None) else None
+        if size is not None:
+            size = int(size)
+        elif context.stream:
+            # the body is not read yet, reading it here would load all of it
+            size = 0
+        else:
+            size = len(getattr(response, 'content', b'') or b'')
+        with self._lock:
+            stats = self._get(context)
+            self._record(stats, context)
+            stats.bytes_in += size
+            stats.status[status] = stats.status.get(status, 0) + 1
+            if status is None or status >= 400:
+                stats.errors += 1
+
+    def on_error(self, context, error):
+        with self._lock:
+            stats = self._get(context)
+            self._record(stats, context)
+            stats.errors += 1
+            name = type(error).__name__
+            stats.status[name] = stats.status.get(name, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def report(self):
+        """
+        :return: a list of dict (method, endpoint and statistics) sorted by total time spent
+        """
+        with self._lock:
+            report = []
+            for (method, endpoint), stats in self._stats.items():
+                entry = stats.as_dict()
+                entry['method'] = method
+                entry['endpoint'] = endpoint
+                report.append(entry)
+        return sorted(report, key=lambda e: e['total_time'], reverse=True)
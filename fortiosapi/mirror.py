@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# mirror.py copies the CMDB of Fortigates in a local SQLite
+# database to query it without loading the devices.
+#
+###################################################################
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import six
+
+LOG = logging.getLogger('fortiosapi')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device TEXT PRIMARY KEY, version TEXT, vdoms TEXT, taken REAL, elapsed REAL,
+    tables INTEGER, objects INTEGER, errors INTEGER);
+CREATE TABLE IF NOT EXISTS tables (
+    device TEXT, vdom TEXT, path TEXT, name TEXT, objects INTEGER, error TEXT,
+    PRIMARY KEY (device, vdom, path, name));
+CREATE TABLE IF NOT EXISTS objects (
+    device TEXT, vdom TEXT, path TEXT, name TEXT, mkey TEXT, data TEXT,
+    PRIMARY KEY (device, vdom, path, name, mkey));
+CREATE INDEX IF NOT EXISTS objects_mkey ON objects (path, name, mkey);
+CREATE TABLE IF NOT EXISTS refs (
+    device TEXT, vdom TEXT, path TEXT, name TEXT, mkey TEXT, field TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS refs_value ON refs (value, field);
+CREATE INDEX IF NOT EXISTS refs_object ON refs (device, vdom, path, name, mkey);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    device TEXT, vdom TEXT, path TEXT, name TEXT, digest TEXT,
+    PRIMARY KEY (device, vdom, path, name));
+CREATE TABLE IF NOT EXISTS checksums (
+    device TEXT, scope TEXT, checksum TEXT, PRIMARY KEY (device, scope));
+"""
+
+
+def _references(entry):
+    """
+    (field, value) of the member lists of an entry (srcaddr, service,
+    member...), the values are the names of the members.
+    """
+    for field, value in entry.items():
+        if not isinstance(value, list):
+            continue
+        for member in value:
+            if isinstance(member, dict):
+                member = member.get('name', member.get('q_origin_key'))
+            if isinstance(member, (six.string_types, int)):
+                yield field, six.text_type(member)
+
+
+def _where(**columns):
+    # sql where clause and arguments of the columns not None
+    clauses = []
+    args = []
+    for column, value in sorted(columns.items()):
+        if value is not None:
+            clauses.append('%s = ?' % column)
+            args.append(six.text_type(value))
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', args
+
+
+class CMDBMirror(object):
+    """
+    Local SQLite copy of the CMDB of one or many Fortigates, keyed by
+    device, vdom, path, name and mkey (empty for the settings), to answer
+    inventory questions locally. A snapshot enumerates the cmdb tables with
+    one schema call, reads them concurrently (workers tables at a time,
+    paged with iter_table) and updates the copy of the device in one
+    transaction. refresh only reads the vdoms whose config checksum changed.
+
+    mirror = CMDBMirror('/var/lib/fortiosapi/cmdb.sqlite')
+    mirror.snapshot(fgt)
+    for obj in mirror.find('HTTPS', path='firewall', name='policy', field='service'):
+        print(obj['device'], obj['vdom'], obj['mkey'])
+
+    :param database: SQLite file name, ':memory:' by default
+    :param workers: number of tables read at the same time
+    :param page_size: entries per GET of the big tables
+    """
+
+    def __init__(self, database=':memory:', workers=8, page_size=1000):
+        self.database = database
+        self.workers = workers
+        self.page_size = page_size
+        # the connection is used by one thread at a time
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(database, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # snapshot
+
+    @staticmethod
+    def _vdoms(client, vdoms):
+        if vdoms is not None:
+            return list(vdoms)
+        resp = client.get('system', 'vdom', vdom='global')
+        if isinstance(resp, dict) and resp.get('status') == 'success' and resp.get('results'):
+            return [vdom['name'] for vdom in resp['results']]
+        return ['root']
+
+    @staticmethod
+    def _checksums(client):
+        """
+        :return: the config checksum of global and of each vdom given by
+                 monitor system/ha-checksums, {} if the device does not give them
+        """
+        try:
+            resp = client.monitor('system', 'ha-checksums', vdom='global')
+        except Exception as e:
+            LOG.debug("no config checksums on %s: %s", client.host, e)
+            return {}
+        if not isinstance(resp, dict) or resp.get('status') != 'success':
+            return {}
+        members = resp.get('results') or []
+        if isinstance(members, dict):
+            members = [members]
+        for member in members:
+            # the primary has the config of the cluster
+            if member.get('is_manage_master'):
+                return dict(member.get('checksum') or {})
+        return dict(members[0].get('checksum') or {}) if members else {}
+
+    def _plan(self, client, vdoms, tables):
+        """
+        :return: (version, vdoms, checksums, list of (vdom, path, name, mkey name or None))
+        """
+        # checksums first: a change done while the tables are read is seen next time
+        checksums = self._checksums(client)
+        vdoms = self._vdoms(client, vdoms)
+        jobs = []
+        for schema in client.cmdb_schemas():
+            path, name = schema['path'], schema['name']
+            if tables is not None and (path, name) not in tables:
+                continue
+            mkeyname = schema.get('mkey') if schema.get('category') == 'table' else None
+            if schema.get('scope') == 'global':
+                jobs.append(('global', path, name, mkeyname))
+            else:
+                jobs.extend((vdom, path, name, mkeyname) for vdom in vdoms)
+        return client.get_version(), vdoms, checksums, jobs
+
+    def _fetch(self, client, device, vdom, path, name, mkeyname):
+        # rows of the objects and refs tables of a cmdb table and its fingerprint
+        objects = []
+        refs = []
+        digest = hashlib.sha1()
+        for entry in client.iter_table(path, name, vdom=vdom, page_size=self.page_size, prefetch=False):
+            if mkeyname is None:
+                mkey = ''
+            else:
+                mkey = six.text_type(entry.get(mkeyname, entry.get('q_origin_key', '')))
+            data = json.dumps(entry, sort_keys=True)
+            digest.update(data.encode('utf-8') + b'\n')
+            objects.append((device, vdom, path, name, mkey, data))
+            refs.extend((device, vdom, path, name, mkey, field, value) for field, value in _references(entry))
+        return objects, refs, digest.hexdigest()
+
+    def _delete(self, device, vdom=None, path=None, name=None):
+        where, args = _where(device=device, vdom=vdom, path=path, name=name)
+        for table in ('objects', 'refs', 'tables', 'fingerprints'):
+            self._db.execute('DELETE FROM %s%s' % (table, where), args)
+
+    def _write(self, device, vdom, path, name, objects, refs, digest):
+        self._delete(device, vdom, path, name)
+        self._db.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)', objects)
+        self._db.executemany('INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?, ?)', refs)
+        self._db.execute('INSERT INTO tables VALUES (?, ?, ?, ?, ?, ?)',
+                         (device, vdom, path, name, len(objects), None))
+        self._db.execute('INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?)', (device, vdom, path, name, digest))
+
+    def _failed(self, device, vdom, path, name, error):
+        # the objects read before are kept, the table is read again next time
+        self._db.execute('DELETE FROM fingerprints WHERE device = ? AND vdom = ? AND path = ? AND name = ?',
+                         (device, vdom, path, name))
+        count = self._db.execute('SELECT COUNT(*) FROM objects WHERE device = ? AND vdom = ? AND path = ? '
+                                 'AND name = ?', (device, vdom, path, name)).fetchone()[0]
+        self._db.execute('INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?, ?, ?)',
+                         (device, vdom, path, name, count, error))
+
+    def _stored(self, device):
+        fingerprints = dict(((vdom, path, name), digest) for vdom, path, name, digest in self._db.execute(
+            'SELECT vdom, path, name, digest FROM fingerprints WHERE device = ?', (device,)))
+        checksums = dict(self._db.execute('SELECT scope, checksum FROM checksums WHERE device = ?', (device,)))
+        return fingerprints, checksums
+
+    def _snapshot(self, clients, vdoms, tables, incremental=False):
+        results = OrderedDict()
+        executor = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        try:
+            plans = OrderedDict((device, executor.submit(self._plan, client, vdoms, tables))
+                                for device, client in clients)
+            fetches = {}
+            fingerprints = {}
+            alljobs = {}
+            for device, client in clients:
+                start = time.time()
+                try:
+                    version, device_vdoms, checksums, jobs = plans[device].result()
+                except Exception as e:
+                    # the previous snapshot of the device is kept
+                    LOG.warning("snapshot of %s failed: %s", device, e)
+                    results[device] = {'error': e}
+                    continue
+                stats = results[device] = {'version': version, 'vdoms': device_vdoms, 'start': start,
+                                           'checksums': checksums, 'failed': set(), 'tables': 0,
+                                           'objects': 0, 'errors': 0, 'changed': 0, 'skipped': 0}
+                alljobs[device] = jobs
+                with self._lock:
+                    fingerprints[device], stored = self._stored(device)
+                for job in jobs:
+                    if incremental and job[:3] in fingerprints[device] and \
+                            checksums.get(job[0]) is not None and checksums[job[0]] == stored.get(job[0]):
+                        stats['skipped'] += 1
+                        continue
+                    fetches[executor.submit(self._fetch, client, device, *job)] = (device,) + job[:3]
+            # the tables are read without the lock, only the changed ones are kept for the writes
+            writes = []
+            for future in as_completed(fetches):
+                device, vdom, path, name = fetches[future]
+                stats = results[device]
+                try:
+                    objects, refs, digest = future.result()
+                except Exception as e:
+                    LOG.debug("snapshot of %s %s/%s vdom %s failed: %s", device, path, name, vdom, e)
+                    writes.append((self._failed, (device, vdom, path, name, str(e))))
+                    stats['errors'] += 1
+                    stats['failed'].add(vdom)
+                    continue
+                stats['tables'] += 1
+                stats['objects'] += len(objects)
+                if fingerprints[device].get((vdom, path, name)) != digest:
+                    writes.append((self._write, (device, vdom, path, name, objects, refs, digest)))
+                    stats['changed'] += 1
+            with self._lock, self._db:
+                if vdoms is None and tables is None:
+                    for device, jobs in alljobs.items():
+                        # tables (or vdoms) which no longer exist
+                        current = set(job[:3] for job in jobs)
+                        for key in list(self._db.execute('SELECT vdom, path, name FROM tables WHERE device = ?',
+                                                         (device,))):
+                            if tuple(key) not in current:
+                                self._delete(device, *key)
+                for write, args in writes:
+                    write(*args)
+                now = time.time()
+                for device, stats in results.items():
+                    if 'error' in stats:
+                        continue
+                    stats['elapsed'] = now - stats.pop('start')
+                    failed = stats.pop('failed')
+                    for scope, checksum in stats.pop('checksums').items():
+                        if scope in failed:
+                            self._db.execute('DELETE FROM checksums WHERE device = ? AND scope = ?',
+                                             (device, scope))
+                        else:
+                            self._db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?)',
+                                             (device, scope, checksum))
+                    count, objects = self._db.execute('SELECT COUNT(*), SUM(objects) FROM tables WHERE device = ?',
+                                                      (device,)).fetchone()
+                    self._db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (device, stats['version'], json.dumps(stats['vdoms']), now,
+                                      stats['elapsed'], count, objects or 0, stats['errors']))
+        finally:
+            executor.shutdown(wait=True)
+        return results
+
+    def snapshot(self, client, device=None, vdoms=None, tables=None):
+        """
+        Read all the tables of a device and update its copy.
+        Tables which can not be read (not supported in a vdom...) are
+        recorded with their error in the tables table.
+
+        :param client: a logged FortiOSAPI
+        :param device: name of the device in the mirror, the host by default
+        :param vdoms: list of vdoms to copy, all by default
+        :param tables: list of (path, name) to copy, all by default
+        :return: dict of version, vdoms, tables (read), objects (read), changed
+                 (tables written), errors (tables failed), skipped and elapsed
+        """
+        device = device or client.host
+        stats = self._snapshot([(device, client)], vdoms, tables)[device]
+        if 'error' in stats:
+            raise stats['error']
+        return stats
+
+    def refresh(self, client, device=None, vdoms=None, tables=None):
+        """
+        Incremental snapshot: the tables of global or of a vdom whose config
+        checksum (monitor system/ha-checksums) did not change since the
+        previous snapshot are not read (skipped), the tables read are only
+        written when their fingerprint (a hash of their content) changed.
+        Without checksums on the device all the tables are read.
+
+        :return: see snapshot
+        """
+        device = device or client.host
+        stats = self._snapshot([(device, client)], vdoms, tables, incremental=True)[device]
+        if 'error' in stats:
+            raise stats['error']
+        return stats
+
+    def snapshot_fleet(self, fleet, vdoms=None, tables=None, incremental=False):
+        """
+        Snapshot (or refresh with incremental) the logged devices of a
+        FortiOSFleet, sharing the workers.
+
+        :return: dict host: stats (see snapshot) or {'error': exception}
+        """
+        return self._snapshot([(host, client) for host, client in fleet.clients.items() if client._logged],
+                              vdoms, tables, incremental)
+
+    # queries
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def devices(self):
+        """
+        :return: list of dict device, version, vdoms, taken (timestamp), elapsed,
+                 tables, objects, errors of the snapshots
+        """
+        rows = self._query('SELECT * FROM devices ORDER BY device', [])
+        return [dict(zip(('device', 'version', 'vdoms', 'taken', 'elapsed', 'tables', 'objects', 'errors'),
+                         row[:2] + (json.loads(row[2]),) + row[3:])) for row in rows]
+
+    def tables(self, device=None, vdom=None, errors=False):
+        """
+        :param errors: only the tables which could not be read
+        :return: list of dict device, vdom, path, name, objects, error
+        """
+        where, args = _where(device=device, vdom=vdom)
+        if errors:
+            where += (' AND ' if where else ' WHERE ') + 'error IS NOT NULL'
+        rows = self._query('SELECT * FROM tables%s ORDER BY device, vdom, path, name' % where, args)
+        return [dict(zip(('device', 'vdom', 'path', 'name', 'objects', 'error'), row)) for row in rows]
+
+    def objects(self, path=None, name=None, mkey=None, device=None, vdom=None):
+        """
+        The mirrored objects matching the arguments not None, "which
+        devices have the address X" is objects('firewall', 'address', 'X').
+
+        :return: list of dict device, vdom, path, name, mkey and data (the object)
+        """
+        where, args = _where(device=device, vdom=vdom, path=path, name=name, mkey=mkey)
+        rows = self._query('SELECT * FROM objects%s ORDER BY device, vdom, path, name, mkey' % where, args)
+        return [{'device': row[0], 'vdom': row[1], 'path': row[2], 'name': row[3], 'mkey': row[4],
+                 'data': json.loads(row[5])} for row in rows]
+
+    def get(self, device, path, name, mkey='', vdom='root'):
+        """
+        :return: one mirrored object (settings have the mkey '') or None
+        """
+        rows = self._query('SELECT data FROM objects WHERE device = ? AND vdom = ? AND path = ? AND name = ? '
+                           'AND mkey = ?', [device, vdom, path, name, six.text_type(mkey)])
+        return json.loads(rows[0][0]) if rows else None
+
+    def find(self, value, path=None, name=None, field=None, device=None, vdom=None):
+        """
+        The objects having value in a member list, "all the policies using
+        the service Y" is find('Y', 'firewall', 'policy', field='service').
+
+        :param field: the member list (srcaddr, member...), any by default
+        :return: list of dict device, vdom, path, name, mkey, field and data
+        """
+        where, args = _where(**{'r.device': device, 'r.vdom': vdom, 'r.path': path, 'r.name': name,
+                                'r.field': field, 'r.value': value})
+        rows = self._query('SELECT DISTINCT r.device, r.vdom, r.path, r.name, r.mkey, r.field, o.data '
+                           'FROM refs r JOIN objects o ON o.device = r.device AND o.vdom = r.vdom '
+                           'AND o.path = r.path AND o.name = r.name AND o.mkey = r.mkey%s '
+                           'ORDER BY r.device, r.vdom, r.path, r.name, r.mkey' % where, args)
+        return [{'device': row[0], 'vdom': row[1], 'path': row[2], 'name': row[3], 'mkey': row[4],
+                 'field': row[5], 'data': json.loads(row[6])} for row in rows]
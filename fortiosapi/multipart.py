@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# multipart.py builds multipart/form-data upload bodies read chunk
+# by chunk from the files instead of in memory.
+#
+###################################################################
+
+import hashlib
+import os
+import uuid
+
+import six
+
+CRLF = b'\r\n'
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return six.text_type(value).encode('utf-8')
+
+
+def _size(fileobj):
+    # bytes left to read in a file, mmap or BytesIO
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError, IOError):
+        position = fileobj.tell()
+        fileobj.seek(0, 2)
+        end = fileobj.tell()
+        fileobj.seek(position)
+        return end - position
+
+
+class MultipartStream(object):
+    """
+    multipart/form-data body given to requests as a file like object: its
+    length is known in advance and the file contents are read chunk_size
+    bytes at a time while sending, so many uploads of big files (firmware)
+    can run at the same time with a bounded memory.
+
+    stream = MultipartStream(files={'file': '/tmp/FGT_VM64-v6-build1066.out'},
+                             progress=lambda sent, total: None)
+    fgt.upload('system', 'firmware/upgrade', data=stream, parameters={'source': 'upload'})
+    stream.checksums['file']
+
+    :param files: dict field: file name, file object (or mmap), or a tuple
+                  (filename, file name or file object[, content type])
+    :param fields: dict of the other form fields
+    :param chunk_size: bytes read at a time from the files
+    :param progress: function(bytes sent, total bytes) called after each chunk
+    :param checksum: hashlib algorithm computed on each file content or None,
+                     the hex digests are in checksums once sent
+    """
+
+    def __init__(self, files, fields=None, chunk_size=65536, progress=None, checksum='sha256'):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.checksum = checksum
+        self.checksums = {}
+        self.sent = 0
+        self._parts = []
+        for key, value in (fields or {}).items():
+            header = ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (self.boundary, key))
+            self._parts.append((_bytes(header) + _bytes(value) + CRLF, None, None, 0))
+        for field, value in files.items():
+            content_type = 'application/octet-stream'
+            if isinstance(value, (tuple, list)):
+                filename, source = value[0], value[1]
+                if len(value) > 2:
+                    content_type = value[2]
+            else:
+                source = value
+                filename = os.path.basename(value) if isinstance(value, six.string_types) else \
+                    os.path.basename(getattr(value, 'name', field))
+            if isinstance(source, six.string_types):
+                size = os.path.getsize(source)
+            else:
+                size = _size(source)
+            header = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: %s\r\n\r\n' % (self.boundary, field, filename, content_type))
+            self._parts.append((_bytes(header), field, source, size))
+        self._end = _bytes('--%s--\r\n' % self.boundary)
+        self.length = sum(len(header) + size + (2 if source is not None else 0)
+                          for header, field, source, size in self._parts) + len(self._end)
+        self._chunks = None
+        self._buffer = b''
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self.length
+
+    def _read_file(self, field, source, size):
+        digest = hashlib.new(self.checksum) if self.checksum else None
+        fileobj = open(source, 'rb') if isinstance(source, six.string_types) else source
+        try:
+            left = size
+            while left > 0:
+                chunk = fileobj.read(min(self.chunk_size, left))
+                if not chunk:
+                    raise IOError("%s is shorter than announced" % field)
+                left -= len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                yield chunk
+        finally:
+            if fileobj is not source:
+                fileobj.close()
+        if digest is not None:
+            self.checksums[field] = digest.hexdigest()
+
+    def __iter__(self):
+        for header, field, source, size in self._parts:
+            yield header
+            if source is not None:
+                for chunk in self._read_file(field, source, size):
+                    yield chunk
+                yield CRLF
+        yield self._end
+
+    def read(self, size=-1):
+        """
+        Read at most size bytes of the body (used by requests/urllib3 to send it)
+        """
+        if self._chunks is None:
+            self._chunks = iter(self)
+        data = self._buffer
+        while size < 0 or len(data) < size:
+            try:
+                data += next(self._chunks)
+            except StopIteration:
+                break
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b''
+        if data:
+            self.sent += len(data)
+            if self.progress is not None:
+                self.progress(self.sent, self.length)
+        return data
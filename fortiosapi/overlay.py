@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# overlay.py compares an overlay yaml tree (see setoverlayconfig)
+# with the running configuration to only push what changed.
+#
+###################################################################
+
+import copy
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger('fortiosapi')
+
+_CIDR = re.compile(r'^(\d{1,3}(?:\.\d{1,3}){3})/(\d{1,2})$')
+
+
+def _cidr_to_mask(value):
+    # the API answers subnets as "ip mask", overlays often use "ip/len"
+    match = _CIDR.match(value)
+    if not match or int(match.group(2)) > 32:
+        return value
+    bits = (0xffffffff << (32 - int(match.group(2)))) & 0xffffffff
+    mask = '.'.join(str((bits >> shift) & 0xff) for shift in (24, 16, 8, 0))
+    return match.group(1) + ' ' + mask
+
+
+def normalize(value):
+    """
+    Normalize a scalar as a string without repeated/edge spaces,
+    numbers and numeric strings are equal, subnets are in "ip mask" form.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'enable' if value else 'disable'
+    value = ' '.join(str(value).split())
+    return _cidr_to_mask(value)
+
+
+def _project(current, desired):
+    # keep only the parts of current which are described in desired
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return normalize(current)
+        return dict((k, _project(current.get(k), v)) for k, v in desired.items())
+    if isinstance(desired, list):
+        if not isinstance(current, list):
+            return normalize(current)
+        keys = {}
+        for item in desired:
+            if isinstance(item, dict):
+                keys.update(item)
+        return sorted(json.dumps(_project(c, keys) if isinstance(c, dict) else normalize(c), sort_keys=True)
+                      for c in current)
+    return normalize(current)
+
+
+def _canonical(desired):
+    if isinstance(desired, dict):
+        return dict((k, _canonical(v)) for k, v in desired.items())
+    if isinstance(desired, list):
+        keys = {}
+        for item in desired:
+            if isinstance(item, dict):
+                keys.update(item)
+        # missing keys in an item are compared as empty like the projection of current does
+        return sorted(json.dumps(_canonical(dict((k, d.get(k)) for k in keys)) if isinstance(d, dict)
+                                 else normalize(d), sort_keys=True)
+                      for d in desired)
+    return normalize(desired)
+
+
+def changed_fields(desired, current):
+    """
+    Compare a desired object with the current one from the API.
+    Only the fields of desired are checked, fields added by the API
+    (q_origin_key, defaults..) are ignored as well as the order of list members.
+
+    :param desired: dict of the wanted values
+    :param current: dict returned by a GET or None if the object does not exist
+    :return: list of the fields of desired which differ
+    """
+    if current is None:
+        return list(desired)
+    return [field for field, value in desired.items()
+            if _canonical(value) != _project(current.get(field), value)]
+
+
+def _results(resp):
+    if not isinstance(resp, dict) or resp.get('status') != 'success':
+        return None
+    results = resp.get('results')
+    return results
+
+
+class OverlayPlan(object):
+    """
+    List of the actions needed to apply an overlay, each one a dict with
+    action (create, update or skip), name, path, mkey, data and changes (fields to change).
+    name/path are in the order of the set calls: cmdb/<name>/<path>.
+    """
+
+    def __init__(self):
+        self.actions = []
+        self.failed = 0
+        self.results = []
+
+    def add(self, action, name, path, mkey, data, changes):
+        self.actions.append({'action': action, 'name': name, 'path': path,
+                             'mkey': mkey, 'data': data, 'changes': changes})
+
+    def count(self, action):
+        return sum(1 for a in self.actions if a['action'] == action)
+
+    @property
+    def created(self):
+        return self.count('create')
+
+    @property
+    def updated(self):
+        return self.count('update')
+
+    @property
+    def skipped(self):
+        return self.count('skip')
+
+    def changes(self):
+        return [a for a in self.actions if a['action'] != 'skip']
+
+    def summary(self):
+        return {'created': self.created, 'updated': self.updated, 'skipped': self.skipped,
+                'failed': self.failed}
+
+    def __repr__(self):
+        return "OverlayPlan(%s)" % self.summary()
+
+
+def overlay_reads(settings, tables):
+    """
+    The reads needed to plan an overlay split by splitoverlay: one GET per
+    settings object or table (and its mkey name for a table).
+
+    :return: list of (name, path, is_table)
+    """
+    reads = [(name, path, False) for name in settings for path in settings[name] if settings[name][path]]
+    return reads + [(name, path, True) for name in tables for path in tables[name]]
+
+
+def build_plan(settings, tables, answers, mkeynames):
+    """
+    Compare an overlay split by splitoverlay with the answers of its reads.
+
+    :param answers: dict (name, path): formatted GET response of each read
+    :param mkeynames: dict (name, path): mkey name of each table
+    :return: an OverlayPlan
+    """
+    plan = OverlayPlan()
+    for name in settings:
+        for path in settings[name]:
+            desired = settings[name][path]
+            if not desired:
+                continue
+            current = _results(answers[(name, path)])
+            if isinstance(current, list):
+                current = current[0] if current else None
+            changes = changed_fields(desired, current)
+            plan.add('update' if changes else 'skip', name, path, None, desired, changes)
+
+    for name in tables:
+        for path in tables[name]:
+            entries = tables[name][path]
+            mkeyname = mkeynames[(name, path)]
+            current = _results(answers[(name, path)]) or []
+            if isinstance(current, dict):
+                current = [current]
+            index = {}
+            if mkeyname:
+                index = dict((normalize(obj.get(mkeyname)), obj) for obj in current)
+            for mkey, desired in entries.items():
+                existing = index.get(normalize(mkey))
+                if existing is None:
+                    plan.add('create', name, path, mkey, desired, list(desired))
+                else:
+                    changes = changed_fields(desired, existing)
+                    plan.add('update' if changes else 'skip', name, path, mkey, desired, changes)
+    LOG.debug("overlay plan %s", plan)
+    return plan
+
+
+def plan_overlay(client, yamltree, vdom=None):
+    """
+    Compute the actions needed to apply an overlay with one GET per touched
+    table or settings object.
+
+    :param client: a logged FortiOSAPI
+    :param yamltree: the overlay tree as for setoverlayconfig (not modified)
+    :param vdom: the vdom on which you want to apply config or global for global settings
+    :return: an OverlayPlan
+    """
+    settings, tables = client.splitoverlay(copy.deepcopy(yamltree))
+    answers = {}
+    mkeynames = {}
+    for name, path, is_table in overlay_reads(settings, tables):
+        if is_table:
+            mkeynames[(name, path)] = client.get_mkeyname(name, path, vdom)
+        answers[(name, path)] = client.get(name, path, vdom=vdom)
+    return build_plan(settings, tables, answers, mkeynames)
+
+
+def set_plan(client, yamltree):
+    """
+    Plan setting every node of an overlay without reading the configuration
+    (the setoverlayconfig behaviour), all actions are set.
+
+    :return: an OverlayPlan
+    """
+    settings, tables = client.splitoverlay(copy.deepcopy(yamltree))
+    plan = OverlayPlan()
+    for name in settings:
+        for path in settings[name]:
+            if settings[name][path]:
+                plan.add('set', name, path, None, settings[name][path], list(settings[name][path]))
+    for name in tables:
+        for path in tables[name]:
+            for mkey, desired in tables[name][path].items():
+                plan.add('set', name, path, mkey, desired, list(desired))
+    return plan
+
+
+# tables where the entries order is meaningful, entries are pushed one after the other
+ORDERED_TABLES = ('firewall policy', 'firewall policy6', 'firewall policy46', 'firewall policy64',
+                  'firewall proxy-policy', 'firewall local-in-policy', 'firewall local-in-policy6',
+                  'firewall multicast-policy', 'firewall multicast-policy6', 'firewall shaping-policy',
+                  'firewall central-snat-map', 'firewall DoS-policy', 'firewall DoS-policy6',
+                  'router policy', 'router policy6', 'system sdwan', 'system virtual-wan-link')
+
+
+def _datasources(schema):
+    # all the datasource references (like firewall.address.name) of a schema tree
+    found = set()
+    stack = [schema]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for source in node.get('datasource') or []:
+                found.add(source)
+            children = node.get('children')
+            if isinstance(children, dict):
+                stack.extend(children.values())
+            elif isinstance(children, list):
+                stack.extend(children)
+    return found
+
+
+def schema_dependencies(tables, schemas):
+    """
+    Find which tables reference which other ones with the schema datasources.
+
+    :param tables: list of (name, path) as in the overlay (cmdb/<name>/<path>)
+    :param schemas: dict (name, path): schema of each table
+    :return: dict (name, path): set of the (name, path) of tables it references,
+             a table referencing itself is included
+    """
+    prefixes = dict(((name + '.' + path.replace('/', '.') + '.'), (name, path)) for name, path in tables)
+    dependencies = {}
+    for table in tables:
+        refs = set()
+        for source in _datasources(schemas[table]):
+            for prefix, target in prefixes.items():
+                if source.startswith(prefix):
+                    refs.add(target)
+        dependencies[table] = refs
+    return dependencies
+
+
+def table_dependencies(client, tables, vdom=None):
+    """
+    schema_dependencies reading the schemas with client
+    """
+    return schema_dependencies(tables, dict((table, client.schema(table[0], table[1], vdom=vdom))
+                                            for table in tables))
+
+
+def dependency_levels(dependencies, order):
+    """
+    Group the tables by level, a table is on a level after all the tables it references.
+    Tables of a cycle are put on a last level in the overlay order.
+
+    :param dependencies: as returned by table_dependencies
+    :param order: the tables in overlay order
+    :return: list of levels, each one a list of tables
+    """
+    remaining = list(order)
+    done = set()
+    levels = []
+    while remaining:
+        level = [t for t in remaining
+                 if all(dep in done or dep == t for dep in dependencies.get(t, ()))]
+        if not level:
+            LOG.warning("circular references between %s, pushed in overlay order", remaining)
+            level = remaining
+        levels.append(level)
+        done.update(level)
+        remaining = [t for t in remaining if t not in done]
+    return levels
+
+
+def push(client, action, vdom):
+    """
+    Do the call of an action with client (a coroutine to await with AsyncFortiOSAPI)
+
+    :return: the response of the call
+    """
+    data = dict(action['data'])
+    name, path, mkey = action['name'], action['path'], action['mkey']
+    if action['action'] == 'create':
+        return client.post(name, path, data, vdom=vdom, mkey=mkey)
+    if action['action'] == 'update':
+        if mkey is None:
+            return client.put(name, path, vdom=vdom, data=data)
+        return client.put(name, path, vdom=vdom, mkey=mkey, data=data)
+    return client.set(name, path, data=data, mkey=mkey, vdom=vdom)
+
+
+def record(plan, action, res, lock):
+    """
+    Keep the response of a pushed action in the plan.
+
+    :return: False if the action failed
+    """
+    with lock:
+        plan.results.append((action, res))
+        if not isinstance(res, dict) or res.get('status') != 'success':
+            LOG.warning("overlay %s of %s/%s %s failed: %s", action['action'], action['name'],
+                        action['path'], action['mkey'], res)
+            plan.failed += 1
+            return False
+    return True
+
+
+def _push_chain(client, plan, actions, vdom, lock):
+    # push actions one after the other, stop at the first failure
+    for action in actions:
+        if not record(plan, action, push(client, action, vdom), lock):
+            return False
+    return True
+
+
+def plan_parts(plan):
+    """
+    Split the changes of a plan in the settings (pushed first, one after the
+    other) and the table entries grouped by table in the plan order.
+
+    :return: (settings actions, entries actions, OrderedDict (name, path): actions)
+    """
+    actions = plan.changes()
+    settings = [a for a in actions if a['mkey'] is None]
+    entries = [a for a in actions if a['mkey'] is not None]
+    bytable = OrderedDict()
+    for action in entries:
+        bytable.setdefault((action['name'], action['path']), []).append(action)
+    return settings, entries, bytable
+
+
+def level_chains(level, bytable, dependencies):
+    """
+    The chains of actions of a level pushed concurrently, the entries of self
+    referencing or ordered tables (policies) are one chain keeping their order.
+    """
+    chains = []
+    for table in level:
+        if table in dependencies[table] or ' '.join(table) in ORDERED_TABLES:
+            chains.append(bytable[table])
+        else:
+            chains.extend([action] for action in bytable[table])
+    return chains
+
+
+def apply_overlay_plan(client, plan, vdom=None, concurrency=1):
+    """
+    Push the create/update/set actions of a plan, stop at the first failure.
+    The settings (no mkey) are pushed first, one after the other.
+    With concurrency > 1 the tables are ordered by their references (addresses
+    before groups before policies) and the entries of the tables of a same level
+    are pushed concurrently. Entries of self referencing or ordered tables
+    (policies) keep their order.
+
+    :return: the plan with results (list of (action, response)) and failed set
+    """
+    lock = threading.Lock()
+    settings, entries, bytable = plan_parts(plan)
+    if not _push_chain(client, plan, settings, vdom, lock):
+        return plan
+    if concurrency <= 1:
+        _push_chain(client, plan, entries, vdom, lock)
+        return plan
+
+    dependencies = table_dependencies(client, list(bytable), vdom=vdom)
+    levels = dependency_levels(dependencies, list(bytable))
+    LOG.debug("overlay levels %s", levels)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for level in levels:
+            chains = level_chains(level, bytable, dependencies)
+            futures = [executor.submit(_push_chain, client, plan, chain, vdom, lock) for chain in chains]
+            if not all([f.result() for f in futures]):
+                # next levels may reference what failed
+                break
+    return plan
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# policy.py decides when FortiOSAPI requests are sent again
+# (backoff, retry budget) and limits the request rate per host.
+#
+###################################################################
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+try:
+    from urllib3.exceptions import NewConnectionError
+except ImportError:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+
+LOG = logging.getLogger('fortiosapi')
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class TokenBucket(object):
+    """
+    Allow rate requests per second with bursts of burst requests.
+    With adaptive the rate is halved when the device says it is
+    overloaded and grows back slowly on success (AIMD).
+    """
+
+    def __init__(self, rate, burst=None, adaptive=True, min_rate=1.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.adaptive = adaptive
+        self.min_rate = min(min_rate, self.max_rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self):
+        """
+        Take a token, may go in debt.
+
+        :return: seconds to wait before sending
+        """
+        with self._lock:
+            self._refill(time.time())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def overloaded(self):
+        if not self.adaptive:
+            return
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        LOG.debug("request rate lowered to %.1f/s", self.rate)
+
+    def succeeded(self):
+        if self.adaptive and self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class RetryBudget(object):
+    """
+    Limit the retries to a ratio of the requests so that a device in
+    trouble does not receive retry storms: every request adds ratio to the
+    balance (up to the minimum plus ratio of the last 10 seconds requests),
+    every retry takes 1.
+    """
+
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.balance = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.minimum + self.ratio * 100)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class RequestPolicy(object):
+    """
+    Retry and rate limit policy applied by FortiOSAPI to every request.
+    It can be shared by many FortiOSAPI, the rate limit is per host.
+
+    Requests failing with a retry_statuses status, a connection error or a
+    timeout are sent again after a jittered exponential backoff (or the
+    Retry-After of the response). Non idempotent requests (POST) are only
+    sent again when the device did not process them: post_statuses or a
+    connection which could not be opened.
+    500 is not in the defaults: FortiOS uses it for errors like "entry exists".
+
+    :param retries: max number of times a request is sent again
+    :param backoff: first backoff in seconds, doubled at each retry
+    :param max_backoff: max backoff in seconds
+    :param retry_statuses: http status retried for idempotent requests
+    :param post_statuses: http status retried for POST
+    :param rate: max requests per second per host, None for no limit
+    :param burst: requests which can be sent at once, default rate
+    :param adaptive: lower the rate when the device answers 429/503
+    :param budget_ratio: retries allowed per request sent
+    :param budget_minimum: retries always allowed
+    """
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30.0, retry_statuses=(429, 502, 503, 504),
+                 post_statuses=(429, 503), rate=None, burst=None, adaptive=True,
+                 budget_ratio=0.2, budget_minimum=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.post_statuses = post_statuses
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.budget = RetryBudget(budget_ratio, budget_minimum)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'budget_exhausted': 0, 'throttled': 0.0}
+
+    def bucket(self, host):
+        if self.rate is None:
+            return None
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(host, TokenBucket(self.rate, self.burst, self.adaptive))
+        return bucket
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def reserve(self, host):
+        """
+        Account a request to host.
+
+        :return: seconds to wait before sending it
+        """
+        self._count('requests')
+        self.budget.deposit()
+        bucket = self.bucket(host)
+        if bucket is None:
+            return 0.0
+        delay = bucket.reserve()
+        if delay:
+            self._count('throttled', delay)
+        return delay
+
+    def acquire(self, host):
+        """
+        Wait for the rate limit of host before sending a request.
+        """
+        delay = self.reserve(host)
+        if delay:
+            time.sleep(delay)
+
+    @staticmethod
+    def _not_sent(error):
+        # the request never reached the device
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.exceptions.ConnectionError):
+            reason = getattr(error.args[0], 'reason', None) if error.args else None
+            return isinstance(reason, NewConnectionError)
+        return False
+
+    def _retryable(self, method, response, error, sent):
+        if error is not None:
+            if sent is None:
+                if self._not_sent(error):
+                    return True
+                return method in IDEMPOTENT_METHODS and isinstance(
+                    error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            return not sent or method in IDEMPOTENT_METHODS
+        if method in IDEMPOTENT_METHODS:
+            return response.status_code in self.retry_statuses
+        return response.status_code in self.post_statuses
+
+    def delay(self, attempt, response=None):
+        """
+        :return: seconds to wait before the retry number attempt (from 1)
+        """
+        if response is not None:
+            try:
+                return min(self.max_backoff, float(response.headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1))))
+
+    def retry(self, host, method, attempt, response=None, error=None, sent=None):
+        """
+        Decide if a request is sent again after a response or an exception,
+        update the host rate limit with the outcome.
+
+        :param attempt: number of retries already done
+        :param sent: for errors which are not from requests, whether the request
+                     may have reached the device (the error is then considered transient)
+        :return: seconds to wait before sending again or None to not retry
+        """
+        bucket = self.bucket(host)
+        if response is not None and response.status_code not in (429, 503):
+            if bucket is not None:
+                bucket.succeeded()
+            if response.status_code not in self.retry_statuses:
+                return None
+        elif bucket is not None:
+            bucket.overloaded()
+        if attempt >= self.retries or not self._retryable(method, response, error, sent):
+            return None
+        if not self.budget.withdraw():
+            self._count('budget_exhausted')
+            LOG.warning("retry budget exhausted, not sending %s again", method)
+            return None
+        self._count('retries')
+        return self.delay(attempt + 1, response)
+
+    def stats(self):
+        """
+        :return: dict of requests, retries, budget_exhausted, throttled (seconds waited)
+                 and the current rate per host
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats['rates'] = dict((host, bucket.rate) for host, bucket in self._buckets.items())
+        return stats
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# policylookup.py finds locally which firewall policy matches a
+# flow, from the policies, addresses, services and schedules.
+#
+###################################################################
+
+import datetime
+import logging
+import socket
+import struct
+from bisect import bisect_right
+
+import six
+
+LOG = logging.getLogger('fortiosapi')
+
+MAX_IP = 0xffffffff
+MAX_PORT = 0xffff
+PORT_PROTOCOLS = {'tcp': 6, 'udp': 17, 'sctp': 132}
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+_IP = struct.Struct('!I')
+
+
+def ip_to_int(ip):
+    return _IP.unpack(socket.inet_aton(ip))[0]
+
+
+def _names(value):
+    # member list [{'name': x}] or a string of names
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [m.get('name') if isinstance(m, dict) else m for m in value]
+    return six.text_type(value).split()
+
+
+def _enabled(policy, field):
+    return policy.get(field) == 'enable'
+
+
+def _subnet_range(subnet):
+    """
+    (first, last) ip of "ip mask" or "ip/len"
+    """
+    if isinstance(subnet, list):
+        subnet = ' '.join(subnet)
+    if '/' in subnet:
+        ip, length = subnet.split('/', 1)
+        bits = (MAX_IP << (32 - int(length))) & MAX_IP
+    else:
+        ip, mask = subnet.split()
+        bits = ip_to_int(mask)
+    first = ip_to_int(ip) & bits
+    return first, first | (~bits & MAX_IP)
+
+
+def _ip_range(value):
+    # "a.b.c.d" or "a.b.c.d-e.f.g.h"
+    if '-' in value:
+        first, last = value.split('-', 1)
+        return ip_to_int(first.strip()), ip_to_int(last.strip())
+    ip = ip_to_int(value.strip())
+    return ip, ip
+
+
+def _port_ranges(value):
+    # "80 443 1000-2000 53:1024" (destination[:source]), the source ports are ignored
+    ranges = []
+    for item in six.text_type(value or '').split():
+        item = item.split(':', 1)[0]
+        if '-' in item:
+            low, high = item.split('-', 1)
+            ranges.append((int(low), int(high)))
+        elif item:
+            ranges.append((int(item), int(item)))
+    return ranges
+
+
+class _Intervals(object):
+    """
+    Sorted elementary segments of a 0..maximum domain, each with the
+    bitset (python int) of the policies having a range covering it.
+    """
+
+    def __init__(self, ranges, maximum):
+        # ranges: list of (first, last, bit)
+        events = {}
+        for first, last, bit in ranges:
+            events.setdefault(first, []).append((bit, 1))
+            if last < maximum:
+                events.setdefault(last + 1, []).append((bit, -1))
+        counts = {}
+        bits = 0
+        self.bounds = [0]
+        self.sets = [0]
+        for position in sorted(events):
+            for bit, delta in events[position]:
+                count = counts.get(bit, 0) + delta
+                counts[bit] = count
+                if count:
+                    bits |= bit
+                else:
+                    bits &= ~bit
+            if position == self.bounds[-1]:
+                self.sets[-1] = bits
+            else:
+                self.bounds.append(position)
+                self.sets.append(bits)
+
+    def __call__(self, value):
+        return self.sets[bisect_right(self.bounds, value) - 1]
+
+
+class PolicyLookup(object):
+    """
+    Local evaluation of the firewall policies of a vdom: which policy (the
+    first one in the policy order) accepts or denies a flow (srcintf,
+    dstintf, src ip, dst ip, protocol number, destination port).
+
+    Address groups, service groups and schedule groups are flattened once
+    (memoized), then each dimension is compiled in sorted intervals or a
+    dict giving the bitset of the policies matching a value: a lookup is a
+    bisect or a dict get per dimension and an AND of python ints, the first
+    matching policy is the lowest bit. Flows of a batch share the per value
+    results.
+
+    engine = PolicyLookup.from_client(fgt, vdom='root')
+    engine.lookup_many([('port1', 'port2', '10.0.0.1', '8.8.8.8', 6, 443), ...])
+
+    IPv4 only. Addresses which can not be evaluated offline (fqdn,
+    geography, dynamic) match nothing and are listed in unsupported.
+
+    :param policies: firewall policy entries in the policy order
+    :param addresses: firewall address entries
+    :param addrgrps: firewall addrgrp entries
+    :param vips: firewall vip entries, matched on their external ip
+    :param services: firewall.service custom entries
+    :param service_groups: firewall.service group entries
+    :param schedules: firewall.schedule recurring and onetime entries
+    :param schedule_groups: firewall.schedule group entries
+    :param zones: system zone entries, an interface matches the policies of its zone
+    """
+
+    def __init__(self, policies, addresses=(), addrgrps=(), vips=(), services=(), service_groups=(),
+                 schedules=(), schedule_groups=(), zones=()):
+        self.policies = [p for p in policies if p.get('status', 'enable') != 'disable']
+        self.unsupported = set()
+        self._addresses = dict((a.get('name'), a) for a in addresses)
+        self._addrgrps = dict((g.get('name'), g) for g in addrgrps)
+        self._vips = dict((v.get('name'), v) for v in vips)
+        self._services = dict((s.get('name'), s) for s in services)
+        self._service_groups = dict((g.get('name'), g) for g in service_groups)
+        self._schedules = dict((s.get('name'), s) for s in schedules)
+        self._schedule_groups = dict((g.get('name'), g) for g in schedule_groups)
+        self._zone_of = {}
+        for zone in zones:
+            for intf in _names(zone.get('interface')):
+                self._zone_of[intf] = zone.get('name')
+        self._address_memo = {}
+        self._service_memo = {}
+        self._compile()
+
+    @classmethod
+    def from_client(cls, client, vdom=None):
+        """
+        Read the policies and the objects they use from a logged FortiOSAPI
+        """
+        def table(path, name):
+            resp = client.get(path, name, vdom=vdom)
+            if isinstance(resp, dict) and resp.get('status') == 'success':
+                return resp.get('results') or []
+            LOG.debug("no %s/%s for the policy lookup: %s", path, name, resp)
+            return []
+
+        schedules = table('firewall.schedule', 'recurring') + table('firewall.schedule', 'onetime')
+        return cls(table('firewall', 'policy'), addresses=table('firewall', 'address'),
+                   addrgrps=table('firewall', 'addrgrp'), vips=table('firewall', 'vip'),
+                   services=table('firewall.service', 'custom'),
+                   service_groups=table('firewall.service', 'group'), schedules=schedules,
+                   schedule_groups=table('firewall.schedule', 'group'),
+                   zones=table('system', 'zone'))
+
+    # objects flattening
+
+    def _address_ranges(self, name, seen=()):
+        ranges = self._address_memo.get(name)
+        if ranges is not None:
+            return ranges
+        ranges = []
+        if name in self._addrgrps:
+            if name in seen:
+                LOG.warning("address group %s contains itself", name)
+                return []
+            for member in _names(self._addrgrps[name].get('member')):
+                ranges.extend(self._address_ranges(member, seen + (name,)))
+        elif name in self._vips:
+            extip = self._vips[name].get('extip')
+            if extip:
+                ranges.append(_ip_range(extip))
+        elif name in self._addresses:
+            address = self._addresses[name]
+            kind = address.get('type', 'ipmask')
+            try:
+                if kind == 'iprange':
+                    ranges.append((ip_to_int(address['start-ip']), ip_to_int(address['end-ip'])))
+                elif kind == 'ipmask' and address.get('subnet'):
+                    ranges.append(_subnet_range(address['subnet']))
+                else:
+                    self.unsupported.add(name)
+            except (KeyError, ValueError, socket.error):
+                self.unsupported.add(name)
+        elif name == 'all':
+            ranges.append((0, MAX_IP))
+        else:
+            self.unsupported.add(name)
+        self._address_memo[name] = ranges
+        return ranges
+
+    def _service_entries(self, name, seen=()):
+        """
+        :return: list of (protocol number or None for any, first port, last port)
+        """
+        entries = self._service_memo.get(name)
+        if entries is not None:
+            return entries
+        entries = []
+        if name in self._service_groups:
+            if name in seen:
+                LOG.warning("service group %s contains itself", name)
+                return []
+            for member in _names(self._service_groups[name].get('member')):
+                entries.extend(self._service_entries(member, seen + (name,)))
+        elif name in self._services:
+            service = self._services[name]
+            protocol = service.get('protocol', 'TCP/UDP/SCTP')
+            if protocol == 'TCP/UDP/SCTP':
+                for field, number in PORT_PROTOCOLS.items():
+                    for first, last in _port_ranges(service.get(field + '-portrange')):
+                        entries.append((number, first, last))
+            elif protocol in ('ICMP', 'ICMP6'):
+                entries.append((1 if protocol == 'ICMP' else 58, 0, MAX_PORT))
+            elif protocol in ('IP', 'ALL'):
+                number = int(service.get('protocol-number') or 0)
+                entries.append((number or None, 0, MAX_PORT))
+            else:
+                self.unsupported.add(name)
+        elif name == 'ALL':
+            entries.append((None, 0, MAX_PORT))
+        else:
+            self.unsupported.add(name)
+        self._service_memo[name] = entries
+        return entries
+
+    def _schedule_active(self, name, when, seen=()):
+        if name == 'always' and name not in self._schedules:
+            return True
+        if name in self._schedule_groups:
+            if name in seen:
+                return False
+            return any(self._schedule_active(m, when, seen + (name,))
+                       for m in _names(self._schedule_groups[name].get('member')))
+        schedule = self._schedules.get(name)
+        if schedule is None:
+            return False
+        start, end = schedule.get('start', '00:00'), schedule.get('end', '00:00')
+        if 'day' in schedule or ' ' not in start:
+            # recurring: days and hh:mm, an end before the start ends the next day
+            days = _names(schedule.get('day')) or list(DAYS)
+            now = when.strftime('%H:%M')
+            today = DAYS[when.weekday()]
+            if start < end or start == end == '00:00':
+                return today in days and (start <= now < end or start == end)
+            yesterday = DAYS[(when.weekday() - 1) % 7]
+            return (today in days and now >= start) or (yesterday in days and now < end)
+        # onetime: "hh:mm yyyy/mm/dd"
+        try:
+            return (datetime.datetime.strptime(start, '%H:%M %Y/%m/%d') <= when <=
+                    datetime.datetime.strptime(end, '%H:%M %Y/%m/%d'))
+        except ValueError:
+            return False
+
+    # compilation
+
+    def _compile(self):
+        src, dst, ports = [], [], {}
+        self._srcneg = self._dstneg = self._servneg = 0
+        self._src_intf, self._dst_intf = {}, {}
+        self._proto = {}
+        self._proto_any = 0
+        self.mask = 0
+        for index, policy in enumerate(self.policies):
+            bit = 1 << index
+            self.mask |= bit
+            for field, intfs in (('srcintf', self._src_intf), ('dstintf', self._dst_intf)):
+                for intf in _names(policy.get(field)):
+                    intfs[intf] = intfs.get(intf, 0) | bit
+            for field, ranges in (('srcaddr', src), ('dstaddr', dst)):
+                for name in _names(policy.get(field)):
+                    ranges.extend((first, last, bit) for first, last in self._address_ranges(name))
+            for name in _names(policy.get('service')):
+                for protocol, first, last in self._service_entries(name):
+                    if protocol is None:
+                        self._proto_any |= bit
+                    elif protocol in PORT_PROTOCOLS.values():
+                        ports.setdefault(protocol, []).append((first, last, bit))
+                    else:
+                        self._proto[protocol] = self._proto.get(protocol, 0) | bit
+            if _enabled(policy, 'srcaddr-negate'):
+                self._srcneg |= bit
+            if _enabled(policy, 'dstaddr-negate'):
+                self._dstneg |= bit
+            if _enabled(policy, 'service-negate'):
+                self._servneg |= bit
+        self._src = _Intervals(src, MAX_IP)
+        self._dst = _Intervals(dst, MAX_IP)
+        self._ports = dict((protocol, _Intervals(ranges, MAX_PORT)) for protocol, ranges in ports.items())
+        self._any_src_intf = self._src_intf.get('any', 0)
+        self._any_dst_intf = self._dst_intf.get('any', 0)
+        if self.unsupported:
+            LOG.info("objects not evaluated by the policy lookup: %s", sorted(self.unsupported))
+
+    def active(self, when=None):
+        """
+        :return: the bitset of the policies whose schedule is active at when (now by default)
+        """
+        when = when or datetime.datetime.now()
+        active = 0
+        cache = {}
+        for index, policy in enumerate(self.policies):
+            schedule = policy.get('schedule', 'always')
+            if schedule not in cache:
+                cache[schedule] = self._schedule_active(schedule, when)
+            if cache[schedule]:
+                active |= 1 << index
+        return active
+
+    # lookups
+
+    def lookup_many(self, flows, when=None, details=False):
+        """
+        :param flows: iterable of (srcintf, dstintf, src ip, dst ip, protocol number, destination port)
+        :param when: datetime used for the schedules (device local time), now by default
+        :param details: give the matching policy entries instead of their policyid
+        :return: list of the policyid (or policy) matching each flow, None when no
+                 policy matches (implicit deny)
+        """
+        active = self.active(when)
+        answers = self.policies if details else [p.get('policyid') for p in self.policies]
+        # locals: this loop runs for every flow
+        aton, unpack = socket.inet_aton, _IP.unpack
+        src_bounds, src_sets, srcneg = self._src.bounds, self._src.sets, self._srcneg
+        dst_bounds, dst_sets, dstneg = self._dst.bounds, self._dst.sets, self._dstneg
+        src_intfs, dst_intfs = {}, {}
+        srcs, dsts, services = {}, {}, {}
+        results = []
+        append = results.append
+        for srcintf, dstintf, src, dst, protocol, port in flows:
+            bits = src_intfs.get(srcintf)
+            if bits is None:
+                bits = src_intfs[srcintf] = active & self._intf(self._src_intf, self._any_src_intf, srcintf)
+            if bits:
+                found = dst_intfs.get(dstintf)
+                if found is None:
+                    found = dst_intfs[dstintf] = self._intf(self._dst_intf, self._any_dst_intf, dstintf)
+                bits &= found
+            if bits:
+                found = srcs.get(src)
+                if found is None:
+                    found = srcs[src] = src_sets[bisect_right(src_bounds, unpack(aton(src))[0]) - 1] ^ srcneg
+                bits &= found
+            if bits:
+                found = dsts.get(dst)
+                if found is None:
+                    found = dsts[dst] = dst_sets[bisect_right(dst_bounds, unpack(aton(dst))[0]) - 1] ^ dstneg
+                bits &= found
+            if bits:
+                key = (protocol, port)
+                found = services.get(key)
+                if found is None:
+                    found = services[key] = self._service(protocol, port)
+                bits &= found
+            append(answers[(bits & -bits).bit_length() - 1] if bits else None)
+        return results
+
+    def lookup(self, srcintf, dstintf, src, dst, protocol, port=0, when=None, details=False):
+        return self.lookup_many([(srcintf, dstintf, src, dst, protocol, port)], when, details)[0]
+
+    def _intf(self, intfs, any_bits, name):
+        bits = any_bits | intfs.get(name, 0)
+        zone = self._zone_of.get(name)
+        if zone is not None:
+            bits |= intfs.get(zone, 0)
+        return bits
+
+    def _service(self, protocol, port):
+        bits = self._proto_any | self._proto.get(protocol, 0)
+        intervals = self._ports.get(protocol)
+        if intervals is not None:
+            bits |= intervals(port or 0)
+        return (bits ^ self._servneg) & self.mask
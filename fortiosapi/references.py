@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# references.py indexes which cmdb objects reference which other
+# ones (schema datasources) to check deletions locally.
+#
+###################################################################
+
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+
+LOG = logging.getLogger('fortiosapi')
+
+
+def _vdom(vdom):
+    # FortiOSAPI calls without vdom go to the root vdom
+    return 'root' if vdom is None else vdom
+
+
+def _specs(children):
+    """
+    Compile the children of a schema in a list of (field, datasources, sub specs):
+    datasources are the targets of a referencing field, sub specs the specs of
+    the entries of a member list or of a complex field.
+    """
+    specs = []
+    for field, child in (children or {}).items():
+        if not isinstance(child, dict):
+            continue
+        if child.get('datasource'):
+            specs.append((field, tuple(child['datasource']), None))
+        elif child.get('children'):
+            sub = _specs(child['children'])
+            if sub:
+                specs.append((field, None, sub))
+    return specs
+
+
+def _walk(specs, entry, root=None):
+    # (top level field, datasources, value) of the references of an entry
+    for field, datasources, sub in specs:
+        value = entry.get(field)
+        if value is None or value == '':
+            continue
+        top = root or field
+        if datasources is not None:
+            if isinstance(value, list):
+                for item in value:
+                    if item not in (None, ''):
+                        yield top, datasources, six.text_type(item)
+            elif not isinstance(value, dict):
+                yield top, datasources, six.text_type(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    for reference in _walk(sub, item, top):
+                        yield reference
+        elif isinstance(value, dict):
+            for reference in _walk(sub, value, top):
+                yield reference
+
+
+def _answered(response):
+    # json body of a response (the first vdom one for vdom=global), {} if none
+    try:
+        resp = json.loads(response.content.decode('utf-8'))
+    except (AttributeError, TypeError, ValueError):
+        return {}
+    if isinstance(resp, list):
+        resp = resp[0] if resp else {}
+    return resp if isinstance(resp, dict) else {}
+
+
+class ReferenceIndex(object):
+    """
+    In memory index of the references between cmdb objects, built from the
+    schema datasources (a policy srcaddr references firewall.address.name,
+    firewall.addrgrp.name...) with one read of the tables having references.
+    Answers who references an object and what an object references with a
+    dict lookup, and follows the writes done by the clients it is attached to.
+
+    index = ReferenceIndex().build(fgt, vdom='root')
+    index.attach(fgt)
+    index.referrers('firewall', 'address', 'srv-1', vdom='root')
+    fgt.delete_many('firewall', 'address', names, vdom='root', reference_index=index)
+
+    A value referencing many possible tables (address or group) is indexed
+    under all of them, FortiOS does not allow the same name in both.
+    """
+
+    def __init__(self):
+        # (path, name): {'specs', 'mkey', 'scope'} of the tables having references
+        self.tables = {}
+        self._scopes = {}
+        # target (vdom, path, name, mkey): {referrer (vdom, path, name, mkey): set of fields}
+        self._referrers = {}
+        # referrer (vdom, path, name, mkey): {target: set of fields}
+        self._references = {}
+        self._lock = threading.RLock()
+
+    def _target_tables(self, datasources):
+        # (path, name) of the tables of datasources like firewall.service.custom.name
+        targets = []
+        for source in datasources:
+            parts = source.split('.')
+            # the path can have a dot (firewall.service), the name a / (ssh/local-key)
+            for cut in range(1, len(parts) - 1):
+                path = '.'.join(parts[:cut])
+                name = '/'.join(parts[cut:-1])
+                if (path, name) in self._scopes:
+                    targets.append((path, name))
+                    break
+            else:
+                targets.append(('.'.join(parts[:-2]), parts[-2]))
+        return targets
+
+    def _target(self, vdom, table, value):
+        scope = 'global' if self._scopes.get(table) == 'global' else vdom
+        return scope, table[0], table[1], value
+
+    def _set(self, referrer, references, fields=None):
+        """
+        Replace the references of referrer (all or only those from fields)
+        by references, a list of (field, datasources, value).
+        """
+        old = self._references.get(referrer, {})
+        kept = {}
+        for target, old_fields in old.items():
+            remaining = set(old_fields) - fields if fields is not None else set()
+            removed = set(old_fields) - remaining
+            referrers = self._referrers.get(target)
+            if referrers is not None and removed:
+                left = referrers.get(referrer, set()) - removed
+                if left:
+                    referrers[referrer] = left
+                else:
+                    referrers.pop(referrer, None)
+                if not referrers:
+                    del self._referrers[target]
+            if remaining:
+                kept[target] = remaining
+        for field, datasources, value in references:
+            for table in self._target_tables(datasources):
+                target = self._target(referrer[0], table, value)
+                kept.setdefault(target, set()).add(field)
+                self._referrers.setdefault(target, {}).setdefault(referrer, set()).add(field)
+        if kept:
+            self._references[referrer] = kept
+        else:
+            self._references.pop(referrer, None)
+
+    def add(self, path, name, entry, vdom=None, fields=None):
+        """
+        Index (again) the references of an entry.
+
+        :param fields: only update the references of these top level fields (partial PUT)
+        """
+        table = self.tables.get((path, name))
+        if table is None:
+            return
+        mkey = table['mkey']
+        if mkey is not None:
+            mkey = six.text_type(entry.get(mkey, entry.get('q_origin_key')))
+        referrer = (self._target(_vdom(vdom), (path, name), None)[0], path, name, mkey)
+        with self._lock:
+            self._set(referrer, list(_walk(table['specs'], entry)), fields)
+
+    def remove(self, path, name, mkey, vdom=None):
+        """
+        Forget the references of a deleted object.
+        """
+        mkey = None if mkey is None else six.text_type(mkey)
+        referrer = (self._target(_vdom(vdom), (path, name), None)[0], path, name, mkey)
+        with self._lock:
+            self._set(referrer, [])
+
+    def build(self, client, vdom=None, tables=None, workers=8):
+        """
+        Read the tables having references (in vdom and global) and index them,
+        the index is emptied first.
+
+        :param client: a logged FortiOSAPI
+        :param tables: list of (path, name) to read, by default all the tables
+                       and settings whose schema has datasources
+        :param workers: tables read at the same time
+        :return: self
+        """
+        vdom = _vdom(vdom)
+        schemas = client.cmdb_schemas(vdom)
+        with self._lock:
+            self.tables = {}
+            self._referrers = {}
+            self._references = {}
+            self._scopes = dict(((s['path'], s['name']), s.get('scope')) for s in schemas)
+            for schema in schemas:
+                table = (schema['path'], schema['name'])
+                if tables is not None and table not in tables:
+                    continue
+                specs = _specs(schema.get('children'))
+                if specs:
+                    mkey = schema.get('mkey') if schema.get('category') == 'table' else None
+                    self.tables[table] = {'specs': specs, 'scope': schema.get('scope'), 'mkey': mkey}
+
+        def read(table):
+            scope = 'global' if self.tables[table]['scope'] == 'global' else vdom
+            entries = list(client.iter_table(table[0], table[1], vdom=scope, prefetch=False))
+            for entry in entries:
+                self.add(table[0], table[1], entry, vdom=scope)
+            return len(entries)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = dict((table, executor.submit(read, table)) for table in self.tables)
+            for table, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    LOG.debug("references of %s/%s not indexed: %s", table[0], table[1], e)
+        LOG.debug("indexed %d references of %d tables", len(self._referrers), len(self.tables))
+        return self
+
+    # queries
+
+    def referrers(self, path, name, mkey, vdom=None):
+        """
+        Who references an object.
+
+        :return: list of dict vdom, path, name, mkey (None for settings) and fields
+                 (the top level fields of the referrer using the object)
+        """
+        target = self._target(_vdom(vdom), (path, name), six.text_type(mkey))
+        with self._lock:
+            found = list(self._referrers.get(target, {}).items())
+        return [{'vdom': r[0], 'path': r[1], 'name': r[2], 'mkey': r[3], 'fields': sorted(fields)}
+                for r, fields in sorted(found, key=lambda item: tuple(six.text_type(k) for k in item[0]))]
+
+    def references(self, path, name, mkey=None, vdom=None):
+        """
+        What an object references.
+
+        :return: list of dict vdom, path, name, mkey and fields of the referenced objects
+        """
+        referrer = (self._target(_vdom(vdom), (path, name), None)[0], path, name,
+                    None if mkey is None else six.text_type(mkey))
+        with self._lock:
+            found = list(self._references.get(referrer, {}).items())
+        return [{'vdom': t[0], 'path': t[1], 'name': t[2], 'mkey': t[3], 'fields': sorted(fields)}
+                for t, fields in sorted(found)]
+
+    def is_referenced(self, path, name, mkey, vdom=None):
+        target = self._target(_vdom(vdom), (path, name), six.text_type(mkey))
+        with self._lock:
+            return bool(self._referrers.get(target))
+
+    # follow the client writes
+
+    def after_response(self, context, response):
+        if context.kind != 'cmdb' or context.method not in ('POST', 'PUT', 'DELETE'):
+            return
+        if getattr(response, 'status_code', None) != 200:
+            return
+        table = (context.path, context.name)
+        if context.method == 'DELETE':
+            if context.mkey is not None:
+                self.remove(context.path, context.name, context.mkey, vdom=context.vdom)
+            return
+        data = context.data
+        if table not in self.tables:
+            return
+        if isinstance(data, dict):
+            entries = [data]
+            mkeys = [context.mkey]
+        elif isinstance(data, list) and context.method == 'POST':
+            # post_batch sends a json array of new objects
+            entries = data
+            mkeys = [None] * len(data)
+        else:
+            # move
+            return
+        mkeyname = self.tables[table]['mkey']
+        if mkeyname is not None and context.method == 'POST':
+            # the Fortigate may allocate the mkey (policyid 0): only index
+            # the objects whose mkey it answered
+            resp = _answered(response)
+            if isinstance(data, dict):
+                mkeys = [resp.get('mkey')]
+            elif isinstance(resp.get('results'), list) and len(resp['results']) == len(data):
+                mkeys = [r.get('mkey') if isinstance(r, dict) and r.get('status', 'success') == 'success'
+                         else None for r in resp['results']]
+        for entry, mkey in zip(entries, mkeys):
+            if not isinstance(entry, dict):
+                continue
+            if mkeyname is not None:
+                if mkey is None and context.method == 'PUT':
+                    mkey = entry.get(mkeyname)
+                if mkey is None:
+                    continue
+                entry = dict(entry)
+                entry[mkeyname] = mkey
+            # a PUT only changes the fields it sends
+            fields = set(entry) if context.method == 'PUT' else None
+            self.add(context.path, context.name, entry, vdom=context.vdom, fields=fields)
+
+    def attach(self, client):
+        """
+        Update the index with the writes (post, put, set, delete) of client
+        """
+        client.add_hook('after_response', self.after_response)
+        return self
+
+    def detach(self, client):
+        client.remove_hook('after_response', self.after_response)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# routing.py keeps a copy of the routing table of a Fortigate
+# (monitor router ipv4/ipv6) for local longest prefix lookups.
+#
+###################################################################
+
+import binascii
+import logging
+import socket
+import threading
+
+from .exceptions import APIError
+from .subscriptions import diff_records, index_records
+
+LOG = logging.getLogger('fortiosapi')
+
+BITS = {4: 32, 6: 128}
+
+
+def ip_version(ip):
+    return 6 if ':' in ip else 4
+
+
+def ip_to_int(ip, version=None):
+    version = version or ip_version(ip)
+    if version == 4:
+        packed = socket.inet_aton(ip)
+    else:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    return int(binascii.hexlify(packed), 16)
+
+
+def _prefix(ip_mask):
+    """
+    :return: (version, network as int, prefix length) of "ip/len" or "ip mask"
+    """
+    if '/' in ip_mask:
+        ip, length = ip_mask.split('/', 1)
+        length = int(length)
+    else:
+        ip, mask = ip_mask.split()
+        length = bin(ip_to_int(mask, 4)).count('1')
+    version = ip_version(ip)
+    bits = BITS[version]
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+    return version, ip_to_int(ip, version) & mask, length
+
+
+def _preference(route):
+    # lowest distance, then priority, then metric wins
+    return route.get('distance', 0), route.get('priority', 0), route.get('metric', 0)
+
+
+class RoutingTable(object):
+    """
+    Longest prefix match over the routes of a Fortigate, per ip version and
+    vrf: a dict network: routes per prefix length, a lookup masks the
+    destination with the prefix lengths present from the longest one.
+    Equal cost routes (same distance and priority) are all kept.
+
+    table = RoutingTable.from_client(fgt, vdom='root')
+    table.lookup_many(['10.1.2.3', '8.8.8.8', '2001:db8::1'])   # best route of each
+    table.refresh(fgt)                                          # only applies the changed routes
+
+    or follow the changes with a MonitorPoller:
+    poller.subscribe('router', 'ipv4', table.apply, vdom='root', key=RoutingTable.KEY)
+
+    :param routes: routes as given by monitor router/ipv4 and router/ipv6
+    """
+
+    # fields identifying a route, as MonitorPoller key
+    KEY = ('ip_mask', 'gateway', 'interface', 'vrf', 'type')
+
+    def __init__(self, routes=()):
+        # (version, vrf): {length: {network: [routes by preference]}}
+        self._tables = {}
+        # (version, vrf): prefix lengths present, longest first
+        self._lengths = {}
+        # route key: route
+        self.records = {}
+        self._lock = threading.RLock()
+        for route in routes:
+            self.add(route)
+
+    @staticmethod
+    def _fetch(client, vdom, ipv6):
+        routes = []
+        for name in ('ipv4', 'ipv6') if ipv6 else ('ipv4',):
+            resp = client.monitor('router', name, vdom=vdom)
+            if not isinstance(resp, dict) or resp.get('status') != 'success':
+                raise APIError(resp)
+            routes.extend(resp.get('results') or [])
+        return routes
+
+    @classmethod
+    def from_client(cls, client, vdom=None, ipv6=True):
+        """
+        Read the routing table of a logged FortiOSAPI
+        """
+        return cls(cls._fetch(client, vdom, ipv6))
+
+    def __len__(self):
+        return len(self.records)
+
+    def _key(self, route):
+        return tuple(route.get(field) for field in self.KEY)
+
+    def add(self, route):
+        try:
+            version, network, length = _prefix(route['ip_mask'])
+        except (KeyError, ValueError, socket.error):
+            LOG.debug("route without a valid ip_mask ignored: %s", route)
+            return
+        table = (version, route.get('vrf', 0) or 0)
+        with self._lock:
+            key = self._key(route)
+            if key in self.records:
+                self._remove(key)
+            self.records[key] = route
+            prefixes = self._tables.setdefault(table, {}).setdefault(length, {})
+            routes = prefixes.setdefault(network, [])
+            routes.append(route)
+            routes.sort(key=_preference)
+            lengths = self._lengths.get(table, [])
+            if length not in lengths:
+                self._lengths[table] = sorted(lengths + [length], reverse=True)
+
+    def _remove(self, key):
+        route = self.records.pop(key, None)
+        if route is None:
+            return
+        version, network, length = _prefix(route['ip_mask'])
+        table = (version, route.get('vrf', 0) or 0)
+        prefixes = self._tables[table][length]
+        routes = [r for r in prefixes.get(network, []) if self._key(r) != key]
+        if routes:
+            prefixes[network] = routes
+            return
+        prefixes.pop(network, None)
+        if not prefixes:
+            del self._tables[table][length]
+            self._lengths[table] = [other for other in self._lengths[table] if other != length]
+
+    def remove(self, route):
+        with self._lock:
+            self._remove(self._key(route))
+
+    def apply(self, delta):
+        """
+        Apply a MonitorDelta of router/ipv4 or router/ipv6 indexed with KEY
+        """
+        with self._lock:
+            for key in delta.removed:
+                self._remove(key)
+            for route in delta.added.values():
+                self.add(route)
+            for change in delta.changed.values():
+                self.add(change['record'])
+
+    def refresh(self, client, vdom=None, ipv6=True):
+        """
+        Read the routing table again and apply only the routes which changed.
+
+        :return: dict of the number of routes added, removed and changed
+        """
+        current = index_records(self._fetch(client, vdom, ipv6), self.KEY)
+        with self._lock:
+            added, removed, changed = diff_records(self.records, current, 0)
+            for key in removed:
+                self._remove(key)
+            for route in added.values():
+                self.add(route)
+            for change in changed.values():
+                self.add(change['record'])
+        return {'added': len(added), 'removed': len(removed), 'changed': len(changed)}
+
+    def lookup_many(self, destinations, vrf=0, all_paths=False):
+        """
+        :param destinations: iterable of ipv4 or ipv6 addresses (strings)
+        :param all_paths: give the list of the equal cost routes instead of the best one
+        :return: list of the route (or routes) of each destination, None when no route
+        """
+        results = []
+        found = {}
+        with self._lock:
+            tables = dict((version, (self._tables.get((version, vrf), {}), self._lengths.get((version, vrf), [])))
+                          for version in BITS)
+            for destination in destinations:
+                routes = found.get(destination, False)
+                if routes is False:
+                    routes = found[destination] = self._match(tables, destination)
+                if routes is None or all_paths:
+                    results.append(routes)
+                else:
+                    results.append(routes[0])
+        return results
+
+    @staticmethod
+    def _match(tables, destination):
+        version = ip_version(destination)
+        prefixes, lengths = tables[version]
+        ip = ip_to_int(destination, version)
+        bits = BITS[version]
+        for length in lengths:
+            routes = prefixes[length].get(ip >> (bits - length) << (bits - length))
+            if routes:
+                best = _preference(routes[0])[:2]
+                return [r for r in routes if _preference(r)[:2] == best]
+        return None
+
+    def lookup(self, destination, vrf=0, all_paths=False):
+        return self.lookup_many([destination], vrf, all_paths)[0]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# subscriptions.py polls monitor endpoints once for all their
+# subscribers and delivers the changes between two polls.
+#
+###################################################################
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger('fortiosapi')
+
+# fields used to identify the records of a monitor list, first found is used
+KEY_FIELDS = ('id', 'mkey', 'name', 'interface', 'ip')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def index_records(results, key=None):
+    """
+    Turn monitor results in a dict record key: record.
+    A dict of dicts (interfaces) is already keyed, a single dict (resource usage)
+    is one record of key None, list records are keyed with key.
+
+    :param key: tuple of fields or function(record) giving the key of a list record,
+                by default the first field of KEY_FIELDS present
+    """
+    if isinstance(results, dict):
+        if results and all(isinstance(v, dict) for v in results.values()):
+            return dict(results)
+        return {None: results}
+    if not isinstance(results, list):
+        return {None: results}
+    records = {}
+    for record in results:
+        if callable(key):
+            rkey = key(record)
+        elif key:
+            rkey = tuple(record.get(field) for field in key)
+        else:
+            rkey = None
+            if isinstance(record, dict):
+                for field in KEY_FIELDS:
+                    if field in record:
+                        rkey = record[field]
+                        break
+            if rkey is None:
+                rkey = json.dumps(record, sort_keys=True)
+        records[rkey] = record
+    return records
+
+
+def diff_records(previous, current, elapsed):
+    """
+    Compare two indexed polls.
+
+    :param elapsed: seconds between the polls, for the rates
+    :return: (added, removed, changed) where changed is key: {'record', 'fields', 'rates'},
+             fields is field: (old, new) and rates field: change per second of the numeric fields
+    """
+    added = dict((k, v) for k, v in current.items() if k not in previous)
+    removed = dict((k, v) for k, v in previous.items() if k not in current)
+    changed = {}
+    for rkey, record in current.items():
+        old = previous.get(rkey)
+        if old is None or old == record:
+            continue
+        if not isinstance(record, dict) or not isinstance(old, dict):
+            changed[rkey] = {'record': record, 'fields': {None: (old, record)}, 'rates': {}}
+            continue
+        fields = {}
+        rates = {}
+        for field, value in record.items():
+            before = old.get(field)
+            if before == value:
+                continue
+            fields[field] = (before, value)
+            if elapsed > 0 and _is_number(value) and _is_number(before):
+                rates[field] = (value - before) / float(elapsed)
+        for field in old:
+            if field not in record:
+                fields[field] = (old[field], None)
+        changed[rkey] = {'record': record, 'fields': fields, 'rates': rates}
+    return added, removed, changed
+
+
+class MonitorDelta(object):
+    """
+    Changes of a monitor endpoint between two deliveries to a subscriber.
+    The first delivery has all the records in added and initial set.
+    """
+
+    def __init__(self, path, name, vdom, added, removed, changed, timestamp, elapsed, initial=False):
+        self.path = path
+        self.name = name
+        self.vdom = vdom
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+        self.initial = initial
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "MonitorDelta(%s/%s +%d -%d ~%d)" % (self.path, self.name, len(self.added),
+                                                    len(self.removed), len(self.changed))
+
+
+class Subscription(object):
+    def __init__(self, endpoint, callback, interval, key, on_error):
+        self.endpoint = endpoint
+        self.callback = callback
+        self.key = key
+        self.interval = interval
+        self.on_error = on_error
+        self.next = 0.0
+        # (timestamp, records) last delivered
+        self.last = None
+
+
+class _Endpoint(object):
+    def __init__(self, path, name, vdom, parameters):
+        self.path = path
+        self.name = name
+        self.vdom = vdom
+        self.parameters = parameters
+        self.subscriptions = []
+        self.polls = 0
+        self.errors = 0
+
+
+class MonitorPoller(object):
+    """
+    Poll monitor endpoints for many subscribers with a single request per
+    distinct (path, name, vdom, parameters) at the smallest interval asked,
+    and deliver to each subscriber (at its own interval) a MonitorDelta of
+    what changed since its previous delivery. Nothing is delivered when
+    nothing changed.
+
+    poller = MonitorPoller(fgt)
+    poller.subscribe('system', 'interface', on_change, interval=5)
+    poller.start()
+    ...
+    poller.stop()
+
+    :param client: a logged FortiOSAPI
+    :param workers: max number of endpoints polled at the same time
+    """
+
+    def __init__(self, client, workers=4):
+        self.client = client
+        self.workers = workers
+        self._endpoints = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self, path, name, callback, vdom=None, parameters=None, interval=10, key=None,
+                  on_error=None):
+        """
+        :param callback: function(delta) called with a MonitorDelta when something changed
+        :param parameters: dict of parameters of the monitor call
+        :param interval: seconds between two deliveries
+        :param key: fields (tuple) or function identifying the records of a list, see index_records
+        :param on_error: function(exception or response) called when the poll fails
+        :return: the Subscription to give to unsubscribe
+        """
+        ekey = (path, name, vdom, json.dumps(parameters, sort_keys=True) if parameters else None)
+        with self._lock:
+            endpoint = self._endpoints.get(ekey)
+            if endpoint is None:
+                endpoint = self._endpoints[ekey] = _Endpoint(path, name, vdom, parameters)
+            subscription = Subscription(ekey, callback, interval, key if callable(key) else tuple(key or ()),
+                                        on_error)
+            endpoint.subscriptions.append(subscription)
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            endpoint = self._endpoints.get(subscription.endpoint)
+            if endpoint is None:
+                return
+            endpoint.subscriptions.remove(subscription)
+            if not endpoint.subscriptions:
+                del self._endpoints[subscription.endpoint]
+
+    @staticmethod
+    def _is_due(subscription, now):
+        # a quarter of interval early is fine, it groups the subscribers
+        # which did not subscribe at the exact same time in one poll
+        return subscription.next <= now + subscription.interval / 4.0
+
+    def _due(self, now):
+        with self._lock:
+            return [e for e in self._endpoints.values()
+                    if any(s.next <= now for s in e.subscriptions)]
+
+    def _poll(self, endpoint):
+        # one request for all the subscribers of the endpoint which are due
+        error = None
+        try:
+            resp = self.client.monitor(endpoint.path, endpoint.name, vdom=endpoint.vdom,
+                                       parameters=endpoint.parameters)
+            if not isinstance(resp, dict) or resp.get('status') != 'success':
+                error = resp
+        except Exception as e:
+            resp = None
+            error = e
+        now = time.time()
+        with self._lock:
+            endpoint.polls += 1
+            if error is not None:
+                endpoint.errors += 1
+            due = [s for s in endpoint.subscriptions if self._is_due(s, now)]
+            for subscription in due:
+                subscription.next = now + subscription.interval
+        if error is not None:
+            LOG.warning("poll of monitor %s/%s failed: %s", endpoint.path, endpoint.name, error)
+            for subscription in due:
+                if subscription.on_error is None:
+                    continue
+                try:
+                    subscription.on_error(error)
+                except Exception as e:
+                    LOG.warning("monitor subscriber error handler %s failed: %s", subscription.on_error, e)
+            return
+        # subscribers delivered at the same time share the indexing and the diff
+        indexes = {}
+        deltas = {}
+        for subscription in due:
+            records = indexes.get(subscription.key)
+            if records is None:
+                records = indexes[subscription.key] = index_records(resp.get('results'), subscription.key)
+            last = subscription.last
+            subscription.last = (now, records)
+            if last is None:
+                delta = MonitorDelta(endpoint.path, endpoint.name, endpoint.vdom, dict(records), {}, {},
+                                     now, 0.0, initial=True)
+            else:
+                delta = deltas.get(id(last[1]))
+                if delta is None:
+                    added, removed, changed = diff_records(last[1], records, now - last[0])
+                    delta = deltas[id(last[1])] = MonitorDelta(endpoint.path, endpoint.name, endpoint.vdom,
+                                                               added, removed, changed, now, now - last[0])
+            if delta:
+                try:
+                    subscription.callback(delta)
+                except Exception as e:
+                    LOG.warning("monitor subscriber %s failed: %s", subscription.callback, e)
+
+    def poll_once(self):
+        """
+        Poll now the endpoints having a subscriber due, without the background thread.
+
+        :return: the number of endpoints polled
+        """
+        due = self._due(time.time())
+        if len(due) <= 1 or self.workers <= 1:
+            for endpoint in due:
+                self._poll(endpoint)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(due))) as executor:
+                list(executor.map(self._poll, due))
+        return len(due)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll_once()
+            with self._lock:
+                nexts = [s.next for e in self._endpoints.values() for s in e.subscriptions]
+            wait = max(0.0, min(nexts) - time.time()) if nexts else 1.0
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+
+    def start(self):
+        """
+        Poll in a background thread until stop()
+        """
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="fortiosapi-poller")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stats(self):
+        """
+        :return: list of dict path, name, vdom, subscribers, polls, errors per endpoint
+        """
+        with self._lock:
+            return [{'path': e.path, 'name': e.name, 'vdom': e.vdom, 'subscribers': len(e.subscriptions),
+                     'polls': e.polls, 'errors': e.errors} for e in self._endpoints.values()]
@@ -21,7 +21,8 @@ setup(
     ],
     keywords='Fortinet fortigate fortios rest api',
     packages=find_packages(),
-    install_requires=['requests', 'paramiko', 'oyaml'],
+    install_requires=['requests', 'paramiko', 'oyaml', 'futures; python_version < "3"'],
+    extras_require={'async': ['aiohttp'], 'zstd': ['zstandard']},
     author='Nicolas Thomas',
     author_email='nthomas@fortinet.com',
     url='https://github.com/fortinet-solutions-cse/fortiosapi',
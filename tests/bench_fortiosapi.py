@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# bench_fortiosapi.py measures the client hot paths (ops/sec,
+# p50/p99 latency, peak memory) against the fake Fortigate with
+# injected latency. The fake runs in a child process so it does not
+# share the GIL nor the traced memory with the client.
+# Results are written as json to compare releases:
+#   python bench_fortiosapi.py --latency 0.002 --output new.json
+#   python bench_fortiosapi.py --compare old.json new.json
+#
+###################################################################
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import sys
+import time
+import tracemalloc
+
+import pkg_resources
+
+from fortiosapi import FortiOSAPI
+from fortiosapi.fleet import latency_summary
+
+from fakefortios import FakeFortiOS
+
+
+def serve(conn, kwargs):
+    with FakeFortiOS(**kwargs) as fake:
+        conn.send(fake.address)
+        # wait for the parent to ask for the stats
+        conn.recv()
+        conn.send(fake.stats['requests'])
+
+
+def timed_ops(func, count):
+    latencies = []
+    start = time.time()
+    for i in range(count):
+        t = time.time()
+        func(i)
+        latencies.append(time.time() - t)
+    return time.time() - start, latencies
+
+
+def request_latencies(fgt, func):
+    # latency of each request sent by func, measured with the hooks,
+    # bulk benchmarks count http requests as ops
+    latencies = []
+
+    def record(context, response):
+        latencies.append(context.elapsed)
+
+    fgt.add_hook('after_response', record)
+    try:
+        start = time.time()
+        func()
+        return time.time() - start, latencies
+    finally:
+        fgt.remove_hook('after_response', record)
+
+
+def bench_get(fgt, args):
+    return timed_ops(lambda i: fgt.get('firewall', 'address', mkey='all', vdom="root"), args.ops)
+
+
+def bench_monitor(fgt, args):
+    return timed_ops(lambda i: fgt.monitor('system', 'resource/usage', vdom="root"), args.ops)
+
+
+def bench_set_create(fgt, args):
+    return timed_ops(lambda i: fgt.set('firewall', 'address', vdom="root",
+                                       data={'name': 'bench-c-%d' % i, 'subnet': '10.1.0.0 255.255.255.0'}),
+                     args.ops)
+
+
+def bench_set_update(fgt, args):
+    return timed_ops(lambda i: fgt.set('firewall', 'address', vdom="root",
+                                       data={'name': 'bench-c-%d' % i, 'comment': 'updated'}), args.ops)
+
+
+def bench_delete(fgt, args):
+    return timed_ops(lambda i: fgt.delete('firewall', 'address', mkey='bench-c-%d' % i, vdom="root"), args.ops)
+
+
+def bench_bulk_import(fgt, args):
+    objects = ({'name': 'bench-bulk-%d' % i, 'subnet': '10.2.%d.0 255.255.255.0' % (i & 255)}
+               for i in range(args.objects))
+    summary = {}
+
+    def bulk():
+        summary.update(fgt.set_many('firewall', 'address', objects, vdom="root", concurrency=args.concurrency))
+
+    elapsed, latencies = request_latencies(fgt, bulk)
+    if summary['error']:
+        raise RuntimeError("bulk import had %d errors" % summary['error'])
+    return elapsed, latencies
+
+
+def bench_overlay(fgt, args):
+    count = max(1, args.objects // 10)
+    overlay = {'firewall': {'address': dict(('bench-ov-%d' % i, {'subnet': '10.3.%d.0/24' % (i & 255)})
+                                            for i in range(count)),
+                            'policy': dict((1000 + i, {'name': 'bench-ov-%d' % i,
+                                                       'srcaddr': [{'name': 'bench-ov-%d' % i}],
+                                                       'dstaddr': [{'name': 'all'}],
+                                                       'service': [{'name': 'ALL'}], 'action': 'accept'})
+                                           for i in range(count))}}
+    done = []
+    elapsed, latencies = request_latencies(
+        fgt, lambda: done.append(fgt.setoverlayconfig(overlay, vdom="root", concurrency=args.concurrency)))
+    if not done[0]:
+        raise RuntimeError("overlay failed")
+    return elapsed, latencies
+
+
+def bench_large_read(fgt, args):
+    latencies = []
+    start = time.time()
+    last = time.time()
+    for _ in fgt.iter_table('firewall', 'address', vdom="root", page_size=1000):
+        now = time.time()
+        latencies.append(now - last)
+        last = now
+    return time.time() - start, latencies
+
+
+BENCHMARKS = [
+    ('get', bench_get),
+    ('monitor', bench_monitor),
+    ('set-create', bench_set_create),
+    ('set-update', bench_set_update),
+    ('delete', bench_delete),
+    ('bulk-import', bench_bulk_import),
+    ('overlay', bench_overlay),
+    ('large-read', bench_large_read),
+]
+
+
+def run(args):
+    results = {'meta': {'fortiosapi': pkg_resources.get_distribution('fortiosapi').version,
+                        'python': platform.python_version(),
+                        'latency': args.latency, 'ops': args.ops, 'objects': args.objects,
+                        'concurrency': args.concurrency, 'date': time.strftime('%Y-%m-%dT%H:%M:%S')},
+               'benchmarks': {}}
+    selected = [b for b in BENCHMARKS if not args.only or b[0] in args.only]
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, {
+        'latency': args.latency, 'table_sizes': {('firewall', 'address'): args.objects}}))
+    server.daemon = True
+    server.start()
+    try:
+        address = parent.recv()
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        fgt.login(address, 'admin', '')
+        for name, bench in selected:
+            tracemalloc.start()
+            elapsed, latencies = bench(fgt, args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            summary = latency_summary(latencies)
+            entry = {'ops': len(latencies), 'elapsed': elapsed,
+                     'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+                     'p50': summary.get('p50'), 'p99': summary.get('p99'), 'peak_memory': peak}
+            results['benchmarks'][name] = entry
+            print("%-12s %8d ops %10.1f ops/s p50 %8.2fms p99 %8.2fms peak %8.1fKB" % (
+                name, entry['ops'], entry['ops_per_sec'], (entry['p50'] or 0) * 1000,
+                (entry['p99'] or 0) * 1000, peak / 1024.0))
+        fgt.logout()
+        parent.send('stats')
+        results['meta']['requests'] = parent.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    return results
+
+
+def compare(old, new, threshold):
+    # return the number of benchmarks slower than threshold
+    regressions = 0
+    for name, entry in sorted(new['benchmarks'].items()):
+        before = old['benchmarks'].get(name)
+        if not before or not before['ops_per_sec']:
+            continue
+        ratio = entry['ops_per_sec'] / before['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print("%-12s %10.1f -> %10.1f ops/s (x%.2f) peak %8.1fKB -> %8.1fKB%s" % (
+            name, before['ops_per_sec'], entry['ops_per_sec'], ratio,
+            before['peak_memory'] / 1024.0, entry['peak_memory'] / 1024.0, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fortiosapi benchmarks against a fake Fortigate")
+    parser.add_argument('--latency', type=float, default=0.002, help="seconds added per request")
+    parser.add_argument('--ops', type=int, default=500, help="calls per single request benchmark")
+    parser.add_argument('--objects', type=int, default=10000, help="objects of bulk import and large read")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrency of bulk calls")
+    parser.add_argument('--only', action='append', help="run only this benchmark (repeatable)")
+    parser.add_argument('--output', help="write the json results in this file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare 2 json results")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown ratio reported as regression")
+    parser.add_argument('--verbose', action='store_true', help="show the fortiosapi warnings")
+    args = parser.parse_args()
+    if not args.verbose:
+        # set() warns on each create (put then post), it would flood the output
+        logging.getLogger('fortiosapi').setLevel(logging.ERROR)
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            sys.exit(1 if compare(json.load(old), json.load(new), args.threshold) else 0)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,864 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+###################################################################
+#
+# fakefortios.py is an in process stand-in of the Fortigate REST API
+# (http only) to test and benchmark fortiosapi without a Fortigate.
+# It implements logincheck/logout, csrf, api token, the cmdb CRUD,
+# schema, move, vdom/global and common monitor calls, with
+# configurable latency, errors and tables sizes.
+#
+###################################################################
+
+import copy
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlsplit
+
+LOG = logging.getLogger('fortiosapi')
+
+
+def _field(datasource=None, ftype='string'):
+    field = {'type': ftype}
+    if datasource:
+        field['datasource'] = datasource
+    return field
+
+
+def _members(datasource):
+    return {'type': 'table', 'mkey': 'name', 'children': {'name': _field(datasource)}}
+
+
+ADDRESSES = ['firewall.address.name', 'firewall.addrgrp.name', 'firewall.vip.name']
+SERVICES = ['firewall.service.custom.name', 'firewall.service.group.name']
+INTERFACES = ['system.interface.name', 'system.zone.name']
+
+# tables known by the fake: (path, name): (mkey, mkey_type, scope, children)
+TABLES = {
+    ('firewall', 'address'): ('name', 'string', 'vdom', {
+        'name': _field(), 'type': _field(), 'subnet': _field(ftype='ipv4-classnet-any'),
+        'start-ip': _field(), 'end-ip': _field(), 'fqdn': _field(), 'comment': _field(),
+        'associated-interface': _field(INTERFACES)}),
+    ('firewall', 'addrgrp'): ('name', 'string', 'vdom', {
+        'name': _field(), 'member': _members(['firewall.address.name', 'firewall.addrgrp.name']),
+        'comment': _field()}),
+    ('firewall', 'vip'): ('name', 'string', 'vdom', {
+        'name': _field(), 'extip': _field(), 'mappedip': _members([]),
+        'extintf': _field(INTERFACES)}),
+    ('firewall.service', 'custom'): ('name', 'string', 'vdom', {
+        'name': _field(), 'protocol': _field(), 'tcp-portrange': _field(), 'udp-portrange': _field(),
+        'sctp-portrange': _field(), 'protocol-number': _field(ftype='integer'), 'icmptype': _field(),
+        'category': _field()}),
+    ('firewall.service', 'group'): ('name', 'string', 'vdom', {
+        'name': _field(), 'member': _members(['firewall.service.custom.name', 'firewall.service.group.name'])}),
+    ('firewall.schedule', 'recurring'): ('name', 'string', 'vdom', {
+        'name': _field(), 'day': _field(), 'start': _field(), 'end': _field()}),
+    ('firewall.schedule', 'onetime'): ('name', 'string', 'vdom', {
+        'name': _field(), 'start': _field(), 'end': _field()}),
+    ('firewall', 'policy'): ('policyid', 'integer', 'vdom', {
+        'policyid': _field(ftype='integer'), 'name': _field(), 'status': _field(), 'action': _field(),
+        'srcintf': _members(INTERFACES), 'dstintf': _members(INTERFACES),
+        'srcaddr': _members(ADDRESSES), 'dstaddr': _members(ADDRESSES),
+        'service': _members(SERVICES),
+        'schedule': _field(['firewall.schedule.onetime.name', 'firewall.schedule.recurring.name',
+                            'firewall.schedule.group.name']),
+        'av-profile': _field(['antivirus.profile.name']), 'logtraffic': _field(), 'nat': _field()}),
+    ('router', 'static'): ('seq-num', 'integer', 'vdom', {
+        'seq-num': _field(ftype='integer'), 'dst': _field(), 'gateway': _field(),
+        'device': _field(INTERFACES), 'distance': _field(ftype='integer')}),
+    ('antivirus', 'profile'): ('name', 'string', 'vdom', {
+        'name': _field(), 'scan-mode': _field(), 'http': {'type': 'complex', 'children': {'options': _field()}},
+        'emulator': _field()}),
+    ('system', 'interface'): ('name', 'string', 'global', {
+        'name': _field(), 'vdom': _field(['system.vdom.name']), 'ip': _field(), 'type': _field(),
+        'allowaccess': _field()}),
+    ('system', 'zone'): ('name', 'string', 'vdom', {
+        'name': _field(), 'interface': _members(['system.interface.name'])}),
+    ('system', 'vdom'): ('name', 'string', 'global', {'name': _field()}),
+    ('system', 'admin'): ('name', 'string', 'global', {'name': _field(), 'accprofile': _field()}),
+}
+
+# settings objects (no mkey): (path, name): (scope, default values)
+SETTINGS = {
+    ('system', 'global'): ('global', {'hostname': 'FGT-FAKE', 'admintimeout': 5, 'timezone': '04'}),
+    ('system', 'settings'): ('vdom', {'opmode': 'nat', 'inspection-mode': 'flow'}),
+    ('system', 'dns'): ('global', {'primary': '8.8.8.8', 'secondary': '8.8.4.4'}),
+    ('log', 'setting'): ('vdom', {'resolve-ip': 'disable'}),
+    ('system', 'central-management'): ('global', {'type': 'none'}),
+}
+
+MONITOR_HANDLERS = {}
+
+
+def monitor_handler(path, name, methods=('GET',)):
+    """
+    Decorator registering a fake monitor endpoint, the function receives
+    (fake, method, vdom, query, body) and returns (http status, results)
+    """
+    def register(func):
+        for method in methods:
+            MONITOR_HANDLERS[(method, path, name)] = func
+        return func
+    return register
+
+
+@monitor_handler('license', 'status')
+def _license_status(fake, method, vdom, query, body):
+    return 200, {'vm': {'type': 'cpu_memory', 'status': 'licensed'},
+                 'forticare': {'status': 'registered'}}
+
+
+@monitor_handler('system', 'status')
+def _system_status(fake, method, vdom, query, body):
+    return 200, {'model_name': 'FortiGate', 'model_number': 'VM64', 'model': 'FGVM64',
+                 'hostname': fake.settings_object('global', 'system', 'global').get('hostname')}
+
+
+@monitor_handler('system', 'resource/usage')
+def _resource_usage(fake, method, vdom, query, body):
+    now = int(time.time())
+    return 200, {'cpu': [{'current': random.randint(0, 100), 'historical': {}}],
+                 'mem': [{'current': random.randint(10, 90)}],
+                 'session': [{'current': fake.session_count}],
+                 'timestamp': now}
+
+
+@monitor_handler('system', 'interface')
+def _monitor_interface(fake, method, vdom, query, body):
+    results = {}
+    for name, intf in fake.table('global', 'system', 'interface').items():
+        counter = fake.counter()
+        results[name] = {'id': name, 'name': name, 'ip': intf.get('ip', '0.0.0.0'), 'link': True,
+                         'speed': 10000, 'tx_packets': counter * 10, 'rx_packets': counter * 12,
+                         'tx_bytes': counter * 1500, 'rx_bytes': counter * 1800, 'tx_errors': 0,
+                         'rx_errors': 0}
+    return 200, results
+
+
+@monitor_handler('router', 'ipv4')
+def _router_ipv4(fake, method, vdom, query, body):
+    return 200, fake.routes(4)
+
+
+@monitor_handler('router', 'ipv6')
+def _router_ipv6(fake, method, vdom, query, body):
+    return 200, fake.routes(6)
+
+
+@monitor_handler('firewall', 'session')
+def _firewall_session(fake, method, vdom, query, body):
+    start = int(query.get('start', 0))
+    count = int(query.get('count', fake.session_count))
+    sessions = []
+    for i in range(start, min(fake.session_count, start + count)):
+        sessions.append({'saddr': '10.%d.%d.%d' % ((i >> 16) & 255, (i >> 8) & 255, i & 255),
+                         'daddr': '192.168.%d.%d' % ((i >> 8) & 255, i & 255),
+                         'sport': 1024 + i % 60000, 'dport': 443, 'proto': 6, 'proto_state': 1,
+                         'srcintf': 'port1', 'dstintf': 'port2', 'policyid': 1,
+                         'bytes': i * 100, 'packets': i})
+    return 200, sessions
+
+
+@monitor_handler('system', 'fortiguard/update', methods=('POST',))
+def _fortiguard_update(fake, method, vdom, query, body):
+    return 200, {}
+
+
+@monitor_handler('system', 'ha-checksums')
+def _ha_checksums(fake, method, vdom, query, body):
+    return 200, [{'is_manage_master': 1, 'is_root_master': 1, 'serial_no': fake.serial,
+                  'checksum': fake.checksums()}]
+
+
+@monitor_handler('system', 'config/backup')
+def _config_backup(fake, method, vdom, query, body):
+    # raw file, see FakeFortiOS._send_raw
+    return 200, fake.config_backup()
+
+
+@monitor_handler('system', 'config/restore', methods=('POST',))
+def _config_restore(fake, method, vdom, query, body):
+    fake.last_upload = body
+    return 200, {'bytes': len(body or b'')}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep alive as the Fortigate does
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment and flush per response
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        LOG.debug("fakefortios: " + format, *args)
+
+    def _dispatch(self):
+        try:
+            self.server.fake._handle(self)
+        except Exception as e:
+            LOG.exception("fakefortios failed on %s %s", self.command, self.path)
+            self.server.fake._send(self, 500, {'status': 'error', 'http_status': 500, 'error': str(e)})
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+    do_PUT = _dispatch
+    do_DELETE = _dispatch
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeFortiOS(object):
+    """
+    Local http server answering as a Fortigate REST API.
+
+    with FakeFortiOS(latency=0.005, table_sizes={('firewall', 'address'): 10000}) as fake:
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        fgt.login(fake.address, 'admin', '')
+
+    :param host: address to listen on
+    :param port: port, 0 to pick a free one
+    :param username: admin user name
+    :param password: admin password
+    :param apitoken: accepted api token (Authorization: Bearer), None to refuse tokens
+    :param version: firmware version answered
+    :param vdoms: list of the vdoms
+    :param latency: seconds added to every request
+    :param jitter: max random seconds added to latency
+    :param error_rate: probability (0-1) to answer error_status to a cmdb/monitor call
+    :param error_status: http status of the injected errors
+    :param table_sizes: dict (path, name): number of generated entries in the root vdom
+    :param session_count: number of sessions answered by monitor firewall/session
+    :param route_count: number of generated routes answered by monitor router/ipv4
+    :param session_timeout: seconds after which a login session expires (None for never)
+    :param atomic_batch: a json array POST (6.4+) creates all its objects or none, with False
+                         the valid ones are created and the answer gives the result of each
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, username='admin', password='', apitoken=None,
+                 version='v6.2.3', vdoms=('root',), latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=500, table_sizes=None, session_count=100, route_count=10,
+                 session_timeout=None, seed=None, atomic_batch=True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.apitoken = apitoken
+        self.version = version
+        self.build = 1066
+        self.serial = 'FGVMEVFAKE000001'
+        self.vdoms = list(vdoms)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.session_count = session_count
+        self.route_count = route_count
+        self.session_timeout = session_timeout
+        self.atomic_batch = atomic_batch
+        self.random = random.Random(seed)
+        self.revision = 1
+        self.tables = {}
+        self.settings = {}
+        self.schemas = {}
+        self.sessions = {}
+        self.stats = {'requests': 0, 'logins': 0, 'errors_injected': 0, 'methods': {}, 'endpoints': {}}
+        # body of the last config/restore upload
+        self.last_upload = None
+        self._injected = []
+        self._counter = 0
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+        for (path, name), (mkey, mkey_type, scope, children) in TABLES.items():
+            self.add_table(path, name, mkey=mkey, mkey_type=mkey_type, scope=scope, children=children)
+        for (path, name), (scope, values) in SETTINGS.items():
+            self.add_settings(path, name, values, scope=scope)
+        for vdom in self.vdoms:
+            self.table('global', 'system', 'vdom')[vdom] = {'name': vdom}
+        for i in range(1, 5):
+            self.table('global', 'system', 'interface')['port%d' % i] = {
+                'name': 'port%d' % i, 'vdom': self.vdoms[0], 'ip': '10.0.%d.1 255.255.255.0' % i,
+                'type': 'physical', 'allowaccess': 'ping https'}
+        self.table('root', 'firewall', 'address')['all'] = {'name': 'all', 'type': 'ipmask',
+                                                            'subnet': '0.0.0.0 0.0.0.0'}
+        self.table('root', 'firewall.service', 'custom')['ALL'] = {'name': 'ALL', 'protocol': 'IP',
+                                                                   'protocol-number': 0}
+        self.table('root', 'firewall.service', 'custom')['HTTPS'] = {'name': 'HTTPS', 'protocol': 'TCP/UDP/SCTP',
+                                                                     'tcp-portrange': '443'}
+        self.table('root', 'firewall.schedule', 'recurring')['always'] = {
+            'name': 'always', 'day': 'sunday monday tuesday wednesday thursday friday saturday',
+            'start': '00:00', 'end': '00:00'}
+        for (path, name), count in (table_sizes or {}).items():
+            self.populate(path, name, count)
+
+    # data model
+
+    def add_table(self, path, name, mkey='name', mkey_type='string', scope='vdom', children=None):
+        """
+        Declare a cmdb table, children is the schema of the fields
+        """
+        self.schemas[(path, name)] = {'name': name, 'path': path, 'category': 'table', 'mkey': mkey,
+                                      'mkey_type': mkey_type, 'scope': scope,
+                                      'children': children or {mkey: _field()}}
+
+    def add_settings(self, path, name, values, scope='vdom'):
+        """
+        Declare a cmdb settings object (no mkey) with its default values
+        """
+        self.schemas[(path, name)] = {'name': name, 'path': path, 'category': 'complex', 'scope': scope,
+                                      'children': dict((k, _field()) for k in values)}
+        for vdom in (['global'] if scope == 'global' else self.vdoms):
+            self.settings[(vdom, path, name)] = copy.deepcopy(values)
+
+    def _scope(self, vdom, path, name):
+        if self.schemas[(path, name)].get('scope') == 'global':
+            return 'global'
+        return vdom
+
+    def table(self, vdom, path, name):
+        """
+        :return: the OrderedDict mkey: object of a table
+        """
+        key = (self._scope(vdom, path, name), path, name)
+        with self._lock:
+            return self.tables.setdefault(key, OrderedDict())
+
+    def settings_object(self, vdom, path, name):
+        return self.settings.setdefault((self._scope(vdom, path, name), path, name), {})
+
+    def referenced(self, vdom, path, name, mkey):
+        """
+        True if an entry of a table uses the object (schema datasources), the
+        Fortigate refuses to delete it
+        """
+        prefix = '%s.%s.' % (path, name)
+        scope = self._scope(vdom, path, name)
+        with self._lock:
+            for (tscope, tpath, tname), table in self.tables.items():
+                if scope != 'global' and tscope not in (scope, 'global'):
+                    continue
+                children = self.schemas[(tpath, tname)]['children']
+                if any(_uses(children, entry, prefix, mkey) for entry in table.values()):
+                    return True
+        return False
+
+    def populate(self, path, name, count, vdom='root'):
+        """
+        Add count generated entries in a table
+        """
+        table = self.table(vdom, path, name)
+        schema = self.schemas[(path, name)]
+        mkey = schema['mkey']
+        start = len(table)
+        for i in range(start, start + count):
+            if schema['mkey_type'] == 'integer':
+                key = i + 1
+                while key in table:
+                    key += 1
+            else:
+                key = '%s-%d' % (name.replace('/', '-'), i)
+            obj = {mkey: key, 'q_origin_key': key}
+            if (path, name) == ('firewall', 'address'):
+                obj.update({'type': 'ipmask', 'subnet': '10.%d.%d.0 255.255.255.0' % ((i >> 8) & 255, i & 255)})
+            elif (path, name) == ('firewall', 'policy'):
+                obj.update({'name': 'policy-%d' % i, 'action': 'accept', 'status': 'enable',
+                            'srcintf': [{'name': 'port1'}], 'dstintf': [{'name': 'port2'}],
+                            'srcaddr': [{'name': 'all'}], 'dstaddr': [{'name': 'all'}],
+                            'service': [{'name': 'ALL'}], 'schedule': 'always'})
+            elif (path, name) == ('firewall.service', 'custom'):
+                obj.update({'protocol': 'TCP/UDP/SCTP', 'tcp-portrange': str(1024 + i % 60000)})
+            table[key] = obj
+
+    def routes(self, version=4):
+        routes = []
+        for intf in self.table('global', 'system', 'interface').values():
+            ip = intf.get('ip', '').split()
+            if version == 4 and len(ip) == 2:
+                prefix = sum(bin(int(b)).count('1') for b in ip[1].split('.'))
+                network = '.'.join(ip[0].split('.')[:3] + ['0'])
+                routes.append({'ip_version': 4, 'type': 'connect', 'ip_mask': '%s/%d' % (network, prefix),
+                               'distance': 0, 'metric': 0, 'priority': 0, 'vrf': 0,
+                               'gateway': '0.0.0.0', 'interface': intf['name']})
+        if version == 4:
+            routes.append({'ip_version': 4, 'type': 'static', 'ip_mask': '0.0.0.0/0', 'distance': 10,
+                           'metric': 0, 'priority': 0, 'vrf': 0, 'gateway': '10.0.1.254', 'interface': 'port1'})
+            for i in range(self.route_count):
+                routes.append({'ip_version': 4, 'type': 'static',
+                               'ip_mask': '172.%d.%d.0/24' % (16 + (i >> 8) % 16, i & 255),
+                               'distance': 10, 'metric': 0, 'priority': 0, 'vrf': 0,
+                               'gateway': '10.0.2.254', 'interface': 'port2'})
+        else:
+            routes.append({'ip_version': 6, 'type': 'static', 'ip_mask': '::/0', 'distance': 10,
+                           'metric': 0, 'priority': 1024, 'vrf': 0, 'gateway': 'fe80::1', 'interface': 'port1'})
+        return routes
+
+    def counter(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def checksums(self):
+        """
+        Config checksum of global, each vdom and all like ha-checksums gives
+        """
+        with self._lock:
+            scopes = {}
+            for (vdom, path, name), content in list(self.tables.items()) + list(self.settings.items()):
+                # list of items to keep the order of the entries (policies), the
+                # empty tables created by the reads do not change the checksum
+                if content:
+                    scopes.setdefault(vdom, []).append((path, name, list(content.items())))
+            checksums = {}
+            for scope in ['global'] + list(self.vdoms):
+                content = json.dumps(sorted(scopes.get(scope, []), key=lambda c: c[:2]), sort_keys=True)
+                checksums[scope] = hashlib.md5(content.encode('utf-8')).hexdigest()
+        checksums['all'] = hashlib.md5(''.join(checksums[k] for k in sorted(checksums)).encode('ascii')).hexdigest()
+        return checksums
+
+    def config_backup(self):
+        lines = ['#config-version=FGVM64-%s-FW-build%d:opmode=0:vdom=0' % (self.version[1:], self.build)]
+        for (vdom, path, name), values in sorted(self.settings.items()):
+            lines.append('config %s %s' % (path.replace('.', ' '), name.replace('/', ' ')))
+            for key, value in values.items():
+                lines.append('    set %s %s' % (key, _cli_value(value)))
+            lines.append('end')
+        for (vdom, path, name), table in sorted(self.tables.items()):
+            lines.append('config %s %s' % (path.replace('.', ' '), name.replace('/', ' ')))
+            for mkey, obj in table.items():
+                lines.append('    edit %s' % _cli_value(mkey))
+                for key, value in obj.items():
+                    if key in ('q_origin_key', self.schemas[(path, name)]['mkey']):
+                        continue
+                    lines.append('        set %s %s' % (key, _cli_value(value)))
+                lines.append('    next')
+            lines.append('end')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def inject_error(self, status=500, method=None, path=None, name=None, count=1):
+        """
+        Answer status to the next count requests matching method/path/name (None matches all)
+        """
+        with self._lock:
+            self._injected.append({'status': status, 'method': method, 'path': path, 'name': name,
+                                   'count': count})
+
+    # server
+
+    @property
+    def address(self):
+        """
+        host:port to give to FortiOSAPI.login (with https('off'))
+        """
+        return '%s:%d' % (self.host, self.port)
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # request handling
+
+    def _send(self, handler, status, payload, headers=None, content_type='application/json'):
+        if isinstance(payload, bytes):
+            body = payload
+        elif isinstance(payload, str) and content_type != 'application/json':
+            body = payload.encode('utf-8')
+        else:
+            body = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or []):
+            handler.send_header(key, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def _send_file(self, handler, status, content):
+        # downloads honour "Range: bytes=start-" to resume
+        match = re.match(r'bytes=(\d+)-$', handler.headers.get('Range') or '')
+        if status == 200 and match and int(match.group(1)) < len(content):
+            start = int(match.group(1))
+            headers = [('Content-Range', 'bytes %d-%d/%d' % (start, len(content) - 1, len(content)))]
+            return self._send(handler, 206, content[start:], headers=headers,
+                              content_type='application/octet-stream')
+        return self._send(handler, status, content, content_type='application/octet-stream')
+
+    def _envelope(self, method, vdom, path, name, status, http_status, results=None, **extra):
+        resp = OrderedDict([('http_method', method)])
+        if results is not None:
+            resp['results'] = results
+        resp.update([('vdom', vdom), ('path', path), ('name', name), ('status', status),
+                     ('http_status', http_status), ('serial', self.serial), ('version', self.version),
+                     ('build', self.build)])
+        resp.update(extra)
+        return resp
+
+    def _cookies(self, handler):
+        cookies = {}
+        for part in (handler.headers.get('Cookie') or '').split(';'):
+            if '=' in part:
+                key, value = part.strip().split('=', 1)
+                cookies[key] = value.strip('"')
+        return cookies
+
+    def _session_id(self, handler):
+        for key, value in self._cookies(handler).items():
+            if key.startswith('APSCOOKIE_'):
+                return value
+        return None
+
+    def _authenticated(self, handler, method):
+        auth = handler.headers.get('Authorization') or ''
+        if auth.startswith('Bearer '):
+            return self.apitoken is not None and auth[7:] == self.apitoken
+        session = self.sessions.get(self._session_id(handler))
+        if session is None:
+            return False
+        if self.session_timeout is not None and time.time() - session['last'] > self.session_timeout:
+            del self.sessions[self._session_id(handler)]
+            return False
+        session['last'] = time.time()
+        if method != 'GET' and handler.headers.get('X-CSRFTOKEN') != session['csrf']:
+            return False
+        return True
+
+    def _handle(self, handler):
+        method = handler.command
+        split = urlsplit(handler.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(split.query, keep_blank_values=True).items())
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['methods'][method] = self.stats['methods'].get(method, 0) + 1
+        if split.path == '/logincheck':
+            return self._login(handler, body)
+        if split.path == '/logout':
+            self.sessions.pop(self._session_id(handler), None)
+            return self._send(handler, 200, '', content_type='text/html')
+        if not split.path.startswith('/api/v2/'):
+            return self._send(handler, 404, 'not found', content_type='text/html')
+        if not self._authenticated(handler, method):
+            return self._send(handler, 401, self._envelope(method, None, None, None, 'error', 401))
+        parts = [unquote(p) for p in split.path[len('/api/v2/'):].split('/') if p != '']
+        if query.get('global') == '1':
+            vdom = 'global'
+        else:
+            vdom = query.get('vdom', 'root')
+        if len(parts) < 3:
+            if parts == ['cmdb'] and query.get('action') == 'schema':
+                return self._send(handler, 200, self._envelope(method, vdom, None, None, 'success', 200,
+                                                               results=list(self.schemas.values())))
+            return self._send(handler, 404, self._envelope(method, vdom, None, None, 'error', 404))
+        kind, path, rest = parts[0], parts[1], parts[2:]
+        with self._lock:
+            self.stats['endpoints'][(method, kind, path, rest[0])] = \
+                self.stats['endpoints'].get((method, kind, path, rest[0]), 0) + 1
+            injected = self._take_injected(method, path, '/'.join(rest))
+        if injected is not None:
+            return self._send(handler, injected, self._envelope(method, vdom, path, rest[0], 'error', injected))
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self._lock:
+                self.stats['errors_injected'] += 1
+            return self._send(handler, self.error_status,
+                              self._envelope(method, vdom, path, rest[0], 'error', self.error_status))
+        if kind == 'cmdb':
+            status, payload = self._cmdb(method, vdom, path, rest, query, body)
+        elif kind == 'monitor':
+            status, payload = self._monitor(method, vdom, path, rest, query, body)
+            if isinstance(payload, bytes):
+                return self._send_file(handler, status, payload)
+        else:
+            status, payload = 404, self._envelope(method, vdom, path, None, 'error', 404)
+        if query.get('global') == '1':
+            # with global=1 the API answers a list with one response per vdom
+            payload = [payload]
+        return self._send(handler, status, payload)
+
+    def _take_injected(self, method, path, name):
+        for injected in self._injected:
+            if ((injected['method'] is None or injected['method'] == method) and
+                    (injected['path'] is None or injected['path'] == path) and
+                    (injected['name'] is None or name.startswith(injected['name']))):
+                injected['count'] -= 1
+                if injected['count'] <= 0:
+                    self._injected.remove(injected)
+                self.stats['errors_injected'] += 1
+                return injected['status']
+        return None
+
+    def _login(self, handler, body):
+        form = dict((k, v[-1]) for k, v in parse_qs(body.decode('utf-8'), keep_blank_values=True).items())
+        with self._lock:
+            self.stats['logins'] += 1
+        if form.get('username') != self.username or form.get('secretkey', '') != self.password:
+            return self._send(handler, 200, '0', content_type='text/html')
+        session = uuid.uuid4().hex
+        csrf = uuid.uuid4().hex.upper()
+        with self._lock:
+            self.sessions[session] = {'csrf': csrf, 'last': time.time(), 'user': self.username}
+        headers = [('Set-Cookie', 'APSCOOKIE_%s="%s"; path=/' % (self.serial, session)),
+                   ('Set-Cookie', 'ccsrftoken="%s"; path=/' % csrf)]
+        return self._send(handler, 200, '1', headers=headers, content_type='text/html')
+
+    def _split(self, path, rest):
+        # find the table/settings name (which can contain /) and the mkey in the url
+        for size in range(len(rest), 0, -1):
+            name = '/'.join(rest[:size])
+            if (path, name) in self.schemas:
+                mkey = '/'.join(rest[size:]) or None
+                return name, mkey
+        return None, None
+
+    def _cmdb(self, method, vdom, path, rest, query, body):
+        name, mkey = self._split(path, rest)
+        if name is None:
+            return 404, self._envelope(method, vdom, path, '/'.join(rest), 'error', 404, error=-3)
+        schema = self.schemas[(path, name)]
+        if query.get('action') == 'schema':
+            return 200, self._envelope(method, vdom, path, name, 'success', 200, results=schema)
+        if vdom != 'global' and vdom not in self.vdoms:
+            return 404, self._envelope(method, vdom, path, name, 'error', 404, error=-3)
+        try:
+            data = json.loads(body.decode('utf-8')) if body else None
+        except ValueError:
+            return 400, self._envelope(method, vdom, path, name, 'error', 400, error=-651)
+        with self._lock:
+            if schema['category'] != 'table':
+                return self._settings(method, vdom, path, name, data, query)
+            return self._table(method, vdom, path, name, mkey, schema, data, query)
+
+    def _settings(self, method, vdom, path, name, data, query):
+        values = self.settings_object(vdom, path, name)
+        if method == 'GET':
+            return 200, self._envelope(method, vdom, path, name, 'success', 200,
+                                       results=_format(values, query.get('format')))
+        if method in ('PUT', 'POST') and isinstance(data, dict):
+            values.update(data)
+            self.revision += 1
+            return 200, self._envelope(method, vdom, path, name, 'success', 200, revision=self.revision)
+        return 405, self._envelope(method, vdom, path, name, 'error', 405)
+
+    def _mkey(self, schema, value):
+        if value is None:
+            return None
+        if schema['mkey_type'] == 'integer':
+            try:
+                return int(value)
+            except ValueError:
+                return value
+        return value
+
+    def _table(self, method, vdom, path, name, mkey, schema, data, query):
+        table = self.table(vdom, path, name)
+        mkeyname = schema['mkey']
+        mkey = self._mkey(schema, mkey)
+        if method == 'GET':
+            if mkey is not None:
+                if mkey not in table:
+                    return 404, self._envelope(method, vdom, path, name, 'error', 404, mkey=mkey, error=-3)
+                return 200, self._envelope(method, vdom, path, name, 'success', 200, mkey=mkey,
+                                           results=[_format(table[mkey], query.get('format'))])
+            entries = list(table.values())
+            total = len(entries)
+            if 'start' in query or 'count' in query:
+                start = int(query.get('start') or 0)
+                count = int(query.get('count') or total)
+                entries = entries[start:start + count]
+            return 200, self._envelope(method, vdom, path, name, 'success', 200, matched_count=total,
+                                       results=[_format(e, query.get('format')) for e in entries])
+        if method == 'POST':
+            if isinstance(data, list) and _version(self.version) >= (6, 4):
+                return self._create_many(vdom, path, name, schema, table, data)
+            if not isinstance(data, dict):
+                return 500, self._envelope(method, vdom, path, name, 'error', 500, error=-651)
+            return self._create(vdom, path, name, schema, table, data)
+        if method == 'PUT':
+            if mkey is None:
+                return 405, self._envelope(method, vdom, path, name, 'error', 405)
+            if mkey not in table:
+                return 404, self._envelope(method, vdom, path, name, 'error', 404, mkey=mkey, error=-3)
+            if query.get('action') == 'move':
+                return self._move(vdom, path, name, table, mkey, query)
+            if isinstance(data, dict):
+                table[mkey].update(data)
+                table[mkey][mkeyname] = mkey
+            self.revision += 1
+            return 200, self._envelope(method, vdom, path, name, 'success', 200, mkey=mkey,
+                                       revision=self.revision)
+        if method == 'DELETE':
+            if mkey is None:
+                table.clear()
+            elif mkey not in table:
+                return 404, self._envelope(method, vdom, path, name, 'error', 404, mkey=mkey, error=-3)
+            elif self.referenced(vdom, path, name, mkey):
+                # entry is used
+                return 500, self._envelope(method, vdom, path, name, 'error', 500, mkey=mkey, error=-23)
+            else:
+                del table[mkey]
+            self.revision += 1
+            return 200, self._envelope(method, vdom, path, name, 'success', 200, mkey=mkey,
+                                       revision=self.revision)
+        return 405, self._envelope(method, vdom, path, name, 'error', 405)
+
+    def _create(self, vdom, path, name, schema, table, data):
+        mkeyname = schema['mkey']
+        mkey = self._mkey(schema, data.get(mkeyname))
+        if schema['mkey_type'] == 'integer' and not mkey:
+            # 0 or missing: the Fortigate allocates the id
+            mkey = max([k for k in table if isinstance(k, int)] or [0]) + 1
+        if mkey is None or mkey == '':
+            return 500, self._envelope('POST', vdom, path, name, 'error', 500, error=-651)
+        if mkey in table:
+            return 500, self._envelope('POST', vdom, path, name, 'error', 500, mkey=mkey, error=-5)
+        obj = copy.deepcopy(data)
+        obj[mkeyname] = mkey
+        obj['q_origin_key'] = mkey
+        table[mkey] = obj
+        self.revision += 1
+        return 200, self._envelope('POST', vdom, path, name, 'success', 200, mkey=mkey,
+                                   revision=self.revision)
+
+    def _create_many(self, vdom, path, name, schema, table, data):
+        # atomic: a json array is created entirely or not at all, the error is
+        # the one of the first object failing; else each object gets its result
+        entries = list(table.items())
+        revision = self.revision
+        results = []
+        for obj in data:
+            if isinstance(obj, dict):
+                status, resp = self._create(vdom, path, name, schema, table, obj)
+            else:
+                status, resp = 500, self._envelope('POST', vdom, path, name, 'error', 500, error=-651)
+            if status != 200 and self.atomic_batch:
+                table.clear()
+                table.update(entries)
+                self.revision = revision
+                return status, resp
+            result = {'mkey': resp.get('mkey'), 'status': resp['status'], 'http_status': status}
+            if status != 200:
+                result['error'] = resp.get('error')
+            results.append(result)
+        if any(r['status'] != 'success' for r in results):
+            return 500, self._envelope('POST', vdom, path, name, 'error', 500, results=results,
+                                       revision=self.revision)
+        return 200, self._envelope('POST', vdom, path, name, 'success', 200, results=results,
+                                   revision=self.revision)
+
+    def _move(self, vdom, path, name, table, mkey, query):
+        where = 'before' if 'before' in query else 'after'
+        reference = self._mkey(self.schemas[(path, name)], query.get(where))
+        if reference not in table:
+            return 404, self._envelope('PUT', vdom, path, name, 'error', 404, mkey=reference, error=-3)
+        if reference == mkey:
+            return 200, self._envelope('PUT', vdom, path, name, 'success', 200, mkey=mkey, revision=self.revision)
+        obj = table.pop(mkey)
+        items = list(table.items())
+        index = [k for k, v in items].index(reference)
+        if where == 'after':
+            index += 1
+        items.insert(index, (mkey, obj))
+        table.clear()
+        table.update(items)
+        self.revision += 1
+        return 200, self._envelope('PUT', vdom, path, name, 'success', 200, mkey=mkey, revision=self.revision)
+
+    def _monitor(self, method, vdom, path, rest, query, body):
+        name = '/'.join(rest)
+        handler = MONITOR_HANDLERS.get((method, path, name))
+        if handler is None:
+            return 404, self._envelope(method, vdom, path, name, 'error', 404)
+        status, results = handler(self, method, vdom, query, body)
+        if isinstance(results, bytes):
+            return status, results
+        return status, self._envelope(method, vdom, path, name, 'success' if status == 200 else 'error',
+                                      status, results=results)
+
+
+def _uses(children, entry, prefix, mkey):
+    # entry has a field whose datasource is in the table prefix with the value mkey
+    for field, child in children.items():
+        value = entry.get(field)
+        if value is None or value == '' or not isinstance(child, dict):
+            continue
+        values = value if isinstance(value, list) else [value]
+        if any(s.startswith(prefix) and '.' not in s[len(prefix):] for s in child.get('datasource') or ()):
+            if any(str(v) == str(mkey) for v in values if not isinstance(v, dict)):
+                return True
+        elif child.get('children'):
+            if any(isinstance(v, dict) and _uses(child['children'], v, prefix, mkey) for v in values):
+                return True
+    return False
+
+
+def _version(version):
+    # (major, minor) of a firmware version like v6.4.5
+    return tuple(int(n) for n in re.findall(r'\d+', version)[:2])
+
+
+def _format(obj, fmt):
+    # format=name|subnet restricts the answered fields
+    if not fmt:
+        return obj
+    fields = fmt.split('|')
+    return dict((k, v) for k, v in obj.items() if k in fields)
+
+
+def _cli_value(value):
+    if isinstance(value, list):
+        return ' '.join(_cli_value(v.get('name', '') if isinstance(v, dict) else v) for v in value)
+    if isinstance(value, dict):
+        return ''
+    value = str(value)
+    if value.isdigit():
+        return value
+    return '"%s"' % value.replace('"', '\\"')
@@ -0,0 +1,1438 @@
+#!/usr/bin/env python
+# Copyright 2015 Fortinet, Inc.
+#
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+###################################################################
+#
+# fortiosapi.py unit test running against the in process fake
+# Fortigate (fakefortios.py) so no VM is needed.
+#
+###################################################################
+from fortiosapi import (APIError, CLIConfig, CMDBMirror, FortiOSAPI, FortiOSFleet, MonitorPoller,
+                        MultipartStream, PolicyLookup, ReferenceIndex, RequestMetrics, RequestPolicy,
+                        ResponseCache, RoutingTable, SchemaCache, SessionCache)
+from fortiosapi.metrics import RequestContext
+
+from fakefortios import FakeFortiOS
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class FakeFortiOSTestCase(unittest.TestCase):
+    """
+    A fake Fortigate started for the class and a FortiOSAPI logged on it for each test
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeFortiOS(apitoken="testtoken", table_sizes={('firewall', 'address'): 250})
+        cls.fake.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.fgt = FortiOSAPI()
+        self.fgt.https('off')
+        self.fgt.login(self.fake.address, 'admin', '')
+
+    def tearDown(self):
+        self.fgt.logout()
+
+    def client(self, **kwargs):
+        # another FortiOSAPI logged on the fake, logged out at the end of the test
+        fgt = FortiOSAPI(**kwargs)
+        fgt.https('off')
+        fgt.login(self.fake.address, 'admin', '')
+        self.addCleanup(fgt.logout)
+        return fgt
+
+
+class TestFortiOSAPIFake(FakeFortiOSTestCase):
+
+    def test_00login(self):
+        self.assertEqual(self.fgt.get_version(), 'v6.2.3')
+
+    def test_tokenlogin(self):
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        self.assertTrue(fgt.tokenlogin(self.fake.address, "testtoken"))
+        self.assertEqual(fgt.get('firewall', 'address', mkey='all')['status'], 'success')
+
+    def test_wrong_password(self):
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        self.assertRaises(Exception, fgt.login, self.fake.address, 'admin', 'wrong')
+
+    def test_set_get_delete(self):
+        data = {'name': 'test-set', 'subnet': '10.10.10.0 255.255.255.0'}
+        self.assertEqual(self.fgt.set('firewall', 'address', data=data, vdom="root")['status'], 'success')
+        data['comment'] = "updated"
+        self.assertEqual(self.fgt.set('firewall', 'address', data=data, vdom="root")['status'], 'success')
+        resp = self.fgt.get('firewall', 'address', mkey='test-set', vdom="root")
+        self.assertEqual(resp['results'][0]['comment'], "updated")
+        self.assertEqual(self.fgt.delete('firewall', 'address', mkey='test-set', vdom="root")['status'],
+                         'success')
+        self.assertEqual(self.fgt.get('firewall', 'address', mkey='test-set', vdom="root")['http_status'], 404)
+
+    def test_global(self):
+        resp = self.fgt.get('system', 'global', vdom="global")
+        self.assertEqual(resp['vdom'], "global")
+        self.assertEqual(resp['results']['hostname'], "FGT-FAKE")
+
+    def test_move(self):
+        for policyid in (101, 102):
+            self.fgt.set('firewall', 'policy', data={'policyid': policyid, 'name': 'p%d' % policyid},
+                         vdom="root")
+        resp = self.fgt.move('firewall', 'policy', vdom="root", mkey=102, where="before", reference_key=101)
+        self.assertEqual(resp['status'], 'success')
+        order = list(self.fake.table('root', 'firewall', 'policy'))
+        self.assertLess(order.index(102), order.index(101))
+
+    def test_move_parameters(self):
+        for policyid in (111, 112):
+            self.fgt.set('firewall', 'policy', data={'policyid': policyid, 'name': 'p%d' % policyid},
+                         vdom="root")
+        parameters = {}
+        self.fgt.move('firewall', 'policy', vdom="root", mkey=112, where="before", reference_key=111,
+                      parameters=parameters)
+        self.assertEqual(parameters, {})
+        self.fgt.move('firewall', 'policy', vdom="root", mkey=111, where="before", reference_key=112)
+        resp = self.fgt.move('firewall', 'policy', vdom="root", mkey=112, where="after", reference_key=111)
+        self.assertEqual(resp['status'], 'success')
+        order = list(self.fake.table('root', 'firewall', 'policy'))
+        self.assertLess(order.index(111), order.index(112))
+
+
+class TestSchemaCache(FakeFortiOSTestCase):
+
+    def test_schema_cache(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            cache = SchemaCache(directory=cachedir)
+            fgt = FortiOSAPI(schema_cache=cache)
+            fgt.https('off')
+            fgt.login(self.fake.address, 'admin', '')
+            for _ in range(3):
+                self.assertEqual(fgt.get_mkeyname('firewall', 'policy', vdom="root"), 'policyid')
+            self.assertEqual(cache.stats()['misses'], 1)
+            # a new process would find it on disk
+            other = SchemaCache(directory=cachedir)
+            self.assertIsNotNone(other.get('v6.2.3', 'firewall', 'policy', vdom="root"))
+            self.assertEqual(fgt.invalidate_schema('firewall', 'policy'), 1)
+            self.assertIsNone(SchemaCache(directory=cachedir).get('v6.2.3', 'firewall', 'policy', vdom="root"))
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_shared_between_clients(self):
+        cache = SchemaCache()
+        schemas = []
+
+        def count(context):
+            if context.kind == 'schema':
+                schemas.append((context.path, context.name))
+
+        for _ in range(3):
+            fgt = self.client(schema_cache=cache)
+            fgt.add_hook('before_request', count)
+            self.assertEqual(fgt.get_mkeyname('firewall', 'address', vdom="root"), 'name')
+            self.assertEqual(fgt.get_mkey('firewall', 'address', {'name': 'a'}, vdom="root"), 'a')
+        self.assertEqual(schemas, [('firewall', 'address')])
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_keyed_by_version(self):
+        cache = SchemaCache()
+        self.assertEqual(self.client(schema_cache=cache).get_mkeyname('firewall', 'policy', vdom="root"),
+                         'policyid')
+        fake = FakeFortiOS(version='v7.0.12')
+        fake.start()
+        try:
+            fgt = FortiOSAPI(schema_cache=cache)
+            fgt.https('off')
+            fgt.login(fake.address, 'admin', '')
+            self.assertEqual(fgt.get_mkeyname('firewall', 'policy', vdom="root"), 'policyid')
+            fgt.logout()
+        finally:
+            fake.stop()
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertIsNotNone(cache.get('v6.2.3', 'firewall', 'policy', vdom="root"))
+        self.assertIsNotNone(cache.get('v7.0.12', 'firewall', 'policy', vdom="root"))
+
+    def test_errors_not_cached(self):
+        cache = SchemaCache()
+        fgt = self.client(schema_cache=cache)
+        for _ in range(2):
+            self.assertEqual(fgt.schema('firewall', 'nothing', vdom="root")['http_status'], 404)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 2, 'disk_hits': 0, 'size': 0})
+
+
+@unittest.skipIf(aiohttp is None, "AsyncFortiOSAPI needs aiohttp")
+class TestAsyncFortiOSAPI(FakeFortiOSTestCase):
+
+    @staticmethod
+    def run_async(coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_gather(self):
+        import asyncio
+        from fortiosapi import AsyncFortiOSAPI
+
+        async def run():
+            fgt = AsyncFortiOSAPI()
+            fgt.https('off')
+            await fgt.login(self.fake.address, 'admin', '')
+            results = await asyncio.gather(*[fgt.get('firewall', 'address', mkey='all', vdom="root")
+                                             for _ in range(5)])
+            await fgt.logout()
+            return results
+
+        results = self.run_async(run())
+        self.assertEqual([r['status'] for r in results], ['success'] * 5)
+
+    def test_bulk_and_paging(self):
+        import asyncio
+        from fortiosapi import AsyncFortiOSAPI
+
+        objects = [{'name': 'async-%d' % i, 'subnet': '10.50.%d.0 255.255.255.0' % i} for i in range(20)]
+
+        async def run():
+            fgt = AsyncFortiOSAPI(response_cache=ResponseCache(ttl=30))
+            fgt.https('off')
+            await fgt.login(self.fake.address, 'admin', '')
+            fgt.existence_index('on')
+            created = await fgt.set_many('firewall', 'address', objects, vdom="root", concurrency=4)
+            names = [a['name'] async for a in fgt.iter_table('firewall', 'address', vdom="root", page_size=100)]
+            sessions = [s async for s in fgt.iter_monitor('firewall', 'session', vdom="root", page_size=30)]
+            # the write dropped the cached reads, identical reads in flight are sent once
+            gets = self.fake.stats['methods']['GET']
+            reads = await asyncio.gather(*[fgt.get('firewall', 'address', vdom="root") for _ in range(5)])
+            gets = self.fake.stats['methods']['GET'] - gets
+            deleted = await fgt.delete_many('firewall', 'address', objects, vdom="root", concurrency=4)
+            # the Fortigate forgets the session, the next call logs in again
+            logins = self.fake.stats['logins']
+            self.fake.sessions.clear()
+            status = await fgt.monitor('system', 'status', vdom="root")
+            relogins = self.fake.stats['logins'] - logins
+            await fgt.logout()
+            return created, names, sessions, reads, gets, deleted, status, relogins
+
+        created, names, sessions, reads, gets, deleted, status, relogins = self.run_async(run())
+        self.assertEqual((created['success'], created['error']), (20, 0))
+        self.assertEqual([r['mkey'] for r in created['results']], [o['name'] for o in objects])
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue(set(o['name'] for o in objects) <= set(names))
+        self.assertEqual(len(sessions), self.fake.session_count)
+        self.assertEqual(gets, 1)
+        self.assertEqual(len(set(id(r) for r in reads)), 1)
+        self.assertEqual(deleted['success'], 20)
+        self.assertNotIn('async-0', self.fake.table('root', 'firewall', 'address'))
+        self.assertEqual(status['status'], 'success')
+        self.assertEqual(relogins, 1)
+
+    def test_methods(self):
+        import inspect
+        from fortiosapi import AsyncFortiOSAPI
+
+        fgt = AsyncFortiOSAPI()
+        # every call doing requests is a coroutine (or an async iterator)
+        for name in ('login', 'tokenlogin', 'logout', 'get', 'monitor', 'schema', 'post', 'put', 'set',
+                     'delete', 'move', 'execute', 'download', 'download_stream', 'upload', 'license',
+                     'get_mkey', 'get_mkeyname', 'get_name_path_dict', 'cmdb_schemas', 'set_many',
+                     'delete_many', 'post_batch', 'planoverlayconfig', 'setoverlayconfig', '_request', '_relogin',
+                     '_table_mkeys'):
+            self.assertTrue(inspect.iscoroutinefunction(getattr(AsyncFortiOSAPI, name)), name)
+        self.assertTrue(hasattr(fgt.iter_table('firewall', 'address'), '__anext__'))
+
+    def test_overlay_download_stats(self):
+        from fortiosapi import AsyncFortiOSAPI
+
+        overlay = {'firewall': {'addrgrp': {'grp-aov': {'member': [{'name': 'aov-1'}]}},
+                                'address': dict(('aov-%d' % i, {'subnet': '10.52.%d.0/24' % i}) for i in range(6))}}
+        sink = io.BytesIO()
+
+        async def run():
+            fgt = AsyncFortiOSAPI()
+            fgt.https('off')
+            await fgt.login(self.fake.address, 'admin', '')
+            plan = await fgt.setoverlayconfig(overlay, vdom="root", diff=True, concurrency=4)
+            again = await fgt.planoverlayconfig(overlay, vdom="root")
+            download = await fgt.download_stream('system', 'config/backup', sink, chunk_size=1024,
+                                                 compression='gzip')
+            stats = fgt.connection_stats()
+            await fgt.delete('firewall', 'addrgrp', mkey='grp-aov', vdom="root")
+            await fgt.delete_many('firewall', 'address', list(overlay['firewall']['address']), vdom="root")
+            await fgt.logout()
+            return plan, again, download, stats
+
+        plan, again, download, stats = self.run_async(run())
+        self.assertEqual(plan.summary(), {'created': 7, 'updated': 0, 'skipped': 0, 'failed': 0})
+        self.assertEqual(again.skipped, 7)
+        self.assertTrue(download['complete'])
+        backup = gzip.GzipFile(fileobj=io.BytesIO(sink.getvalue())).read()
+        self.assertIn(b'aov-5', backup)
+        self.assertEqual(download['checksum'], hashlib.sha256(backup).hexdigest())
+        self.assertEqual(len(stats), 1)
+        self.assertGreater(stats[0]['requests'], stats[0]['connections'])
+
+    def test_set_put_move_delete(self):
+        from fortiosapi import AsyncFortiOSAPI
+
+        async def run():
+            fgt = AsyncFortiOSAPI()
+            fgt.https('off')
+            await fgt.login(self.fake.address, 'admin', '')
+            results = [await fgt.set('firewall', 'address', {'name': 'async-crud', 'subnet': '10.51.0.0/24'},
+                                     vdom="root"),
+                       await fgt.put('firewall', 'address', vdom="root",
+                                     data={'name': 'async-crud', 'comment': 'put'}),
+                       await fgt.post('firewall', 'policy', {'policyid': 301, 'name': 'async-1'}, vdom="root"),
+                       await fgt.post('firewall', 'policy', {'policyid': 302, 'name': 'async-2'}, vdom="root"),
+                       await fgt.move('firewall', 'policy', vdom="root", mkey=302, where='before',
+                                      reference_key=301)]
+            comment = (await fgt.get('firewall', 'address', mkey='async-crud', vdom="root"))['results'][0]
+            results += [await fgt.delete('firewall', 'address', mkey='async-crud', vdom="root"),
+                        await fgt.delete('firewall', 'policy', mkey=301, vdom="root"),
+                        await fgt.delete('firewall', 'policy', mkey=302, vdom="root")]
+            await fgt.logout()
+            return results, comment
+
+        results, entry = self.run_async(run())
+        self.assertEqual([r['status'] for r in results], ['success'] * 8)
+        self.assertEqual(entry['comment'], 'put')
+        self.assertNotIn('async-crud', self.fake.table('root', 'firewall', 'address'))
+
+    def test_tokenlogin(self):
+        from fortiosapi import AsyncFortiOSAPI
+        from fortiosapi.exceptions import NotLogged
+
+        async def run(token):
+            fgt = AsyncFortiOSAPI()
+            fgt.https('off')
+            try:
+                await fgt.tokenlogin(self.fake.address, token)
+                return (await fgt.get('firewall', 'address', mkey='all', vdom="root"))['status']
+            finally:
+                await fgt.close()
+
+        self.assertEqual(self.run_async(run("testtoken")), 'success')
+        self.assertRaises(NotLogged, self.run_async, run("badtoken"))
+
+
+class TestFortiOSFleet(FakeFortiOSTestCase):
+
+    def test_fleet(self):
+        fleet = FortiOSFleet(concurrency=4)
+        fleet.add(self.fake.address, username='admin', password='', https=False)
+        fleet.add('127.0.0.1:1', username='admin', password='', https=False, timeout=1)
+        logins = dict((r.host, r) for r in fleet.login())
+        self.assertTrue(logins[self.fake.address].ok)
+        self.assertFalse(logins['127.0.0.1:1'].ok)
+        results = fleet.run_all('monitor', 'system', 'status', hosts=[self.fake.address])
+        self.assertEqual(results[self.fake.address].result['status'], 'success')
+        self.assertEqual(fleet.stats()['count'], 1)
+        fleet.logout()
+
+    def test_tokens_and_shared_schemas(self):
+        other = FakeFortiOS(apitoken="othertoken")
+        other.start()
+        try:
+            fleet = FortiOSFleet(concurrency=2)
+            fleet.add(self.fake.address, username='admin', password='', https=False)
+            fleet.add(other.address, apitoken='othertoken', https=False)
+            self.assertTrue(all(r.ok for r in fleet.login()))
+            # same firmware: the schema fetched on one device is used for the other
+            for host in (self.fake.address, other.address):
+                results = fleet.run_all('get_mkeyname', 'firewall', 'policy', vdom="root", hosts=[host])
+                self.assertEqual(results[host].result, 'policyid')
+            self.assertEqual(fleet.schema_cache.stats()['misses'], 1)
+            self.assertEqual(len(fleet.logout()), 2)
+        finally:
+            other.stop()
+
+    def test_bounded_concurrency(self):
+        fleet = FortiOSFleet(concurrency=3)
+        for i in range(8):
+            fleet.add('10.0.0.%d' % i, apitoken='token')
+        hosts = dict((id(client), host) for host, client in fleet.clients.items())
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def call(client):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            if hosts[id(client)] == '10.0.0.7':
+                raise ValueError("failed")
+            return hosts[id(client)]
+
+        results = list(fleet.call(call))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(running[1], 3)
+        self.assertEqual([r.host for r in results if not r.ok], ['10.0.0.7'])
+        stats = fleet.stats()
+        self.assertEqual((stats['count'], stats['errors']), (8, 1))
+        self.assertGreaterEqual(stats['wall'], 0.15)
+
+    def test_latency_summary(self):
+        from fortiosapi.fleet import latency_summary
+        summary = latency_summary([float(i) for i in range(1, 101)])
+        self.assertEqual((summary['min'], summary['max'], summary['avg']), (1.0, 100.0, 50.5))
+        self.assertEqual((summary['p50'], summary['p90'], summary['p99']), (51.0, 90.0, 99.0))
+        self.assertEqual(latency_summary([]), {'count': 0})
+
+
+class TestBulkCalls(FakeFortiOSTestCase):
+
+    def test_set_many_delete_many(self):
+        objects = [{'name': 'bulk-%d' % i, 'subnet': '10.20.%d.0 255.255.255.0' % i} for i in range(40)]
+        summary = self.fgt.set_many('firewall', 'address', objects, vdom="root", concurrency=8)
+        self.assertEqual(summary['success'], 40)
+        self.assertEqual([r['mkey'] for r in summary['results']], [o['name'] for o in objects])
+        summary = self.fgt.delete_many('firewall', 'address', [o['name'] for o in objects] + ['missing'],
+                                       vdom="root")
+        self.assertEqual(summary['success'], 40)
+        self.assertEqual(summary['error'], 1)
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        inflight = [0, 0]
+        done = []
+        ahead = []
+
+        def before(context):
+            with lock:
+                inflight[0] += 1
+                inflight[1] = max(inflight)
+
+        def after(context, response):
+            with lock:
+                inflight[0] -= 1
+                done.append(context.mkey)
+
+        def objects():
+            # the objects are read as the calls complete, not all at once
+            for i in range(60):
+                ahead.append(i - len(done))
+                yield {'name': 'bounded-%d' % i, 'subnet': '10.21.%d.0 255.255.255.0' % i}
+
+        self.fgt.get_mkeyname('firewall', 'address', vdom="root")
+        self.fgt.add_hook('before_request', before)
+        self.fgt.add_hook('after_response', after)
+        self.fake.latency = 0.005
+        try:
+            summary = self.fgt.set_many('firewall', 'address', objects(), vdom="root", concurrency=4)
+        finally:
+            self.fake.latency = 0.0
+        self.assertEqual(summary['success'], 60)
+        self.assertTrue(1 < inflight[1] <= 4)
+        self.assertLess(max(ahead), 2 * 4)
+        # mkeys or objects
+        summary = self.fgt.delete_many('firewall', 'address', ['bounded-%d' % i for i in range(30)] +
+                                       [{'name': 'bounded-%d' % i} for i in range(30, 60)], vdom="root")
+        self.assertEqual(summary['success'], 60)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, self.fgt.set_many, 'system', 'global', [{'hostname': 'fgt'}], vdom="root")
+        self.fake.inject_error(503, method='PUT', path='firewall', name='address/bulk-err-1')
+        objects = [{'name': 'bulk-err-%d' % i} for i in range(3)]
+        summary = self.fgt.set_many('firewall', 'address', objects, vdom="root")
+        self.assertEqual((summary['success'], summary['error']), (2, 1))
+        self.assertEqual(summary['results'][1]['http_status'], 503)
+        self.assertEqual(summary['results'][1]['response']['status'], 'error')
+        self.fgt.delete_many('firewall', 'address', objects, vdom="root")
+
+
+class TestPaging(FakeFortiOSTestCase):
+
+    def test_iter_table(self):
+        names = [a['name'] for a in self.fgt.iter_table('firewall', 'address', vdom="root", page_size=100)]
+        self.assertEqual(len(names), len(self.fake.table('root', 'firewall', 'address')))
+        self.assertEqual(len(set(names)), len(names))
+
+    def test_iter_monitor(self):
+        sessions = list(self.fgt.iter_monitor('firewall', 'session', vdom="root", page_size=30))
+        self.assertEqual(len(sessions), self.fake.session_count)
+
+    def test_pages(self):
+        table = self.fake.table('root', 'firewall', 'address')
+        for prefetch in (True, False):
+            gets = self.fake.stats['endpoints'].get(('GET', 'cmdb', 'firewall', 'address'), 0)
+            entries = list(self.fgt.iter_table('firewall', 'address', vdom="root", parameters={'format': 'name'},
+                                               page_size=100, prefetch=prefetch))
+            self.assertEqual([e['name'] for e in entries], [e['name'] for e in table.values()])
+            self.assertEqual(set(len(e) for e in entries), set([1]))
+            # the last page is shorter, no request for an empty page
+            pages = -(-len(table) // 100)
+            self.assertEqual(self.fake.stats['endpoints'][('GET', 'cmdb', 'firewall', 'address')] - gets, pages)
+
+    def test_stop_and_errors(self):
+        entries = self.fgt.iter_table('firewall', 'address', vdom="root", page_size=10)
+        self.assertEqual(len([e for _, e in zip(range(15), entries)]), 15)
+        entries.close()
+        self.fake.inject_error(500, method='GET', path='firewall', name='address')
+        self.assertRaises(APIError, list, self.fgt.iter_table('firewall', 'address', vdom="root"))
+
+
+class TestHooksMetrics(FakeFortiOSTestCase):
+
+    def test_metrics(self):
+        metrics = RequestMetrics().attach(self.fgt)
+        self.fgt.get('firewall', 'address', vdom="root")
+        self.fgt.monitor('system', 'status')
+        endpoints = dict((e['endpoint'], e) for e in metrics.report())
+        self.assertEqual(endpoints['cmdb/firewall/address']['count'], 1)
+        self.assertEqual(endpoints['monitor/system/status']['status'], {200: 1})
+        self.assertGreater(endpoints['cmdb/firewall/address']['bytes_in'], 0)
+        # a streamed download is counted with its Content-Length
+        result = self.fgt.download_stream('system', 'config/backup', io.BytesIO())
+        endpoints = dict((e['endpoint'], e) for e in metrics.report())
+        self.assertEqual(endpoints['monitor/system/config/backup']['bytes_in'], result['bytes'])
+
+    def test_hooks(self):
+        events = []
+
+        def failing(context):
+            raise ValueError("hook bug")
+
+        self.fgt.get_mkeyname('firewall', 'address', vdom="root")
+        self.fgt.add_hook('before_request', lambda context: events.append(('before', context)))
+        self.fgt.add_hook('before_request', failing)
+        self.fgt.add_hook('after_response', lambda context, res: events.append(('after', res.status_code)))
+        data = {'name': 'hooked-1', 'subnet': '10.22.0.0 255.255.255.0'}
+        # a failing hook does not fail the request
+        self.assertEqual(self.fgt.set('firewall', 'address', data=data, vdom="root")['status'], 'success')
+        self.assertEqual([e[0] for e in events], ['before', 'after', 'before', 'after'])
+        context = events[0][1]
+        self.assertEqual((context.method, context.kind, context.endpoint, context.mkey, context.vdom),
+                         ('PUT', 'cmdb', 'cmdb/firewall/address', 'hooked-1', 'root'))
+        self.assertIs(context.data, data)
+        self.assertGreater(context.bytes_out, 0)
+        self.assertIsNotNone(context.elapsed)
+        self.assertEqual(events[2][1].method, 'POST')
+        self.fgt.remove_hook('before_request', failing)
+        self.assertRaises(ValueError, self.fgt.add_hook, 'after_request', failing)
+        self.fgt.delete('firewall', 'address', mkey='hooked-1', vdom="root")
+
+    def test_errors(self):
+        fgt = self.client()
+        metrics = RequestMetrics().attach(fgt)
+        fgt.get('firewall', 'address', mkey='missing', vdom="root")
+        fgt.url_prefix = 'http://127.0.0.1:1'
+        self.assertRaises(requests.exceptions.ConnectionError, fgt.get, 'firewall', 'address', vdom="root")
+        report = dict((e['endpoint'], e) for e in metrics.report())['cmdb/firewall/address']
+        self.assertEqual((report['count'], report['errors']), (2, 2))
+        self.assertEqual(report['status'], {404: 1, 'ConnectionError': 1})
+        self.assertEqual(sum(report['histogram'].values()), 2)
+        fgt.url_prefix = 'http://' + self.fake.address
+        metrics.detach(fgt)
+        fgt.get('firewall', 'address', vdom="root")
+        self.assertEqual(metrics.report()[0]['count'], 2)
+        metrics.reset()
+        self.assertEqual(metrics.report(), [])
+
+
+class TestOverlayDiff(FakeFortiOSTestCase):
+
+    def test_overlay_diff(self):
+        overlay = {'firewall': {'address': {'overlay-1': {'subnet': '10.30.0.0/24'},
+                                            'all': {'subnet': '0.0.0.0 0.0.0.0'}}}}
+        plan = self.fgt.setoverlayconfig(overlay, vdom="root", diff=True)
+        self.assertEqual(plan.summary(), {'created': 1, 'updated': 0, 'skipped': 1, 'failed': 0})
+        plan = self.fgt.setoverlayconfig(overlay, vdom="root", diff=True)
+        self.assertEqual(plan.skipped, 2)
+        self.fgt.delete('firewall', 'address', mkey='overlay-1', vdom="root")
+
+    def test_changed_fields(self):
+        from fortiosapi.overlay import changed_fields
+        current = {'name': 'a', 'subnet': '10.0.0.0 255.255.255.0', 'q_origin_key': 'a',
+                   'member': [{'name': 'y', 'q_origin_key': 'y'}, {'name': 'x', 'q_origin_key': 'x'}],
+                   'status': 'enable', 'comment': 'two  words'}
+        same = {'subnet': '10.0.0.0/24', 'member': [{'name': 'x'}, {'name': 'y'}], 'status': True,
+                'comment': 'two words'}
+        self.assertEqual(changed_fields(same, current), [])
+        self.assertEqual(sorted(changed_fields({'subnet': '10.0.1.0/24', 'member': [{'name': 'x'}],
+                                                'status': 'enable'}, current)), ['member', 'subnet'])
+        self.assertEqual(sorted(changed_fields(same, None)), sorted(same))
+
+    def test_plan_reads_once(self):
+        overlay = {'system': {'settings': {'opmode': 'transparent'}},
+                   'firewall': {'address': dict(('plan-%d' % i, {'subnet': '10.31.%d.0/24' % i})
+                                                for i in range(5))}}
+        self.fgt.set('firewall', 'address', {'name': 'plan-0', 'subnet': '10.31.0.0/24'}, vdom="root")
+        self.fgt.set('firewall', 'address', {'name': 'plan-1', 'subnet': '10.99.0.0/24'}, vdom="root")
+        methods = dict(self.fake.stats['methods'])
+        plan = self.fgt.planoverlayconfig(overlay, vdom="root")
+        self.assertEqual(plan.summary(), {'created': 3, 'updated': 2, 'skipped': 1, 'failed': 0})
+        self.assertEqual([(a['path'], a['mkey'], a['changes']) for a in plan.actions if a['action'] == 'update'],
+                         [('settings', None, ['opmode']), ('address', 'plan-1', ['subnet'])])
+        # one GET per settings object or table, nothing written
+        self.assertEqual(self.fake.stats['methods']['GET'] - methods['GET'], 2)
+        self.assertEqual(dict(self.fake.stats['methods'], GET=0), dict(methods, GET=0))
+        # the plan pushes only the changes: 3 POST and 2 PUT
+        plan = self.fgt.setoverlayconfig(overlay, vdom="root", diff=True)
+        self.assertEqual(self.fake.stats['methods']['POST'] - methods.get('POST', 0), 3)
+        self.assertEqual(self.fake.stats['methods']['PUT'] - methods.get('PUT', 0), 2)
+        self.assertEqual(self.fgt.planoverlayconfig(overlay, vdom="root").skipped, 6)
+        self.fgt.set('system', 'settings', {'opmode': 'nat'}, vdom="root")
+        self.fgt.delete_many('firewall', 'address', list(overlay['firewall']['address']), vdom="root")
+
+
+class TestOverlayConcurrency(FakeFortiOSTestCase):
+
+    def test_overlay_concurrency(self):
+        overlay = {'firewall': {'policy': {201: {'name': 'ov', 'srcaddr': [{'name': 'grp-ov'}]}},
+                                'addrgrp': {'grp-ov': {'member': [{'name': 'addr-ov-1'}]}},
+                                'address': {'addr-ov-%d' % i: {'subnet': '10.40.%d.0/24' % i}
+                                            for i in range(10)}},
+                   'system': {'settings': {'opmode': 'nat'}}}
+        self.assertTrue(self.fgt.setoverlayconfig(overlay, vdom="root", concurrency=4))
+        self.assertIn(201, self.fake.table('root', 'firewall', 'policy'))
+        self.assertIn('grp-ov', self.fake.table('root', 'firewall', 'addrgrp'))
+
+    def test_dependency_levels(self):
+        from fortiosapi.overlay import dependency_levels, table_dependencies
+        tables = [('firewall', 'policy'), ('firewall', 'addrgrp'), ('firewall', 'address')]
+        dependencies = table_dependencies(self.fgt, tables, vdom="root")
+        self.assertIn(('firewall', 'address'), dependencies[('firewall', 'addrgrp')])
+        self.assertEqual(dependency_levels(dependencies, tables),
+                         [[('firewall', 'address')], [('firewall', 'addrgrp')], [('firewall', 'policy')]])
+        # a cycle goes on a last level in the given order
+        self.assertEqual(dependency_levels({'a': set(['b']), 'b': set(['a']), 'c': set()}, ['a', 'b', 'c']),
+                         [['c'], ['a', 'b']])
+
+    def test_order_and_failure(self):
+        overlay = {'firewall': {'policy': dict((210 + i, {'name': 'ordered-%d' % i,
+                                                          'srcaddr': [{'name': 'grp-order'}]})
+                                               for i in range(4)),
+                                'addrgrp': {'grp-order': {'member': [{'name': 'addr-order-%d' % i}
+                                                                     for i in range(6)]}},
+                                'address': dict(('addr-order-%d' % i, {'subnet': '10.41.%d.0/24' % i})
+                                                for i in range(6))}}
+        pushed = []
+        lock = threading.Lock()
+
+        def record(context):
+            if context.method in ('PUT', 'POST'):
+                with lock:
+                    pushed.append((context.name, context.mkey))
+
+        self.fgt.add_hook('before_request', record)
+        self.assertTrue(self.fgt.setoverlayconfig(overlay, vdom="root", concurrency=4))
+        # a table is pushed once all the tables it references are
+        first = dict((name, i) for i, (name, _) in reversed(list(enumerate(pushed))))
+        last = dict((name, i) for i, (name, _) in enumerate(pushed))
+        self.assertLess(last['address'], first['addrgrp'])
+        self.assertLess(last['addrgrp'], first['policy'])
+        # policies keep the overlay order
+        policies = [mkey for name, mkey in pushed if name == 'policy']
+        self.assertEqual(sorted(set(policies), key=policies.index), [210, 211, 212, 213])
+        # a failing level stops the next ones
+        del pushed[:]
+        self.fake.inject_error(400, method='PUT', path='firewall', name='addrgrp/grp-order')
+        self.assertFalse(self.fgt.setoverlayconfig(overlay, vdom="root", concurrency=4))
+        self.assertNotIn('policy', [name for name, _ in pushed])
+
+
+class TestExistenceIndex(FakeFortiOSTestCase):
+
+    def test_existence_index(self):
+        self.fgt.existence_index('on')
+        before = dict(self.fake.stats['methods'])
+        self.fgt.set('firewall', 'address', data={'name': 'index-1'}, vdom="root")
+        self.fgt.set('firewall', 'address', data={'name': 'index-1', 'comment': 'x'}, vdom="root")
+        after = self.fake.stats['methods']
+        self.assertEqual(after.get('POST', 0) - before.get('POST', 0), 1)
+        self.assertEqual(after.get('PUT', 0) - before.get('PUT', 0), 1)
+        self.fgt.delete('firewall', 'address', mkey='index-1', vdom="root")
+
+    def test_read_once_and_updated(self):
+        self.fgt.get_mkeyname('firewall', 'address', vdom="root")
+        self.fgt.existence_index('on')
+        gets = self.fake.stats['endpoints'].get(('GET', 'cmdb', 'firewall', 'address'), 0)
+        puts = self.fake.stats['methods'].get('PUT', 0)
+        for i in range(5):
+            self.fgt.set('firewall', 'address', data={'name': 'index-%d' % i}, vdom="root")
+        self.fgt.set('firewall', 'address', data={'name': 'all', 'comment': 'x'}, vdom="root")
+        self.assertEqual(self.fake.stats['endpoints'][('GET', 'cmdb', 'firewall', 'address')] - gets, 1)
+        self.assertEqual(self.fake.stats['methods']['PUT'] - puts, 1)
+        # the deletes done with this client are known
+        self.fgt.delete('firewall', 'address', mkey='index-0', vdom="root")
+        posts = self.fake.stats['methods']['POST']
+        self.assertEqual(self.fgt.set('firewall', 'address', data={'name': 'index-0'}, vdom="root")['status'],
+                         'success')
+        self.assertEqual(self.fake.stats['methods']['POST'] - posts, 1)
+        self.assertEqual(self.fake.stats['methods']['PUT'] - puts, 1)
+        self.fgt.delete_many('firewall', 'address', ['index-%d' % i for i in range(5)], vdom="root")
+
+    def test_read_outside_lock(self):
+        reading = threading.Event()
+        release = threading.Event()
+
+        def block(context):
+            if context.method == 'GET' and context.kind == 'cmdb' and context.name == 'address':
+                reading.set()
+                release.wait(5)
+
+        self.fgt.add_hook('before_request', block)
+        thread = threading.Thread(target=self.fgt._table_mkeys, args=('firewall', 'address', "root"))
+        thread.start()
+        try:
+            self.assertTrue(reading.wait(5))
+            # the other threads use the index while a table is read
+            self.assertTrue(self.fgt._index_lock.acquire(timeout=1))
+            self.fgt._index_lock.release()
+        finally:
+            release.set()
+            thread.join()
+        self.assertIn('all', self.fgt._mkey_index[('firewall', 'address', "root")])
+
+    def test_invalidate(self):
+        self.fgt.existence_index('on')
+        self.fgt.set('firewall', 'address', data={'name': 'all', 'comment': 'x'}, vdom="root")
+        # created by another client, this one still thinks it is missing
+        self.client().post('firewall', 'address', {'name': 'index-other'}, vdom="root")
+        data = {'name': 'index-other', 'comment': 'x'}
+        puts = self.fake.stats['methods']['PUT']
+        # the POST fails with -5, the object is indexed and set does the PUT
+        self.assertEqual(self.fgt.set('firewall', 'address', data=data, vdom="root")['status'], 'success')
+        self.assertEqual(self.fake.stats['methods']['PUT'] - puts, 1)
+        self.assertEqual(self.fake.table('root', 'firewall', 'address')['index-other']['comment'], 'x')
+        self.assertIn('index-other', self.fgt._mkey_index[('firewall', 'address', "root")])
+        self.fgt.invalidate_existence('firewall', 'address', vdom="root")
+        self.assertNotIn(('firewall', 'address', "root"), self.fgt._mkey_index)
+        self.fgt.existence_index('off')
+        self.assertEqual(self.fgt._mkey_index, {})
+        self.fgt.delete('firewall', 'address', mkey='index-other', vdom="root")
+
+
+class TestFakeFortiOS(FakeFortiOSTestCase):
+
+    def test_error_injection(self):
+        # no retry without a policy asking for it
+        self.fake.inject_error(503, method='GET', path='firewall')
+        self.assertEqual(self.fgt.get('firewall', 'address', vdom="root")['http_status'], 503)
+        self.assertEqual(self.fgt.get('firewall', 'address', vdom="root")['http_status'], 200)
+
+
+class TestConnectionPool(FakeFortiOSTestCase):
+
+    def test_threads_share_client(self):
+        logins = self.fake.stats['logins']
+        results = []
+
+        def worker():
+            for _ in range(10):
+                results.append(self.fgt.get('firewall', 'address', mkey='all', vdom="root")['status'])
+                self.fgt.update_cookie()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['success'] * 80)
+        self.assertEqual(self.fake.stats['logins'], logins)
+        stats = self.fgt.connection_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertLessEqual(stats[0]['connections'], 10)
+        self.assertGreater(stats[0]['reuse'], 0.5)
+
+    def test_shared_pool(self):
+        pool = FortiOSAPI.connection_pool(pool_maxsize=4)
+        clients = [FortiOSAPI(pool=pool) for _ in range(2)]
+        for fgt in clients:
+            fgt.https('off')
+            fgt.login(self.fake.address, 'admin', '')
+            fgt.get('firewall', 'address', mkey='all', vdom="root")
+        clients[0].logout()
+        self.assertEqual(clients[1].get('firewall', 'address', mkey='all', vdom="root")['status'], 'success')
+        self.assertEqual(clients[1].connection_stats(all_hosts=True)[0]['connections'], 1)
+        clients[1].logout()
+
+    def test_pool_grows(self):
+        fgt = self.client(pool_maxsize=2)
+        pool = fgt._pool
+        objects = [{'name': 'pool-%d' % i} for i in range(12)]
+        self.assertEqual(fgt.set_many('firewall', 'address', objects, vdom="root", concurrency=6)['success'], 12)
+        # a new adapter with room for the threads, the sizes asked are kept
+        self.assertIsNot(fgt._pool, pool)
+        self.assertEqual(fgt._pool_sizes, (10, 6, False))
+        self.assertLessEqual(fgt.connection_stats()[0]['connections'], 6)
+        grown = fgt._pool
+        fgt.delete_many('firewall', 'address', objects, vdom="root", concurrency=4)
+        self.assertIs(fgt._pool, grown)
+
+
+class TestRequestPolicy(FakeFortiOSTestCase):
+
+    def test_retry(self):
+        self.fgt.policy = RequestPolicy(backoff=0.01)
+        metrics = RequestMetrics().attach(self.fgt)
+        self.fake.inject_error(503, method='GET', path='firewall', count=2)
+        self.assertEqual(self.fgt.get('firewall', 'address', vdom="root")['http_status'], 200)
+        self.assertEqual(metrics.report()[0]['retries'], 2)
+        # a POST may have been processed on a 502, it is not sent again
+        self.fake.inject_error(502, method='POST', path='firewall')
+        resp = self.fgt.post('firewall', 'address', {'name': 'retry-1'}, vdom="root")
+        self.assertEqual(resp['http_status'], 502)
+        self.fake.inject_error(429, method='POST', path='firewall')
+        resp = self.fgt.post('firewall', 'address', {'name': 'retry-1'}, vdom="root")
+        self.assertEqual(resp['status'], 'success')
+        # a transient 500 on the PUT of set is not taken as a missing object
+        self.fake.inject_error(500, method='PUT', path='firewall')
+        posts = self.fake.stats['methods'].get('POST', 0)
+        resp = self.fgt.set('firewall', 'address', data={'name': 'retry-1', 'comment': 'x'}, vdom="root")
+        self.assertEqual(resp['http_status'], 500)
+        self.assertEqual(self.fake.stats['methods'].get('POST', 0), posts)
+        self.fgt.delete('firewall', 'address', mkey='retry-1', vdom="root")
+
+    def test_retry_upload(self):
+        self.fgt.policy = RequestPolicy(backoff=0.01)
+        # upload passes files=None with an in memory body, it can be sent again
+        self.fake.inject_error(503, method='POST', path='system')
+        res = self.fgt.upload('system', 'config/restore', data=b'config system global\nend\n')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.fake.last_upload, b'config system global\nend\n')
+        # a file is read while sending, it is not
+        self.fake.inject_error(503, method='POST', path='system')
+        res = self.fgt.upload('system', 'config/restore', files={'file': ('fgt.conf', io.BytesIO(b'x'))})
+        self.assertEqual(res.status_code, 503)
+
+    def test_rate_limit(self):
+        policy = RequestPolicy(rate=50, burst=1)
+        self.fgt.policy = policy
+        start = time.time()
+        for _ in range(11):
+            self.fgt.get('firewall', 'address', mkey='all', vdom="root")
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        self.assertGreater(policy.stats()['throttled'], 0)
+
+
+class TestSessions(FakeFortiOSTestCase):
+
+    def test_session_cache(self):
+        cachedir = tempfile.mkdtemp()
+        try:
+            cache = SessionCache(directory=cachedir)
+            first = FortiOSAPI(session_cache=cache)
+            first.https('off')
+            first.login(self.fake.address, 'admin', '')
+            files = os.listdir(cachedir)
+            self.assertEqual(len(files), 1)
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(cachedir, files[0])).st_mode), 0o600)
+            logins = self.fake.stats['logins']
+            second = FortiOSAPI(session_cache=cache)
+            second.https('off')
+            second.login(self.fake.address, 'admin', '')
+            self.assertEqual(self.fake.stats['logins'], logins)
+            self.assertEqual(second.get_version(), 'v6.2.3')
+            self.assertEqual(second.set('firewall', 'address', data={'name': 'session-1'},
+                                        vdom="root")['status'], 'success')
+            second.delete('firewall', 'address', mkey='session-1', vdom="root")
+            second.logout()
+            self.assertEqual(os.listdir(cachedir), [])
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_relogin(self):
+        logins = self.fake.stats['logins']
+        # the Fortigate forgets the session (timeout, reboot)
+        self.fake.sessions.clear()
+        self.assertEqual(self.fgt.get('firewall', 'address', mkey='all', vdom="root")['status'], 'success')
+        self.assertEqual(self.fake.stats['logins'], logins + 1)
+        # uploads with an in memory body are sent again after the login
+        self.fake.sessions.clear()
+        res = self.fgt.upload('system', 'config/restore', data=b'config system global\nend\n')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.fake.stats['logins'], logins + 2)
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        # no password to login again with a token
+        self.assertRaises(Exception, fgt.tokenlogin, self.fake.address, "badtoken")
+
+
+class TestResponseCache(FakeFortiOSTestCase):
+
+    def test_response_cache(self):
+        cache = ResponseCache(ttl=60, ttls={'monitor': 0})
+        self.fgt.response_cache = cache
+        key = ('GET', 'cmdb', 'firewall', 'address')
+        before = self.fake.stats['endpoints'].get(key, 0)
+        for _ in range(3):
+            self.assertEqual(self.fgt.get('firewall', 'address', mkey='all', vdom="root")['status'], 'success')
+        self.assertEqual(self.fake.stats['endpoints'][key] - before, 1)
+        # a write through the client drops the table responses
+        self.fgt.set('firewall', 'address', data={'name': 'all', 'comment': 'cached'}, vdom="root")
+        resp = self.fgt.get('firewall', 'address', mkey='all', vdom="root")
+        self.assertEqual(resp['results'][0]['comment'], 'cached')
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_response_coalescing(self):
+        self.fgt.response_cache = ResponseCache(ttl=0)
+        key = ('GET', 'monitor', 'system', 'resource')
+        before = self.fake.stats['endpoints'].get(key, 0)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.fgt.monitor('system', 'resource/usage', vdom="root")['status'])) for _ in range(8)]
+        self.fake.latency = 0.3
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.fake.latency = 0.0
+        self.assertEqual(results, ['success'] * 8)
+        self.assertEqual(self.fake.stats['endpoints'][key] - before, 1)
+        self.assertEqual(self.fgt.response_cache.stats()['coalesced'], 7)
+
+    def test_identities_and_probe(self):
+        cache = ResponseCache(ttl=60)
+        key = ('GET', 'cmdb', 'firewall', 'address')
+        before = self.fake.stats['endpoints'].get(key, 0)
+        user = self.client(response_cache=cache)
+        token = FortiOSAPI(response_cache=cache)
+        token.https('off')
+        token.tokenlogin(self.fake.address, 'testtoken')
+        for fgt in (user, token, user, token):
+            self.assertEqual(fgt.get('firewall', 'address', mkey='all', vdom="root")['status'], 'success')
+        # each identity reads once, the token is not in the keys
+        self.assertEqual(self.fake.stats['endpoints'][key] - before, 2)
+        self.assertNotIn('testtoken', repr(list(cache._memory.keys())))
+        # the session probe of a login is never answered from the cache
+        key = ('GET', 'monitor', 'license', 'status')
+        before = self.fake.stats['endpoints'].get(key, 0)
+        for _ in range(2):
+            user.login(self.fake.address, 'admin', '')
+        self.assertEqual(self.fake.stats['endpoints'][key] - before, 2)
+
+
+class TestMonitorPoller(FakeFortiOSTestCase):
+
+    def test_monitor_poller(self):
+        poller = MonitorPoller(self.fgt)
+        first, second = [], []
+        subscriptions = [poller.subscribe('system', 'interface', first.append, interval=60),
+                         poller.subscribe('system', 'interface', second.append, interval=60)]
+        key = ('GET', 'monitor', 'system', 'interface')
+        before = self.fake.stats['endpoints'].get(key, 0)
+        self.assertEqual(poller.poll_once(), 1)
+        self.assertEqual(self.fake.stats['endpoints'][key] - before, 1)
+        self.assertTrue(first[0].initial)
+        self.assertEqual(set(first[0].added), set(self.fake.table('global', 'system', 'interface')))
+        # not due yet
+        self.assertEqual(poller.poll_once(), 0)
+        time.sleep(0.01)
+        for subscription in subscriptions:
+            subscription.next = 0
+        poller.poll_once()
+        delta = second[1]
+        self.assertIs(first[1], delta)
+        self.assertFalse(delta.added or delta.removed)
+        rates = delta.changed['port1']['rates']
+        self.assertGreater(rates['tx_bytes'], 0)
+        self.assertNotIn('speed', delta.changed['port1']['fields'])
+        poller.unsubscribe(subscriptions[0])
+        poller.unsubscribe(subscriptions[1])
+        self.assertEqual(poller.stats(), [])
+
+    def test_monitor_poller_error(self):
+        poller = MonitorPoller(self.fgt)
+        errors, deltas = [], []
+
+        def failing(error):
+            errors.append(error)
+            raise RuntimeError("handler bug")
+
+        poller.subscribe('system', 'interface', deltas.append, interval=60, on_error=failing)
+        poller.subscribe('system', 'interface', deltas.append, interval=60, on_error=errors.append)
+        self.fake.inject_error(500, method='GET', path='system', name='interface')
+        # a failing error handler neither escapes poll_once nor skips the others
+        self.assertEqual(poller.poll_once(), 1)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(poller.stats()[0]['errors'], 1)
+
+    def test_monitor_poller_thread(self):
+        deltas = []
+        with MonitorPoller(self.fgt) as poller:
+            poller.subscribe('system', 'interface', deltas.append, interval=0.05)
+            deadline = time.time() + 5
+            while len(deltas) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertGreaterEqual(len(deltas), 3)
+        self.assertFalse(deltas[-1].initial)
+
+
+class TestDownloadStream(FakeFortiOSTestCase):
+
+    def test_download_stream(self):
+        backup = self.fake.config_backup()
+        if not isinstance(backup, bytes):
+            backup = backup.encode('utf-8')
+        sink = io.BytesIO()
+        progress = []
+        result = self.fgt.download_stream('system', 'config/backup', sink, parameters={'scope': 'global'},
+                                          chunk_size=1024, compression='gzip',
+                                          progress=lambda done, total: progress.append((done, total)))
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['bytes'], len(backup))
+        self.assertEqual(result['checksum'], hashlib.sha256(backup).hexdigest())
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(sink.getvalue())).read(), backup)
+        self.assertEqual(progress[-1], (len(backup), len(backup)))
+        self.assertGreater(len(progress), 1)
+
+    def test_download_resume(self):
+        backup = self.fake.config_backup()
+        if not isinstance(backup, bytes):
+            backup = backup.encode('utf-8')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'backup.conf')
+            cancel = threading.Event()
+
+            def stop(done, total):
+                cancel.set()
+
+            result = self.fgt.download_stream('system', 'config/backup', filename, chunk_size=1024,
+                                              progress=stop, cancel=cancel)
+            self.assertFalse(result['complete'])
+            self.assertEqual(os.path.getsize(filename), 1024)
+            result = self.fgt.download_stream('system', 'config/backup', filename, chunk_size=1024,
+                                              resume=True)
+            self.assertEqual(result['http_status'], 206)
+            self.assertTrue(result['complete'])
+            self.assertEqual(result['checksum'], hashlib.sha256(backup).hexdigest())
+            with open(filename, 'rb') as fh:
+                self.assertEqual(fh.read(), backup)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestUploadStream(FakeFortiOSTestCase):
+
+    def test_upload_stream(self):
+        content = os.urandom(300000)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'fgt.conf')
+            with open(filename, 'wb') as fh:
+                fh.write(content)
+            progress = []
+            stream = MultipartStream(files={'file': filename}, fields={'scope': 'global'}, chunk_size=4096,
+                                     progress=lambda sent, total: progress.append((sent, total)))
+            res = self.fgt.upload('system', 'config/restore', data=stream)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json()['results']['bytes'], len(stream))
+            self.assertEqual(progress[-1], (len(stream), len(stream)))
+            self.assertEqual(stream.checksums['file'], hashlib.sha256(content).hexdigest())
+            body = self.fake.last_upload
+            self.assertIn(b'name="scope"\r\n\r\nglobal\r\n', body)
+            start = body.index(b'filename="fgt.conf"')
+            start = body.index(b'\r\n\r\n', start) + 4
+            self.assertEqual(body[start:start + len(content)], content)
+            self.assertTrue(body.endswith(('\r\n--%s--\r\n' % stream.boundary).encode('ascii')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(aiohttp is None, "AsyncFortiOSAPI needs aiohttp")
+    def test_async_upload_stream(self):
+        from fortiosapi import AsyncFortiOSAPI
+
+        content = os.urandom(100000)
+        stream = MultipartStream(files={'file': ('fgt.conf', io.BytesIO(content))}, chunk_size=4096)
+
+        async def run():
+            fgt = AsyncFortiOSAPI()
+            fgt.https('off')
+            await fgt.login(self.fake.address, 'admin', '')
+            res = await fgt.upload('system', 'config/restore', data=stream)
+            await fgt.logout()
+            return res
+
+        res = TestAsyncFortiOSAPI.run_async(run())
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['results']['bytes'], len(stream))
+        self.assertEqual(stream.checksums['file'], hashlib.sha256(content).hexdigest())
+        self.assertIn(content, self.fake.last_upload)
+        self.assertRaises(TypeError, TestAsyncFortiOSAPI.run_async,
+                          AsyncFortiOSAPI().upload('system', 'config/restore', data='scope=global'))
+
+
+class TestCLIConfig(FakeFortiOSTestCase):
+
+    def test_cliconfig(self):
+        config = CLIConfig(b'''#config-version=FGVM64-6.04-FW-build1575-190418:opmode=0:vdom=1:user=admin
+config vdom
+edit root
+next
+end
+config global
+config system global
+    set hostname "FGT 1"
+end
+config system admin
+    edit "admin"
+        set comments "first line
+end of the comment"
+        config gui-dashboard
+            edit 1
+                set name "Main"
+            next
+        end
+    next
+end
+end
+config vdom
+edit root
+config firewall address
+    edit "h \\"1\\""
+        set subnet 10.0.0.1 255.255.255.255
+    next
+end
+next
+end
+''')
+        self.assertEqual(config.header['build'], '1575')
+        self.assertEqual(config.vdoms, ['global', 'root'])
+        self.assertEqual(config.get('system', 'global', vdom='global'), {'hostname': 'FGT 1'})
+        admin = config['global', 'system', 'admin']['admin']
+        self.assertEqual(admin['comments'], 'first line\nend of the comment')
+        self.assertEqual(admin['gui-dashboard']['1']['name'], 'Main')
+        self.assertEqual(config.get('firewall', 'address', 'h "1"', vdom='root')['subnet'],
+                         ['10.0.0.1', '255.255.255.255'])
+
+    def test_cliconfig_diff(self):
+        before = CLIConfig(self.fgt.download('system', 'config/backup', parameters={'scope': 'global'}).content)
+        addresses = before[None, 'firewall', 'address']
+        subnet = addresses['address-1']['subnet']
+        self.fgt.set('firewall', 'address', vdom='root',
+                     data={'name': 'address-1', 'subnet': '10.9.9.9 255.255.255.255'})
+        self.fgt.set('firewall', 'address', vdom='root',
+                     data={'name': 'cliconfig', 'subnet': '10.8.8.8 255.255.255.255'})
+        try:
+            after = CLIConfig(self.fgt.download('system', 'config/backup', parameters={'scope': 'global'}).content)
+            diff = before.diff(after)
+            self.assertIn((None, 'firewall', 'address', 'cliconfig'), diff.added)
+            self.assertEqual(diff.changed[(None, 'firewall', 'address', 'address-1')],
+                             {'subnet': (subnet, '10.9.9.9 255.255.255.255')})
+            self.assertFalse(before.diff(before))
+        finally:
+            self.fgt.delete('firewall', 'address', vdom='root', mkey='cliconfig')
+            self.fgt.set('firewall', 'address', vdom='root', data={'name': 'address-1', 'subnet': subnet})
+
+
+class TestCMDBMirror(FakeFortiOSTestCase):
+
+    def test_mirror(self):
+        self.fgt.set('firewall', 'policy', vdom='root',
+                     data={'policyid': 900, 'name': 'mirror', 'srcaddr': [{'name': 'address-7'}],
+                           'dstaddr': [{'name': 'all'}], 'service': [{'name': 'HTTPS'}]})
+        try:
+            with CMDBMirror(workers=4, page_size=100) as mirror:
+                stats = mirror.snapshot(self.fgt, device='fgt1')
+                self.assertEqual(stats['errors'], 0)
+                addresses = self.fgt.get('firewall', 'address', vdom='root')['results']
+                self.assertEqual(len(mirror.objects('firewall', 'address', device='fgt1')), len(addresses))
+                self.assertEqual(mirror.objects('firewall', 'address', 'address-7')[0]['data']['subnet'],
+                                 '10.0.7.0 255.255.255.0')
+                found = mirror.find('address-7', 'firewall', 'policy')
+                self.assertEqual([(f['mkey'], f['field']) for f in found], [('900', 'srcaddr')])
+                self.assertEqual(mirror.find('HTTPS', field='service')[0]['data']['name'], 'mirror')
+                self.assertEqual(mirror.get('fgt1', 'system', 'global', vdom='global')['hostname'], 'FGT-FAKE')
+                self.fgt.delete('firewall', 'policy', vdom='root', mkey=900)
+                mirror.snapshot(self.fgt, device='fgt1')
+                self.assertEqual(mirror.find('address-7'), [])
+                self.assertEqual([d['device'] for d in mirror.devices()], ['fgt1'])
+        finally:
+            self.fgt.delete('firewall', 'policy', vdom='root', mkey=900)
+
+    def test_mirror_refresh(self):
+        with CMDBMirror(workers=4) as mirror:
+            first = mirror.snapshot(self.fgt, device='fgt1')
+            self.assertEqual(first['changed'], first['tables'])
+            unchanged = mirror.refresh(self.fgt, device='fgt1')
+            self.assertEqual(unchanged['tables'], 0)
+            self.assertEqual(unchanged['skipped'], first['tables'])
+            self.fgt.set('firewall', 'address', vdom='root',
+                         data={'name': 'refresh', 'subnet': '10.7.7.7 255.255.255.255'})
+            try:
+                changed = mirror.refresh(self.fgt, device='fgt1')
+                # only the root vdom tables are read, only the address table written
+                self.assertGreater(changed['skipped'], 0)
+                self.assertEqual(changed['changed'], 1)
+                self.assertEqual(len(mirror.objects('firewall', 'address', 'refresh')), 1)
+            finally:
+                self.fgt.delete('firewall', 'address', vdom='root', mkey='refresh')
+            mirror.refresh(self.fgt, device='fgt1')
+            self.assertEqual(mirror.objects('firewall', 'address', 'refresh'), [])
+
+    def test_queries_during_snapshot(self):
+        reading = threading.Event()
+        release = threading.Event()
+
+        def block(context):
+            if context.kind == 'cmdb' and context.name == 'address':
+                reading.set()
+                release.wait(5)
+
+        with CMDBMirror(workers=2) as mirror:
+            mirror.snapshot(self.fgt, device='fgt1', vdoms=['root'], tables=[('firewall', 'address')])
+            self.fgt.add_hook('before_request', block)
+            thread = threading.Thread(target=mirror.snapshot, args=(self.fgt,),
+                                      kwargs={'device': 'fgt1', 'vdoms': ['root']})
+            thread.start()
+            try:
+                self.assertTrue(reading.wait(5))
+                # the copy is readable while the tables are fetched
+                found = []
+                query = threading.Thread(target=lambda: found.extend(mirror.objects('firewall', 'address',
+                                                                                    'address-7')))
+                query.start()
+                query.join(2)
+                self.assertEqual(len(found), 1)
+            finally:
+                release.set()
+                thread.join()
+                self.fgt.remove_hook('before_request', block)
+
+
+class TestReferenceIndex(FakeFortiOSTestCase):
+
+    def test_reference_index(self):
+        index = ReferenceIndex().build(self.fgt, vdom='root').attach(self.fgt)
+        try:
+            self.fgt.set('firewall', 'addrgrp', vdom='root',
+                         data={'name': 'refgrp', 'member': [{'name': 'address-11'}, {'name': 'address-12'}]})
+            referrers = index.referrers('firewall', 'address', 'address-11')
+            self.assertEqual([(r['name'], r['mkey'], r['fields']) for r in referrers],
+                             [('addrgrp', 'refgrp', ['member'])])
+            summary = self.fgt.delete_many('firewall', 'address', ['address-11', 'refgrp-missing'], vdom='root',
+                                           reference_index=index)
+            self.assertEqual(summary['results'][0]['error'], 'referenced')
+            self.assertEqual(summary['results'][0]['response']['referrers'][0]['mkey'], 'refgrp')
+            self.assertIsNotNone(self.fgt.get('firewall', 'address', vdom='root', mkey='address-11')['results'])
+            self.fgt.put('firewall', 'addrgrp', vdom='root', mkey='refgrp',
+                         data={'member': [{'name': 'address-12'}]})
+            self.assertFalse(index.is_referenced('firewall', 'address', 'address-11'))
+            self.assertTrue(index.is_referenced('firewall', 'address', 'address-12'))
+            # the group and its member deleted together
+            summary = self.fgt.delete_many('firewall', 'addrgrp', ['refgrp'], vdom='root', reference_index=index)
+            self.assertEqual(summary['success'], 1)
+            self.assertFalse(index.is_referenced('firewall', 'address', 'address-12'))
+        finally:
+            index.detach(self.fgt)
+            self.fgt.delete('firewall', 'addrgrp', vdom='root', mkey='refgrp')
+
+    def test_delete_many_nested_groups(self):
+        groups = [('nested-1', 'address-14'), ('nested-2', 'nested-1'), ('nested-3', 'nested-2')]
+        for group, member in groups:
+            self.fgt.set('firewall', 'addrgrp', vdom='root', data={'name': group, 'member': [{'name': member}]})
+        index = ReferenceIndex().build(self.fgt, vdom='root', tables=[('firewall', 'addrgrp')])
+        try:
+            # the Fortigate refuses to delete a group still used by another one
+            self.assertEqual(self.fgt.delete('firewall', 'addrgrp', vdom='root', mkey='nested-1')['error'], -23)
+            summary = self.fgt.delete_many('firewall', 'addrgrp', ['nested-1', 'nested-2', 'nested-3'],
+                                           vdom='root', concurrency=1, reference_index=index)
+            self.assertEqual(summary['success'], 3)
+            self.assertEqual([r['mkey'] for r in summary['results']], ['nested-1', 'nested-2', 'nested-3'])
+        finally:
+            for group, member in reversed(groups):
+                self.fgt.delete('firewall', 'addrgrp', vdom='root', mkey=group)
+
+    def test_reference_index_allocated_mkey(self):
+        index = ReferenceIndex().build(self.fgt, vdom='root', tables=[('firewall', 'policy')]).attach(self.fgt)
+        policyid = None
+        try:
+            resp = self.fgt.post('firewall', 'policy', vdom='root',
+                                 data={'policyid': 0, 'name': 'allocated', 'srcaddr': [{'name': 'address-13'}]})
+            policyid = resp['mkey']
+            self.assertNotEqual(policyid, 0)
+            self.assertEqual([r['mkey'] for r in index.referrers('firewall', 'address', 'address-13')],
+                             [str(policyid)])
+            # no mkey answered: nothing is guessed
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'{"status": "success", "http_status": 200}'
+            index.after_response(RequestContext('POST', '', kind='cmdb', path='firewall', name='policy',
+                                                vdom='root', data={'policyid': 0, 'srcaddr': [{'name': 'all'}]}),
+                                 response)
+            self.assertFalse(index.is_referenced('firewall', 'address', 'all'))
+        finally:
+            index.detach(self.fgt)
+            if policyid is not None:
+                self.fgt.delete('firewall', 'policy', vdom='root', mkey=policyid)
+
+
+class TestPolicyLookup(FakeFortiOSTestCase):
+
+    def test_policy_lookup(self):
+        def policy(policyid, srcaddr, service, **fields):
+            entry = {'policyid': policyid, 'srcintf': [{'name': 'lan'}], 'dstintf': [{'name': 'port2'}],
+                     'srcaddr': [{'name': srcaddr}], 'dstaddr': [{'name': 'all'}],
+                     'service': [{'name': service}], 'schedule': 'always', 'status': 'enable'}
+            entry.update(fields)
+            return entry
+
+        engine = PolicyLookup(
+            [policy(1, 'servers', 'web', status='disable'),
+             policy(2, 'servers', 'web', schedule='office'),
+             policy(3, 'servers', 'web', dstaddr=[{'name': 'dns'}], **{'dstaddr-negate': 'enable'}),
+             policy(4, 'range', 'PING'),
+             policy(5, 'all', 'ALL', srcintf=[{'name': 'any'}], action='deny')],
+            addresses=[{'name': 'srv', 'type': 'ipmask', 'subnet': '10.0.1.0 255.255.255.0'},
+                       {'name': 'range', 'type': 'iprange', 'start-ip': '10.0.2.10', 'end-ip': '10.0.2.20'},
+                       {'name': 'dns', 'type': 'ipmask', 'subnet': '8.8.8.8 255.255.255.255'},
+                       {'name': 'cdn', 'type': 'fqdn', 'fqdn': 'cdn.example.com'}],
+            addrgrps=[{'name': 'servers', 'member': [{'name': 'srv'}, {'name': 'more'}]},
+                      {'name': 'more', 'member': [{'name': 'range'}, {'name': 'cdn'}]}],
+            services=[{'name': 'HTTPS', 'protocol': 'TCP/UDP/SCTP', 'tcp-portrange': '443'},
+                      {'name': 'ALT', 'protocol': 'TCP/UDP/SCTP', 'tcp-portrange': '8000-8080:1-65535'},
+                      {'name': 'PING', 'protocol': 'ICMP'},
+                      {'name': 'ALL', 'protocol': 'IP', 'protocol-number': 0}],
+            service_groups=[{'name': 'web', 'member': [{'name': 'HTTPS'}, {'name': 'ALT'}]}],
+            schedules=[{'name': 'office', 'day': 'monday tuesday wednesday thursday friday',
+                        'start': '08:00', 'end': '18:00'}],
+            zones=[{'name': 'lan', 'interface': [{'name': 'port1'}, {'name': 'port3'}]}])
+        self.assertEqual(engine.unsupported, set(['cdn']))
+        monday = datetime.datetime(2024, 1, 1, 10, 0)
+        sunday = datetime.datetime(2024, 1, 7, 10, 0)
+        flows = [('port1', 'port2', '10.0.1.5', '1.1.1.1', 6, 443),
+                 ('port3', 'port2', '10.0.2.15', '1.1.1.1', 6, 8080),
+                 ('port1', 'port2', '10.0.1.5', '8.8.8.8', 6, 443),
+                 ('port1', 'port2', '10.0.2.15', '8.8.8.8', 1, 0),
+                 ('port1', 'port2', '10.0.1.5', '1.1.1.1', 17, 443),
+                 ('port4', 'port2', '10.0.1.5', '1.1.1.1', 6, 443),
+                 ('port4', 'port1', '10.0.1.5', '1.1.1.1', 6, 443)]
+        self.assertEqual(engine.lookup_many(flows, when=monday), [2, 2, 2, 4, 5, 5, None])
+        self.assertEqual(engine.lookup_many(flows, when=sunday), [3, 3, 5, 4, 5, 5, None])
+        self.assertEqual(engine.lookup('port1', 'port2', '10.0.1.5', '1.1.1.1', 6, 443, when=sunday,
+                                       details=True)['policyid'], 3)
+
+
+class TestRoutingTable(FakeFortiOSTestCase):
+
+    def test_routing_table(self):
+        table = RoutingTable.from_client(self.fgt, vdom='root')
+        routes = table.lookup_many(['172.16.3.9', '8.8.8.8', '2001:db8::1', '172.16.200.1'])
+        self.assertEqual([r['interface'] for r in routes], ['port2', 'port1', 'port1', 'port1'])
+        self.assertEqual(routes[0]['ip_mask'], '172.16.3.0/24')
+        # equal cost paths and a more specific route
+        table.add({'type': 'static', 'ip_mask': '0.0.0.0/0', 'distance': 10, 'priority': 0,
+                   'gateway': '10.0.3.254', 'interface': 'port3'})
+        table.add({'type': 'bgp', 'ip_mask': '172.16.3.128 255.255.255.128', 'distance': 20,
+                   'gateway': '10.0.4.254', 'interface': 'port4'})
+        self.assertEqual(sorted(r['interface'] for r in table.lookup('8.8.8.8', all_paths=True)),
+                         ['port1', 'port3'])
+        self.assertEqual(table.lookup('172.16.3.200')['interface'], 'port4')
+        self.assertIsNone(RoutingTable().lookup('10.0.0.1'))
+        # refresh only applies the routes which changed
+        route_count = self.fake.route_count
+        self.fake.route_count = route_count + 2
+        try:
+            self.assertEqual(table.refresh(self.fgt, vdom='root'), {'added': 2, 'removed': 2, 'changed': 0})
+        finally:
+            self.fake.route_count = route_count
+        self.assertEqual(table.lookup('172.16.3.200')['interface'], 'port2')
+        self.assertEqual(table.lookup('172.16.%d.1' % route_count)['gateway'], '10.0.2.254')
+
+
+class TestPostBatch(FakeFortiOSTestCase):
+
+    def test_post_batch(self):
+        # 6.2 has no json array POST: one post per object
+        objects = [{'name': 'batch-%d' % i, 'subnet': '10.30.%d.0 255.255.255.0' % i} for i in range(5)]
+        posts = self.fake.stats['methods'].get('POST', 0)
+        summary = self.fgt.post_batch('firewall', 'address', objects, vdom="root")
+        self.assertEqual(summary['success'], 5)
+        self.assertEqual(self.fake.stats['methods']['POST'] - posts, 5)
+        self.fgt.delete_many('firewall', 'address', objects, vdom="root")
+
+        fake = FakeFortiOS(version='v7.0.12')
+        fake.start()
+        fgt = FortiOSAPI()
+        fgt.https('off')
+        try:
+            fgt.login(fake.address, 'admin', '')
+            index = ReferenceIndex().build(fgt, vdom='root', tables=[('firewall', 'addrgrp')]).attach(fgt)
+            objects = [{'name': 'batch-%d' % i, 'subnet': '10.30.%d.%d 255.255.255.255' % (i >> 8, i & 255)}
+                       for i in range(250)]
+            # an existing object and one without its mkey
+            objects[42]['name'] = 'all'
+            del objects[180]['name']
+            posts = fake.stats['methods'].get('POST', 0)
+            summary = fgt.post_batch('firewall', 'address', objects, vdom="root", chunk_size=100)
+            self.assertEqual((summary['success'], summary['error']), (248, 2))
+            self.assertEqual([r['mkey'] for r in summary['results']][:3], ['batch-0', 'batch-1', 'batch-2'])
+            errors = [(i, r['response']['error']) for i, r in enumerate(summary['results'])
+                      if r['status'] != 'success']
+            self.assertEqual(errors, [(42, -5), (180, -651)])
+            # 3 chunks and the halves isolating the 2 bad objects (about 14 each)
+            self.assertLess(fake.stats['methods']['POST'] - posts, 40)
+            self.assertEqual(len(fake.table('root', 'firewall', 'address')), 249)
+            # a failure of the request is not split
+            posts = fake.stats['methods']['POST']
+            objects = [{'name': 'failed-%d' % i} for i in range(10)]
+            fake.inject_error(503, method='POST', path='firewall')
+            summary = fgt.post_batch('firewall', 'address', objects, vdom="root", chunk_size=100)
+            self.assertEqual(fake.stats['methods']['POST'] - posts, 1)
+            self.assertEqual(summary['error'], 10)
+            self.assertEqual(set(r['http_status'] for r in summary['results']), set([503]))
+            # the results of each object are used when the answer gives them
+            fake.atomic_batch = False
+            objects = [{'name': 'partial-%d' % i} for i in range(10)] + [{'name': 'all'}]
+            posts = fake.stats['methods']['POST']
+            summary = fgt.post_batch('firewall', 'address', objects, vdom="root", chunk_size=100)
+            self.assertEqual(fake.stats['methods']['POST'] - posts, 1)
+            self.assertEqual((summary['success'], summary['error']), (10, 1))
+            self.assertEqual(summary['results'][10]['response']['error'], -5)
+            self.assertEqual(summary['results'][3]['mkey'], 'partial-3')
+            fake.atomic_batch = True
+            groups = [{'name': 'batchgrp-%d' % i, 'member': [{'name': 'batch-%d' % i}]} for i in range(3)]
+            self.assertEqual(fgt.post_batch('firewall', 'addrgrp', groups, vdom="root")['success'], 3)
+            self.assertTrue(index.is_referenced('firewall', 'address', 'batch-2', vdom='root'))
+            fgt.logout()
+        finally:
+            fake.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()